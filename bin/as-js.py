@@ -1,8 +1,12 @@
 #!/usr/bin/python
 
 import datetime
+import gzip
+import hashlib
+import itertools
 import json
-import math
+import multiprocessing
+import multiprocessing.pool
 import optparse
 import os
 from pipes import quote as shell_quote
@@ -10,152 +14,745 @@ import cPickle as pickle
 import re
 import shlex
 import sys
+import tempfile
 
+import numpy
 import shapely.geometry
 import shapely.wkb
 from shapely.geometry import LineString, MultiLineString, GeometryCollection
-import psycopg2
 
+import dpranks
+import gridcache
+import pathcodec
+import regioncache
+import runstats
 import utils
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# The version of the manifest of --format=bundle
+BUNDLE_VERSION = 1
+
 class SimplifiedPolygonRing(object):
-    def __init__(self, coords):
-        self.coords = coords
-        self.__geo_interface__ = {
-          "type": "LineString", "coordinates": coords,
-        }
+    """A simplified ring, whose coords are an (N,2) array. These are
+    often views into the arrays of a SimplifiedMultipolygon.
+    """
+    __slots__ = ("coords", "cart_coords", "levels")
+    
+    def __init__(self, coords, cart_coords=None, levels=None):
+        self.coords = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+        # The (K, N, 2) array of coords interpolated for each cart, if known
+        self.cart_coords = cart_coords
+        # For --levels, the index of the coarsest level that keeps each point
+        self.levels = levels
+    
+    @property
+    def __geo_interface__(self):
+        return { "type": "LineString", "coordinates": self.coords.tolist() }
+    
+    def __getstate__(self):
+        return dict(( (slot, getattr(self, slot)) for slot in self.__slots__ ))
+    
+    def __setstate__(self, state):
+        # (Rings pickled by older versions have their coords as a list of
+        # (x, y), and a __geo_interface__ as well)
+        self.__init__(state["coords"], state.get("cart_coords"), state.get("levels"))
 
 class SimplifiedGeom(object):
+    __slots__ = ("exterior", "interiors")
+    
     def __init__(self, exterior, interiors):
         self.exterior = exterior
         self.interiors = interiors
-        self.__geo_interface__ = {
+    
+    @property
+    def __geo_interface__(self):
+        return {
           "type": "Polygon",
           "coordinates": [
-            exterior.coords
-          ] + [
-            interior.coords for interior in interiors
+            ring.coords.tolist() for ring in [ self.exterior ] + list(self.interiors)
           ]
         }
+    
+    def __getstate__(self):
+        return dict(( (slot, getattr(self, slot)) for slot in self.__slots__ ))
+    
+    def __setstate__(self, state):
+        self.__init__(state["exterior"], state["interiors"])
 
 class SimplifiedMultipolygon(object):
-  def __init__(self, region_name, geoms):
+  """A simplified region, whose rings are all kept in one (N,2) array,
+  points. Ring i is points[ring_offsets[i]:ring_offsets[i+1]], and polygon
+  j is made of rings polygon_offsets[j] to polygon_offsets[j+1] - 1, the
+  exterior ring first. geoms gives the polygons as SimplifiedGeoms, whose
+  rings are views into points (and cart_points and levels).
+  """
+  __slots__ = ("region_name", "points", "ring_offsets", "polygon_offsets", "cart_points", "levels", "breakpoints")
+  
+  def __init__(self, region_name, geoms, breakpoints=None):
+    rings = [ ring for geom in geoms for ring in [ geom.exterior ] + list(geom.interiors) ]
     self.region_name = region_name
-    self.geoms = geoms
-    self.__geo_interface__ = {
-      "type": "MultiPolygon", "id": region_name, "coordinates": [
-        polygon.__geo_interface__["coordinates"] for polygon in geoms
+    self.points = numpy.concatenate([ ring.coords for ring in rings ]) if rings else numpy.zeros((0, 2))
+    self.ring_offsets = numpy.cumsum([ 0 ] + [ len(ring.coords) for ring in rings ])
+    self.polygon_offsets = numpy.cumsum([ 0 ] + [ 1 + len(geom.interiors) for geom in geoms ])
+    # The (K, N, 2) array of points interpolated for each cart, if known
+    self.cart_points = None
+    if rings and all(ring.cart_coords is not None for ring in rings):
+      self.cart_points = numpy.concatenate([ ring.cart_coords for ring in rings ], axis=1)
+    # For --levels, the index of the coarsest level that keeps each point
+    self.levels = None
+    if rings and all(ring.levels is not None for ring in rings):
+      self.levels = numpy.concatenate([ ring.levels for ring in rings ])
+    # The points where the region's borders with its neighbours meet, as a
+    # list of (x, y), or None if they are not known
+    self.breakpoints = breakpoints
+  
+  @property
+  def geoms(self):
+    ring_offsets = self.ring_offsets.tolist()
+    rings = [
+      SimplifiedPolygonRing(
+        self.points[start:end],
+        None if self.cart_points is None else self.cart_points[:, start:end],
+        None if self.levels is None else self.levels[start:end],
+      )
+      for start, end in zip(ring_offsets[:-1], ring_offsets[1:])
+    ]
+    polygon_offsets = self.polygon_offsets.tolist()
+    return [
+      SimplifiedGeom(exterior=rings[start], interiors=rings[start+1:end])
+      for start, end in zip(polygon_offsets[:-1], polygon_offsets[1:])
+    ]
+  
+  def split(self, points):
+    """Split an (N,2) array of points, one for each of this multipolygon's
+    points, into a list of polygons, each a list of rings.
+    """
+    rings = numpy.split(points, self.ring_offsets[1:-1])
+    polygon_offsets = self.polygon_offsets.tolist()
+    return [ rings[start:end] for start, end in zip(polygon_offsets[:-1], polygon_offsets[1:]) ]
+  
+  @property
+  def __geo_interface__(self):
+    return {
+      "type": "MultiPolygon", "id": self.region_name, "coordinates": [
+        [ ring.tolist() for ring in rings ] for rings in self.polygons()
       ]
     }
   
+  def __getstate__(self):
+    return dict(( (slot, getattr(self, slot)) for slot in self.__slots__ ))
+  
+  def __setstate__(self, state):
+    if "points" not in state:
+      # A region pickled by an older version, with a list of geoms
+      self.__init__(state["region_name"], state["geoms"], state.get("breakpoints"))
+      return
+    for slot in self.__slots__:
+      setattr(self, slot, state[slot])
+  
+  @classmethod
+  def from_polygons(cls, region_name, polygons, breakpoints=None):
+    """Make a SimplifiedMultipolygon from a list of polygons, each a list
+    of rings (the exterior ring and then any interior rings), each an (N,2)
+    array, and an (M,2) array of breakpoints, as stored in a region cache file.
+    """
+    return cls(region_name, [
+      SimplifiedGeom(exterior=SimplifiedPolygonRing(rings[0]), interiors=map(SimplifiedPolygonRing, rings[1:]))
+      for rings in polygons
+    ], None if breakpoints is None else map(tuple, breakpoints.tolist()))
+  
+  def polygons(self):
+    """The rings of this multipolygon, as from_polygons takes them.
+    """
+    return self.split(self.points)
+  
+class GeoJSONWriter(object):
+  """Write a GeoJSON FeatureCollection of regions to filename, one region
+  at a time, from a background thread. The file is compressed with gzip
+  if filename ends with .gz. If levels is given, it is the list of
+  simplifications of --levels, and each feature has a "levels" property.
+  The bytes written (before compression) are counted in stats.
+  
+  The file is written to a temporary name, and only renamed into place
+  by commit(), so a run that fails part of the way through leaves no
+  truncated file behind. (See regioncache.RegionCacheWriter.)
+  """
+  def __init__(self, filename, srid, levels=None, stats=runstats.NULL):
+    self.filename = filename
+    fd, self.tmp_filename = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(filename)),
+      prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    self.f = os.fdopen(fd, 'wb')
+    if filename.endswith(".gz"):
+      # (Named in the gzip header as the file it will be renamed to)
+      f = gzip.GzipFile(os.path.basename(filename[:-len(".gz")]), 'wb', 9, self.f)
+    else:
+      f = self.f
+    self.writer = runstats.counted(utils.BackgroundWriter(f), stats)
+    self.n_features = 0
+    self.writer.write("""{ "type": "FeatureCollection", 
+%s    "crs": {
+          "type": "name",
+          "properties": {
+              "name": "urn:ogc:def:crs:EPSG::%d"
+          }
+      },
+"features": [
+""" % ("" if levels is None else '    "simplification_levels": %s,\n' % (json.dumps(levels),), srid))
+  
+  def write_feature(self, region_name, coords, levels=None):
+    properties = { "name": region_name }
+    if levels is not None:
+      properties["levels"] = levels
+    self.writer.write(("\n" if self.n_features == 0 else ",\n") + json.dumps({
+      "type": "Feature",
+      "id": region_name,
+      "properties": properties,
+      "geometry": {
+        "type": "MultiPolygon",
+        "coordinates": coords
+      }
+    }))
+    self.n_features += 1
+  
+  def commit(self):
+    self.writer.write("]}\n")
+    self.writer.close()
+    self.f.close()
+    os.chmod(self.tmp_filename, 0666 & ~gridcache._umask())
+    os.rename(self.tmp_filename, self.filename)
+  
+  def abort(self):
+    try:
+      self.writer.close()
+      self.f.close()
+    finally:
+      os.unlink(self.tmp_filename)
+
+class BundleChunkWriter(object):
+  """Write a chunk of a bundle to filename: a JSON object of region name
+  => value, written one region at a time from a background thread. The
+  bytes written are counted in stats.
+  
+  As for GeoJSONWriter, the chunk is written to a temporary name. So are
+  the compressed copies that close() makes, and commit() renames them all
+  into place.
+  """
+  def __init__(self, filename, stats=runstats.NULL):
+    self.filename = filename
+    self.tmp_filenames = {}
+    self.f = self._create("")
+    self.writer = runstats.counted(utils.BackgroundWriter(self.f), stats)
+    self.n_regions = 0
+    self.writer.write("{")
+  
+  def _create(self, suffix):
+    """Open a temporary file for filename + suffix."""
+    fd, self.tmp_filenames[suffix] = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(self.filename)),
+      prefix=os.path.basename(self.filename + suffix) + ".", suffix=".tmp")
+    return os.fdopen(fd, 'wb')
+  
+  def write_region(self, region_name, value):
+    self.writer.write(("\n" if self.n_regions == 0 else ",\n") + json.dumps(region_name) + ": " + json.dumps(value))
+    self.n_regions += 1
+  
+  def close(self):
+    """Finish the chunk and write its .gz and (if the brotli module is
+    installed) .br copies, returning a dict of its size, SHA-1 and
+    compressed sizes for the manifest.
+    """
+    self.writer.write("\n}\n")
+    self.writer.close()
+    
+    print >>sys.stderr, "Compressing %s..." % (self.filename,)
+    with open(self.tmp_filenames[""], 'rb') as f:
+      data = f.read()
+    chunk = { "bytes": len(data), "sha1": hashlib.sha1(data).hexdigest() }
+    
+    # With no timestamp, the same chunk always compresses to the same bytes
+    with self._create(".gz") as f:
+      with gzip.GzipFile(os.path.basename(self.filename), 'wb', 9, f, mtime=0) as gz:
+        gz.write(data)
+    chunk["gzip_bytes"] = os.path.getsize(self.tmp_filenames[".gz"])
+    
+    if brotli is not None:
+      with self._create(".br") as f:
+        f.write(brotli.compress(data, quality=11))
+      chunk["brotli_bytes"] = os.path.getsize(self.tmp_filenames[".br"])
+    return chunk
+  
+  def commit(self):
+    while self.tmp_filenames:
+      suffix, tmp_filename = self.tmp_filenames.popitem()
+      os.chmod(tmp_filename, 0666 & ~gridcache._umask())
+      os.rename(tmp_filename, self.filename + suffix)
+  
+  def abort(self):
+    try:
+      self.writer.close()
+    finally:
+      for tmp_filename in self.tmp_filenames.values():
+        os.unlink(tmp_filename)
+
 class MultipolygonSimplifier(object):
-  def __init__(self, simplification_dict, simplification, interpolators, raw_key, max_segment_length):
+  """Simplify the rings of regions, segment by segment, where the rings
+  are split into segments (arcs) at the breakpoints.
+  
+  Each arc is simplified, densified and interpolated in a canonical
+  direction, so a border that two neighbours share comes out exactly the
+  same for both of them. If share_arcs is true, the result for an arc is
+  also kept until the neighbour on the other side of it asks for it,
+  so each border is only simplified once. Once expect_regions has said
+  which regions are to come, an arc is only kept while one of them may
+  still ask for it, so coastlines and borders with regions that are not
+  output are not held on to, and the arcs kept are only those along the
+  edge of the regions done so far.
+  
+  If levels is given, it is a list of simplifications, finest first, and
+  the rings are simplified for all of them at once: each ring keeps the
+  points of the finest level, and its levels attribute gives the index of
+  the coarsest level that keeps each point. (A per-region simplification
+  scales all the levels for that region in proportion.)
+  
+  If densify_tolerance is given, points are added along any edge that
+  one of the carts would bend by more than that, where output_scale is
+  the (x, y) size of an output unit in map units. (See _densify_adaptive.)
+  
+  The time spent densifying and interpolating is recorded in stats.
+  """
+  # The most times an edge is split by _densify_adaptive
+  MAX_DENSIFY_ROUNDS = 6
+  
+  def __init__(self, simplification_dict, simplification, interpolator, max_segment_length, share_arcs=True, levels=None,
+               densify_tolerance=None, output_scale=(1, 1), stats=runstats.NULL):
     self.simplification_dict = simplification_dict
     self.simplification = simplification
-    self.interpolators = interpolators
-    self.raw_key = raw_key
+    self.interpolator = interpolator
     self.max_segment_length = None if max_segment_length is None else float(max_segment_length)
+    self.share_arcs = share_arcs
+    self.levels = None if levels is None else numpy.array(sorted(levels), dtype=numpy.float64)
+    self.densify_tolerance = densify_tolerance
+    self.output_scale = numpy.array(output_scale, dtype=numpy.float64)
+    self.stats = stats
+    # Simplified arcs waiting for the other region they border
+    self._arcs = {}
+    # The keys of the arcs in _arcs that end at each breakpoint
+    self._arcs_at = {}
+    # The regions yet to be simplified that have each breakpoint, if
+    # expect_regions has been called
+    self._claimants = None
+  
+  def expect_regions(self, region_breakpoints):
+    """Only keep a shared arc while a region yet to be simplified may ask
+    for it, given (region name, breakpoints) for each region to come.
+    """
+    self._claimants = {}
+    for region_name, breakpoints in region_breakpoints:
+      for point in breakpoints:
+        self._claimants.setdefault(point, set()).add(region_name)
+  
+  def skip(self, region_name, breakpoints):
+    """Note that a region expected by expect_regions will not be
+    simplified after all (because it was cached, say), so that the arcs
+    kept for it can be let go.
+    """
+    self._region_started(region_name, breakpoints)
+    self._region_finished(breakpoints)
+  
+  def _region_started(self, region_name, breakpoints):
+    if self._claimants is not None:
+      for point in breakpoints:
+        self._claimants.get(point, set()).discard(region_name)
+  
+  def _region_finished(self, breakpoints):
+    """Let go of the kept arcs that end at breakpoints and that no region
+    yet to come may ask for.
+    """
+    if self._claimants is None:
+      return
+    for point in breakpoints:
+      for key in list(self._arcs_at.get(point, ())):
+        if key in self._arcs and not self._may_be_asked_for(*self._arcs[key][1]):
+          self._forget_arc(key)
+  
+  def _may_be_asked_for(self, start, end):
+    """Whether a region yet to come may ask for an arc from start to end:
+    one that has both of them as breakpoints.
+    """
+    if self._claimants is None:
+      return True
+    start_claimants, end_claimants = self._claimants.get(start), self._claimants.get(end)
+    return bool(start_claimants and end_claimants and not start_claimants.isdisjoint(end_claimants))
+  
+  def _keep_arc(self, key, simplified, ends):
+    self._arcs[key] = (simplified, ends)
+    for point in ends:
+      self._arcs_at.setdefault(point, set()).add(key)
+  
+  def _forget_arc(self, key):
+    simplified, ends = self._arcs.pop(key)
+    for point in ends:
+      keys = self._arcs_at[point]
+      keys.discard(key)
+      if not keys:
+        del self._arcs_at[point]
+    return simplified
   
   def simplify(self, region_name, multipolygon, breakpoints):
-    return [
-      SimplifiedGeom(
-        exterior=self._simplify(region_name, geom.exterior, breakpoints),
-        interiors=[
-          self._simplify(region_name, interior, breakpoints)
-          for interior in geom.interiors
-        ]
-      )
+    self._region_started(region_name, breakpoints)
+    simplification = self.simplification_dict.get(region_name, self.simplification)
+    polygons = [
+      [ utils.as_coords_array(ring.coords) for ring in [ geom.exterior ] + list(geom.interiors) ]
       for geom in multipolygon.geoms
     ]
+    segments = [ [ self._segments(coords, breakpoints) for coords in polygon ] for polygon in polygons ]
+    
+    # Simplify the arcs of all the rings together
+    arcs = iter(self._simplify_arcs(
+      [ coords[segment] for polygon, polygon_segments in zip(polygons, segments) for coords, ring_segments in zip(polygon, polygon_segments) for segment in ring_segments ],
+      simplification,
+      [ len(ring_segments) > 1 for polygon_segments in segments for ring_segments in polygon_segments for segment in ring_segments ],
+    ))
+    rings = [
+      [ self._join_arcs([ arcs.next() for segment in ring_segments ]) for ring_segments in polygon_segments ]
+      for polygon_segments in segments
+    ]
+    self._region_finished(breakpoints)
+    return [ SimplifiedGeom(exterior=polygon_rings[0], interiors=polygon_rings[1:]) for polygon_rings in rings ]
   
-  def _simplify(self, region_name, ring, breakpoints):
-    simplification = self.simplification_dict.get(region_name, self.simplification)
+  def ranks(self, multipolygon, breakpoints):
+    """The rank of each point of each ring of multipolygon, as measured
+    by simplify(): the largest simplification that keeps the point. (See
+    dpranks.) The ranks of all the rings are concatenated, leaving out the
+    last point of each ring, which repeats the first.
+    """
+    rings = [ utils.as_coords_array(ring.coords) for geom in multipolygon.geoms for ring in [ geom.exterior ] + list(geom.interiors) ]
+    segments = [ self._segments(coords, breakpoints) for coords in rings ]
+    arcs = [ self._canonical(coords[segment]) for coords, ring_segments in zip(rings, segments) for segment in ring_segments ]
+    if not arcs:
+      return numpy.zeros(0)
     
-    prev = None
-    ret = []
-    for segment in self._segments(ring.coords, breakpoints):
-      max_stretch = self._max_stretch(segment)
-      ls = LineString(segment).simplify(tolerance=simplification / max_stretch, preserve_topology=False)
-      max_segment_length = None if self.max_segment_length is None else self.max_segment_length / max_stretch
-      
-      for coord in ls.coords:
-        if coord != prev:
-          
-          if max_segment_length and prev:
-            d = self._distance(prev, coord)
-            if d > max_segment_length:
-              fraction = max_segment_length / d
-              dx, dy = (coord[0]-prev[0])*fraction, (coord[1]-prev[1])*fraction
-              while d > max_segment_length:
-                prev = (prev[0] + dx, prev[1] + dy)
-                ret.append(prev)
-                d -= max_segment_length
-          
-          ret.append(coord)
-        
-        prev = coord
+    offsets = numpy.cumsum([ 0 ] + [ len(arc) for arc, reverse, arc_hash in arcs ])
+    stretches = self._arc_stretches(arcs, offsets)
+    arc_ranks = numpy.split(
+      dpranks.ranks_of_lines(numpy.concatenate([ arc for arc, reverse, arc_hash in arcs ]), offsets, numpy.zeros(len(arcs)))
+      * numpy.repeat(stretches, numpy.diff(offsets)), offsets[1:-1])
+    
+    ranks, i = [], 0
+    for coords, ring_segments in zip(rings, segments):
+      ring_ranks = numpy.zeros(len(coords))
+      for segment in ring_segments:
+        (arc, reverse, arc_hash), r = arcs[i], arc_ranks[i]
+        i += 1
+        # (The breakpoints at the ends of each arc have infinite rank)
+        ring_ranks[segment] = numpy.maximum(ring_ranks[segment], r[::-1] if reverse else r)
+      # The first point is kept if either copy of it is
+      ring_ranks[0] = max(ring_ranks[0], ring_ranks[-1])
+      ranks.append(ring_ranks[:-1])
+    return numpy.concatenate(ranks)
+  
+  def _join_arcs(self, arcs):
+    """The SimplifiedPolygonRing made of the simplified arcs of a ring."""
+    # Drop repeated points, such as the breakpoint where one segment meets the next
+    points = numpy.concatenate([ arc_points for arc_points, arc_cart_points, arc_levels in arcs ])
+    keep = numpy.ones(len(points), dtype=bool)
+    keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+    
+    if self.interpolator:
+      cart_coords = numpy.concatenate([ arc_cart_points for arc_points, arc_cart_points, arc_levels in arcs ], axis=1)[:, keep]
+    else:
+      cart_coords = None
+    if self.levels is not None:
+      levels = numpy.concatenate([ arc_levels for arc_points, arc_cart_points, arc_levels in arcs ])[keep]
+    else:
+      levels = None
+    return SimplifiedPolygonRing(points[keep], cart_coords, levels)
+  
+  @staticmethod
+  def _canonical(arc):
+    """(arc, reverse, arc_hash), where arc is the (N,2) array arc in
+    whichever direction has the smaller representation, reverse is whether
+    that is backwards, and arc_hash identifies it. Working in this
+    direction means the result doesn't depend on which neighbour the arc
+    came from.
+    """
+    forwards, backwards = arc.tostring(), arc[::-1].tostring()
+    reverse = backwards < forwards
+    return (arc[::-1] if reverse else arc), reverse, hashlib.sha1(min(forwards, backwards)).digest()
+  
+  def _simplify_arcs(self, arcs, simplification, shared):
+    """Simplify the list of (N,2) arrays arcs, returning for each of them
+    the simplified points, a (K, M, 2) array of them interpolated for each
+    cart (or None), and for --levels the level index of each of them (or
+    None). shared[i] says whether arcs[i] is one that a neighbouring region
+    may also have.
+    
+    The arcs are measured, simplified and interpolated all together, since
+    most of them are short and numpy calls on them one at a time would
+    cost more than the arithmetic.
+    """
+    results = [ None ] * len(arcs)
+    # The arcs to simplify, as (index in arcs, canonical arc, reverse, arc hash)
+    todo = []
+    # The keys of the shared arcs in todo, and where they are in it
+    pending = {}
+    # Arcs that are the same as another in todo, by index, as (index in todo, reverse)
+    same_as = {}
+    for i, (arc, is_shared) in enumerate(zip(arcs, shared)):
+      arc, reverse, arc_hash = self._canonical(arc)
+      # (Arcs of two points are not worth sharing, and include the empty arc
+      # that _segments makes when a ring starts at a breakpoint)
+      if is_shared and self.share_arcs and len(arc) > 2:
+        key = (arc_hash, len(arc), simplification)
+        if key in self._arcs:
+          results[i] = self._oriented(self._forget_arc(key), reverse)
+          continue
+        if key in pending:
+          same_as[i] = (pending.pop(key), reverse)
+          continue
+        pending[key] = len(todo)
+      todo.append((i, arc, reverse, arc_hash))
+    
+    if todo:
+      simplified = self._simplify_canonical_arcs([ (arc, reverse, arc_hash) for i, arc, reverse, arc_hash in todo ], simplification)
+      for (i, arc, reverse, arc_hash), result in zip(todo, simplified):
+        results[i] = self._oriented(result, reverse)
+      for i, (j, reverse) in same_as.items():
+        results[i] = self._oriented(simplified[j], reverse)
+      # Keep the shared arcs that the neighbours on the other side of them
+      # have yet to ask for
+      for key, j in pending.items():
+        arc = todo[j][1]
+        ends = (tuple(arc[0].tolist()), tuple(arc[-1].tolist()))
+        if self._may_be_asked_for(*ends):
+          self._keep_arc(key, simplified[j], ends)
+    return results
+  
+  def _simplify_canonical_arcs(self, arcs, simplification):
+    """Simplify arcs, a list of (arc, reverse, arc_hash) from _canonical,
+    returning a list of (points, cart_points, levels) as _simplify_arcs does,
+    but in the canonical direction.
+    """
+    offsets = numpy.cumsum([ 0 ] + [ len(arc) for arc, reverse, arc_hash in arcs ])
+    points = numpy.concatenate([ arc for arc, reverse, arc_hash in arcs ])
+    stretches = self._arc_stretches(arcs, offsets)
+    arc_of_point = numpy.repeat(numpy.arange(len(arcs)), numpy.diff(offsets))
+    
+    if self.levels is None:
+      tolerances = simplification / stretches
+      ranks = dpranks.ranks_of_lines(points, offsets, tolerances)
+      # (Exactly the points that LineString.simplify would keep)
+      keep = ranks > tolerances[arc_of_point]
+      levels = None
+    else:
+      tolerances = self.levels[numpy.newaxis, :] * (simplification / float(self.simplification)) / stretches[:, numpy.newaxis]
+      ranks = dpranks.ranks_of_lines(points, offsets, tolerances[:, 0])
+      # A point is in each level whose tolerance is less than its rank
+      levels = (tolerances[arc_of_point] < ranks[:, numpy.newaxis]).sum(axis=1) - 1
+      keep = levels >= 0
+      levels = numpy.split(levels[keep], numpy.cumsum(numpy.bincount(arc_of_point[keep], minlength=len(arcs)))[:-1])
+    kept = numpy.split(points[keep], numpy.cumsum(numpy.bincount(arc_of_point[keep], minlength=len(arcs)))[:-1])
     
-    return SimplifiedPolygonRing(ret)
+    if self.max_segment_length:
+      with self.stats.stage("densify"):
+        kept = [ self._densify(arc_points, numpy.repeat(self.max_segment_length / stretch, len(arc_points) - 1)) for arc_points, stretch in zip(kept, stretches) ]
+    if self.densify_tolerance and self.interpolator:
+      with self.stats.stage("densify"):
+        kept = map(self._densify_adaptive, kept)
+    
+    if self.interpolator:
+      kept_offsets = numpy.cumsum([ len(arc_points) for arc_points in kept ])[:-1]
+      with self.stats.stage("interpolate"):
+        cart_points = numpy.split(self.interpolator.map_array(numpy.concatenate(kept)), kept_offsets, axis=1)
+    else:
+      cart_points = [ None ] * len(arcs)
+    if levels is None:
+      levels = [ None ] * len(arcs)
+    return zip(kept, cart_points, levels)
+  
+  def _arc_stretches(self, arcs, offsets):
+    """The largest factor by which any of the carts lengthens each of arcs,
+    a list of (arc, reverse, arc_hash) from _canonical whose points start at
+    offsets, or 1 for an arc that none of them lengthens.
+    """
+    stretches = numpy.ones(len(arcs))
+    if not self.interpolator:
+      return stretches
+    
+    points = numpy.concatenate([ arc for arc, reverse, arc_hash in arcs ])
+    lengths = self._arc_lengths(points, offsets)
+    with self.stats.stage("interpolate"):
+      cart_points = self.interpolator.map_array(points)
+    cart_lengths = self._arc_lengths(cart_points, offsets).max(axis=0)
+    stretched = (lengths > 0) & (cart_lengths > lengths)
+    stretches[stretched] = cart_lengths[stretched] / lengths[stretched]
+    return stretches
+  
+  @staticmethod
+  def _arc_lengths(points, offsets):
+    """The length of each of the paths through the (..., N, 2) array of
+    points that start at offsets, as a (..., len(offsets) - 1) array.
+    (Each path has at least two points, as the arcs from _segments do.)
+    """
+    d = numpy.diff(points, axis=-2)
+    edge_lengths = numpy.sqrt((d * d).sum(axis=-1))
+    # Leave out the edges from the end of one path to the start of the next
+    edge_lengths[..., offsets[1:-1] - 1] = 0
+    return numpy.add.reduceat(edge_lengths, offsets[:-1], axis=-1)
+  
+  @staticmethod
+  def _oriented((points, cart_points, levels), reverse):
+    if not reverse:
+      return points, cart_points, levels
+    return (
+      points[::-1],
+      None if cart_points is None else cart_points[:, ::-1],
+      None if levels is None else levels[::-1],
+    )
   
   def _segments(self, coords, breakpoints):
-    segments = [[]]
-    for coord in coords:
-      segments[-1].append(coord)
-      if coord in breakpoints:
-        segments.append([coord])
+    """Split the (N,2) array coords into the segments between breakpoints,
+    returning a list of arrays of indices into coords. Each breakpoint is
+    the last point of one segment and the first of the next, and the first
+    and last segments are joined, since the ring is closed.
+    """
+    n = len(coords)
+    if breakpoints:
+      bp = numpy.array(list(breakpoints), dtype=numpy.float64)
+      is_breakpoint = numpy.in1d(coords[:,0] + 1j * coords[:,1], bp[:,0] + 1j * bp[:,1])
+      b = numpy.flatnonzero(is_breakpoint)
+    else:
+      b = []
     
-    if len(segments) > 1:
-      # Join the first and last segments
-      segments[0] = segments.pop() + segments[0]
+    if len(b) == 0:
+      return [ numpy.arange(n) ]
     
+    segments = [ numpy.arange(start, end + 1) for start, end in zip(b[:-1], b[1:]) ]
+    # Join the first and last segments
+    segments.insert(0, numpy.concatenate([ numpy.arange(b[-1], n), numpy.arange(0, b[0] + 1) ]))
     return segments
   
   def _segment_length(self, segment):
-    return sum([
-      self._distance(p1, p2)
-      for p1, p2 in zip(segment, segment[1:])
-    ])
+    """The length of the path through the (..., N, 2) array of points segment.
+    """
+    d = numpy.diff(segment, axis=-2)
+    return numpy.sqrt((d * d).sum(axis=-1)).sum(axis=-1)
   
-  def _distance(self, (x1,y1), (x2,y2)):
-    return math.sqrt((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))
-  
-  def _max_stretch(self, segment):
-    l = self._segment_length(segment)
-    if l == 0 or self.interpolators.keys() == [self.raw_key]:
-      return 1
+  def _densify(self, points, max_lengths):
+    """Add points along any edge of the (N,2) array points that is longer
+    than the corresponding entry of max_lengths, evenly spaced from the
+    start of the edge at intervals of the maximum length.
+    """
+    delta = points[1:] - points[:-1]
+    d = numpy.sqrt((delta * delta).sum(axis=1))
+    long_edge = d > max_lengths
+    if not long_edge.any():
+      return points
     
-    max_stretch = max([
-      self._segment_length(interpolator.map(segment))
-      for interpolator in self.interpolators.values() if interpolator
-    ])
+    n_extra = numpy.zeros(len(d), dtype=numpy.intp)
+    n_extra[long_edge] = numpy.ceil(d[long_edge] / max_lengths[long_edge]) - 1
     
-    if max_stretch > l:
-      return max_stretch / l
-    else:
-      return 1
+    # The index in the result of each of the original points
+    position = numpy.arange(len(points))
+    position[1:] += numpy.cumsum(n_extra)
+    result = numpy.empty((position[-1] + 1, 2))
+    result[position] = points
+    
+    # The added points are numbered 1, 2, ... along each edge
+    edge = numpy.repeat(numpy.arange(len(d)), n_extra)
+    step = numpy.arange(len(edge)) - numpy.repeat(numpy.cumsum(n_extra) - n_extra, n_extra) + 1
+    step_delta = delta * (max_lengths / d)[:, numpy.newaxis]
+    result[position[edge] + step] = points[edge] + step[:, numpy.newaxis] * step_delta[edge]
+    return result
+
+  
+  def _densify_adaptive(self, points):
+    """Add points along the edges of the (N,2) array points where the
+    carts would bend them, so that the interpolated edges, drawn straight,
+    are within densify_tolerance output units of the curves they stand for.
+    
+    The bend of an edge is measured both from the change in the Jacobian
+    of the carts between its ends and from where its midpoint lands, and
+    an edge that bends too much is split into as many equal parts as that
+    bend calls for, since the bend of each part goes down as the square
+    of its length. The new edges are measured in turn, up to
+    MAX_DENSIFY_ROUNDS times.
+    """
+    to_measure = numpy.arange(len(points) - 1)
+    for _ in range(self.MAX_DENSIFY_ROUNDS):
+      if len(to_measure) == 0:
+        break
+      a, b = points[to_measure], points[to_measure + 1]
+      n = len(a)
+      with self.stats.stage("interpolate"):
+        cart_points = self.interpolator.map_array(numpy.concatenate([ a, b, (a + b) / 2 ]))
+        jacobians = self.interpolator.jacobian_array(numpy.concatenate([ a, b ]))
+      cart_a, cart_b, cart_mid = cart_points[:, :n], cart_points[:, n:2*n], cart_points[:, 2*n:]
+      
+      # The midpoint of a curve with constant second derivative is off
+      # the chord by an eighth of the change in its first derivative
+      bend_jacobian = numpy.einsum("keij,ej->kei", jacobians[:, n:] - jacobians[:, :n], b - a) / 8
+      bend_midpoint = cart_mid - (cart_a + cart_b) / 2
+      bend = numpy.maximum(
+        numpy.sqrt(((bend_jacobian / self.output_scale) ** 2).sum(axis=-1)),
+        numpy.sqrt(((bend_midpoint / self.output_scale) ** 2).sum(axis=-1)),
+      ).max(axis=0)
+      
+      n_parts = numpy.ones(len(points) - 1, dtype=numpy.intp)
+      n_parts[to_measure] = numpy.maximum(1, numpy.ceil(numpy.sqrt(bend / self.densify_tolerance)))
+      if (n_parts == 1).all():
+        break
+      
+      lengths = self._segment_length(numpy.stack([ points[:-1], points[1:] ], axis=1))
+      # (Just over the length of each part, so the last part isn't split off)
+      points = self._densify(points, lengths / n_parts * (1 + 1e-9))
+      to_measure = numpy.flatnonzero(numpy.repeat(n_parts > 1, n_parts))
+    return points
 
 
+# With --jobs, regions are simplified and interpolated in a pool of worker
+# processes. The pool is forked once the cart grids are loaded, so each
+# worker inherits the AsJSON (and the grids) from the parent without
+# copying, and these functions find it here.
+_worker_as_json = None
+
+def _process_region_row(row):
+  return _worker_as_json.process_region_row(row)
+
+def _render_loaded_region(loaded):
+  return _worker_as_json.render_loaded_region(loaded)
+
 class AsJSON(object):
   def __init__(self, options, carts):
     self.options = options
     self.carts = carts
     
-    db_connection_data = []
-    if options.db_host:
-      db_connection_data.append("host=" + options.db_host)
-    if options.db_name:
-      db_connection_data.append(" dbname=" + options.db_name)
-    if options.db_user:
-      db_connection_data.append(" user=" + options.db_user)
+    # For --stats and --region-stats
+    if options.stats or options.region_stats:
+      self.stats = runstats.Stats()
+    else:
+      self.stats = runstats.NULL
+    self.region_stats_out = open(options.region_stats, 'w') if options.region_stats else None
     
-    self.db = psycopg2.connect(" ".join(db_connection_data))
-    self.m = utils.Map(self.db, options.map)
+    with self.stats.stage("connect"):
+      self.db = utils.db_connect(options)
+      self.m = utils.Map(self.db, options.map)
     
-    if options.format != "geojson":
-      if options.output:
-        self.out = open(options.output, 'w')
-      else:
-        self.out = sys.stdout
+    if options.format in ("geojson", "bundle") or options.add_carts:
+      self.out = None
+    elif options.format == "binary":
+      self.out = open(options.output, 'wb')
+    elif options.output:
+      self.out = open(options.output, 'w')
+    else:
+      self.out = sys.stdout
+    if self.out is not None:
+      self.out = runstats.counted(self.out, self.stats)
     
     if self.options.simplification_json:
       self.simplification_dict = json.loads(self.options.simplification_json)
@@ -166,96 +763,433 @@ class AsJSON(object):
       self.exclude_regions = set(shlex.split(options.exclude_regions))
     else:
       self.exclude_regions = set()
+    
+    # In subset mode, only the region named by --region, or the regions
+    # that intersect this bounding box, are output, and only the part of
+    # each cart grid that covers them is loaded (see _subset_bounds).
+    self.bbox = options.bbox or None
+  
+  def _subset_bounds(self):
+    """The bounding box of the regions to be output in subset mode, as
+    (x_min, y_min, x_max, y_max). The regions are output whole, so this
+    is usually larger than --bbox. (It includes any --exclude-regions.)
+    """
+    params = {
+        "srid": self.m.srid,
+        "division_id": self.m.division_id,
+    }
+    sql = """
+        select ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+        from (
+          select ST_Extent(ST_Transform(region.the_geom, %(srid)s)) e
+          from region
+          where region.division_id = %(division_id)s
+      """ + self._region_filter(params) + """
+        ) x
+      """
+    c = self.db.cursor()
+    try:
+      c.execute(sql, params)
+      row = c.fetchone()
+    finally:
+      c.close()
+    
+    if row is None or row[0] is None:
+      if self.options.region:
+        raise Exception("No such region: " + self.options.region)
+      # No regions intersect --bbox, so hardly any of the grid is needed
+      return self.bbox
+    return tuple(map(float, row))
   
   @staticmethod
   def _extract_cart_name(cart):
     n = re.sub(r".*/", "", cart)
+    n = re.sub(r"\.grid$", "", n)
     n = re.sub(r"\.cart$", "", n)
     return n
   
   def _init_carts(self):
-    self.interpolators = {
-      self.options.raw_key: None
-    }
-    for cart in self.carts:
-      cart_name = self._extract_cart_name(cart)
+    self.cart_names = [ self._extract_cart_name(cart) for cart in self.carts ]
+    self.keys = [ self.options.raw_key ] + self.cart_names
+    for cart_name in self.cart_names:
       print >>sys.stderr, "Loading cartogram grid for {cart_name}...".format(cart_name=cart_name)
-      self.interpolators[cart_name] = utils.FastInterpolator(cart, self.m)
-  
-  def region_paths(self):
-    if self.options.load_regions:
-      with open(self.options.load_regions, 'r') as f:
-        while True:
-          try:
-            yield pickle.load(f)
-          except EOFError:
-            return
-    
-    if self.options.dump_regions:
-      with open(self.options.dump_regions + ".new", 'w') as f:
-        for region in self._region_paths(f):
-          yield region
-      os.rename(self.options.dump_regions + ".new", self.options.dump_regions)
+    bbox = self._subset_bounds() if self.options.region or self.bbox else None
+    if self.carts:
+      with self.stats.stage("load_carts"):
+        self.interpolator = utils.MultiInterpolator(self.carts, self.m, bbox=bbox)
     else:
-      for region in self._region_paths():
-        yield region
-  
-  def _region_paths(self, dump_file=None):
-    simplifier = MultipolygonSimplifier(
+      self.interpolator = None
+    
+    # The simplified regions are only culled early if they are not being
+    # kept for another run, which might have other carts or thresholds
+    self.early_cull_stretches = None
+    if (self.options.min_feature_extent or self.options.min_feature_area) \
+        and not (self.options.dump_regions or self.options.load_regions or self.options.region_cache):
+      with self.stats.stage("load_carts"):
+        self.early_cull_stretches = numpy.concatenate([
+          [ 1.0 ], self.interpolator.max_stretches() if self.interpolator else []
+        ])
+    
+    # A worker process only sees some of the regions, so it could not
+    # tell when an arc it kept would never be asked for
+    self.simplifier = MultipolygonSimplifier(
         simplification_dict=self.simplification_dict,
         simplification=self.options.simplification,
-        interpolators=self.interpolators,
-        raw_key=self.options.raw_key,
+        interpolator=self.interpolator,
         max_segment_length=self.options.segmentize,
+        share_arcs=self.options.jobs == 1,
+        levels=self.options.levels,
+        densify_tolerance=self.options.densify_tolerance,
+        output_scale=self._output_unit(),
+        stats=self.stats,
     )
-    
-    c = self.db.cursor()
-    try:
-      if self.options.segmentize:
-        c.execute("""
-          select region.id
-               , region.name
-               , ST_AsEWKB(ST_Segmentize(ST_Transform(region.the_geom, %(srid)s), %(max_length)s)) geom_wkb
-               , ST_AsEWKB(ST_Transform(region.breakpoints, %(srid)s)) breakpoints_wkb
-          from region
-          where region.division_id = %(division_id)s
-        """, {
-            "srid": self.m.srid,
-            "division_id": self.m.division_id,
-            "max_length": self.options.segmentize,
-        })
-      else:
-        c.execute("""
-          select region.id
-               , region.name
-               , ST_AsEWKB(ST_Transform(region.the_geom, %(srid)s)) geom_wkb
-               , ST_AsEWKB(ST_Transform(region.breakpoints, %(srid)s)) breakpoints_wkb
-          from region
-          where region.division_id = %(division_id)s
-        """, {
-            "srid": self.m.srid,
-            "division_id": self.m.division_id,
-        })
-      
-      for region_id, region_name, geom_wkb, breakpoints_wkb in c:
-        if region_name in self.exclude_regions:
-          continue
-        geom = shapely.wkb.loads(str(geom_wkb))
+    if self.options.max_vertices is not None:
+      self._fit_vertex_budget()
+  
+  def _fit_vertex_budget(self):
+    """For --max-vertices, choose the simplification, and a larger one
+    for any region that needs it to keep --min-region-vertices, by ranking
+    the points of every region before any of them is simplified.
+    """
+    region_ranks = {}
+    for region_name, geom_wkb, breakpoints_wkb in self._region_rows():
+      self._progress("Ranking points of {region_name}...", region_name=region_name)
+      with self.stats.stage("parse"):
+        geom = shapely.wkb.loads(geom_wkb)
         breakpoints = set() if breakpoints_wkb is None else set((
-          (point.x, point.y) for point in shapely.wkb.loads(str(breakpoints_wkb))
+          (point.x, point.y) for point in shapely.wkb.loads(breakpoints_wkb)
         ))
-        
-        smp = SimplifiedMultipolygon(region_name, simplifier.simplify(region_name, geom, breakpoints))
-        if dump_file: pickle.dump(smp, dump_file, -1)
-        yield smp
+      with self.stats.stage("rank"):
+        region_ranks[region_name] = self.simplifier.ranks(geom, breakpoints)
+    
+    simplification, self.simplification_dict, n_vertices = dpranks.fit_budget(
+      region_ranks, self.options.max_vertices, self.options.min_region_vertices)
+    if n_vertices > self.options.max_vertices:
+      print >>sys.stderr, "Warning: cannot simplify to {max_vertices} points: the breakpoints and --min-region-vertices need {n_vertices}".format(
+        max_vertices=self.options.max_vertices, n_vertices=n_vertices)
+    print >>sys.stderr, "Simplifying to {n_vertices} points with simplification {simplification!r}{by_region}".format(
+      n_vertices=n_vertices, simplification=simplification,
+      by_region=", and by region " + json.dumps(self.simplification_dict, sort_keys=True) if self.simplification_dict else "")
+    
+    self.options.simplification = simplification
+    self.simplifier.simplification = simplification
+    self.simplifier.simplification_dict = self.simplification_dict
+  
+  def _progress(self, message, **kwargs):
+    """Print a progress message about a single region, with --verbose."""
+    if self.options.verbose:
+      print >>sys.stderr, message.format(**kwargs)
+  
+  def _region_cache_meta(self):
+    """The settings that the simplified regions depend on,
+    to be recorded in a region cache file.
+    """
+    return {
+      "map": self.options.map,
+      "simplification": self.options.simplification,
+      "simplification_dict": self.simplification_dict,
+      "segmentize": self.options.segmentize,
+      "densify_tolerance": self.options.densify_tolerance,
+      "carts": [
+        { "name": cart_name, "filename": os.path.abspath(cart), "sha1": cart_hash }
+        for cart_name, cart, cart_hash in zip(self.cart_names, self.carts, self.cart_hashes)
+      ],
+    }
+  
+  def rendered_regions(self):
+    """Yield (region, rendered) for each region, where rendered is
+    the result of render_region(region).
+    
+    The regions are yielded in the same order whether or not they are
+    processed in parallel, so the output does not depend on --jobs.
+    """
+    cache_filename = self.options.dump_regions or self.options.region_cache
+    if cache_filename:
+      # The carts are part of the key of each region
+      self.cart_hashes = map(regioncache.file_hash, self.carts)
+    else:
+      self.cart_hashes = None
+    
+    if self.options.load_regions:
+      work = self._loaded_regions()
+      process, process_in_worker = self.render_loaded_region, _render_loaded_region
+    else:
+      work = self._region_work()
+      process, process_in_worker = self.process_region_row, _process_region_row
+    
+    if self.options.jobs > 1:
+      results = self._parallel_map(process_in_worker, work)
+    else:
+      results = itertools.imap(process, work)
+    
+    if cache_filename:
+      writer = regioncache.RegionCacheWriter(cache_filename, self._region_cache_meta())
+      try:
+        for region, key, rendered, record in results:
+          # Whatever is done with the region until the next one is wanted,
+          # such as writing it out, is recorded as part of its work
+          with self.stats.resume(record):
+            with self.stats.stage("write_cache"):
+              writer.add(region.region_name, key, region.polygons(), getattr(region, "breakpoints", None) or ())
+            yield region, rendered
+          self._add_region_stats(record)
+      except:
+        writer.abort()
+        raise
+      with self.stats.stage("write_cache"):
+        writer.commit()
+    else:
+      for region, key, rendered, record in results:
+        with self.stats.resume(record):
+          yield region, rendered
+        self._add_region_stats(record)
+  
+  def _add_region_stats(self, record):
+    """Add the times and counters of a region to the totals, and write
+    them to --region-stats as a line of JSON.
+    """
+    if record is None:
+      return
+    self.stats.add(record)
+    if self.region_stats_out:
+      self.region_stats_out.write(json.dumps(record.as_dict(), sort_keys=True) + "\n")
+  
+  def write_stats(self):
+    """Write the summary for --stats, and finish --region-stats."""
+    if self.region_stats_out:
+      self.region_stats_out.close()
+    if self.options.stats:
+      self.stats.write_summary(self.options.stats)
+  
+  def _parallel_map(self, f, work):
+    global _worker_as_json
+    _worker_as_json = self
+    
+    # Anything still buffered would be written again by each worker
+    sys.stdout.flush()
+    if self.out is not None:
+      self.out.flush()
     
+    pool = multiprocessing.Pool(self.options.jobs)
+    try:
+      for result in pool.imap(f, work):
+        yield result
+      pool.close()
+    except:
+      pool.terminate()
+      raise
     finally:
-      c.close()
+      pool.join()
+  
+  def _loaded_regions(self):
+    """Yield (region, key) for each region in the --load-regions file.
+    """
+    if regioncache.is_region_cache(self.options.load_regions):
+      with regioncache.RegionCache(self.options.load_regions) as cache:
+        for region_name in cache.names:
+          with self.stats.stage("read_cache"):
+            polygons, breakpoints = cache.region(region_name)
+          yield SimplifiedMultipolygon.from_polygons(region_name, polygons, breakpoints), cache.key(region_name)
+      return
+    
+    # A stream of pickled regions, as written by older versions
+    with open(self.options.load_regions, 'r') as f:
+      while True:
+        try:
+          yield pickle.load(f), None
+        except EOFError:
+          return
+  
+  def render_region(self, region):
+    """The SVG paths of region (or, for ActionScript, the path as a list
+    of commands and numbers, and for GeoJSON, its coordinates) for every
+    key, as a dict.
+    """
+    if self.options.format == "geojson":
+      return self.multipolygon_as_coords(region)
+    if self.options.format == "actionscript":
+      return self.multipolygon_as_actionscript(region)
+    if self.options.format == "binary":
+      return self.multipolygon_as_binary(region)
+    if self.options.format == "topojson":
+      return self.multipolygon_as_topology_rings(region)
+    return self.multipolygon_as_svg(region)
+  
+  def render_loaded_region(self, (region, key)):
+    """Render a region from _loaded_regions(), returning (region, key,
+    rendered, record), where record holds the stats of the region.
+    """
+    with self.stats.region(region.region_name) as record:
+      with self.stats.stage("render"):
+        rendered = self.render_region(region)
+    return region, key, rendered, record
+  
+  def _region_work(self):
+    """Yield (region_name, key, geom_wkb, breakpoints_wkb, region) for
+    each region, for process_region_row. If the region is in the region
+    cache with the same key, region is the cached region and there is
+    no need to simplify it again; otherwise it is None.
+    
+    The key is only needed, and only computed, if the regions are being
+    written to a region cache file.
+    """
+    if self.simplifier.share_arcs:
+      self.simplifier.expect_regions(self._region_breakpoints())
+    rows = utils.prefetch(self._region_rows(), self.options.prefetch)
+    if self.cart_hashes is None:
+      for region_name, geom_wkb, breakpoints_wkb in rows:
+        yield region_name, None, geom_wkb, breakpoints_wkb, None
+      return
+    
+    old_cache = None
+    if self.options.region_cache and os.path.exists(self.options.region_cache) \
+        and regioncache.is_current(self.options.region_cache):
+      old_cache = regioncache.RegionCache(self.options.region_cache)
+    
+    densify = None
+    if self.options.densify_tolerance is not None:
+      densify = (self.options.densify_tolerance,) + self._output_unit()
+    
+    try:
+      reused = 0
+      for region_name, geom_wkb, breakpoints_wkb in rows:
+        with self.stats.stage("read_cache"):
+          key = regioncache.region_key(geom_wkb, breakpoints_wkb,
+            self.simplification_dict.get(region_name, self.options.simplification),
+            self.options.segmentize, self.cart_hashes, densify)
+          cached = old_cache.get(region_name, key) if old_cache else None
+        if cached is None:
+          yield region_name, key, geom_wkb, breakpoints_wkb, None
+        else:
+          reused += 1
+          region = SimplifiedMultipolygon.from_polygons(region_name, *cached)
+          self.simplifier.skip(region_name, region.breakpoints or ())
+          yield region_name, key, None, None, region
+      
+      if old_cache:
+        print >>sys.stderr, "Reused {reused} of {n} regions from {filename}".format(
+          reused=reused, n=len(old_cache), filename=self.options.region_cache)
+    finally:
+      if old_cache:
+        old_cache.close()
+  
+  def process_region_row(self, row):
+    """Simplify (unless it was cached) and render a region from
+    _region_work(), returning (region, key, rendered, record), where
+    record holds the stats of the region.
+    """
+    region_name, key, geom_wkb, breakpoints_wkb, region = row
+    with self.stats.region(region_name) as record:
+      if region is None:
+        with self.stats.stage("parse"):
+          geom = shapely.wkb.loads(geom_wkb)
+          breakpoints = set() if breakpoints_wkb is None else set((
+            (point.x, point.y) for point in shapely.wkb.loads(breakpoints_wkb)
+          ))
+        if self.stats.enabled:
+          self.stats.count("vertices_in", sum((
+            len(ring.coords) for g in geom.geoms for ring in [ g.exterior ] + list(g.interiors)
+          )))
+        if self.early_cull_stretches is not None:
+          geom = self._without_small_polygons(geom)
+        with self.stats.stage("simplify"):
+          region = SimplifiedMultipolygon(region_name, self.simplifier.simplify(region_name, geom, breakpoints), sorted(breakpoints))
+      self.stats.count("vertices_simplified", len(region.points))
+      
+      with self.stats.stage("render"):
+        rendered = self.render_region(region)
+    # The interpolated points are not needed once the region is rendered,
+    # so don't keep them (or send them back from a worker process)
+    region.cart_points = None
+    return region, key, rendered, record
+  
+  def _region_filter(self, params):
+    """The conditions that select the regions to be output, other than
+    --exclude-regions, to be added to the where clause of a query on
+    region, adding their parameters to params.
+    """
+    if self.options.region:
+      params["region_name"] = self.options.region
+      return """  and region.name = %(region_name)s
+      """
+    if self.bbox:
+      params.update(zip(("xmin", "ymin", "xmax", "ymax"), self.bbox))
+      return """  and ST_Intersects(
+          ST_Transform(region.the_geom, %(srid)s),
+          ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s)
+        )
+      """
+    return ""
+  
+  def _region_breakpoints(self):
+    """Yield (region_name, breakpoints) for each region to be output,
+    where breakpoints is a set of (x, y), as for the simplifier.
+    """
+    sql = """
+        select region.name
+             , ST_AsEWKB(ST_Transform(region.breakpoints, %(srid)s)) breakpoints_wkb
+        from region
+        where region.division_id = %(division_id)s
+      """
+    params = {
+        "srid": self.m.srid,
+        "division_id": self.m.division_id,
+    }
+    sql += self._region_filter(params)
+    
+    rows = utils.stream_rows(self.db, sql, params, self.options.fetch_size)
+    for region_name, breakpoints_wkb in self.stats.timed("query", rows):
+      if region_name in self.exclude_regions or breakpoints_wkb is None:
+        continue
+      yield region_name, set((
+        (point.x, point.y) for point in shapely.wkb.loads(str(breakpoints_wkb))
+      ))
+  
+  def _region_rows(self):
+    """Yield (region_name, geom_wkb, breakpoints_wkb) for each region
+    to be output, where breakpoints_wkb may be None.
+    
+    The regions are streamed from the database --fetch-size at a time.
+    """
+    if self.options.segmentize:
+      sql = """
+        select region.id
+             , region.name
+             , ST_AsEWKB(ST_Segmentize(ST_Transform(region.the_geom, %(srid)s), %(max_length)s)) geom_wkb
+             , ST_AsEWKB(ST_Transform(region.breakpoints, %(srid)s)) breakpoints_wkb
+        from region
+        where region.division_id = %(division_id)s
+      """
+      params = {
+          "srid": self.m.srid,
+          "division_id": self.m.division_id,
+          "max_length": self.options.segmentize,
+      }
+    else:
+      sql = """
+        select region.id
+             , region.name
+             , ST_AsEWKB(ST_Transform(region.the_geom, %(srid)s)) geom_wkb
+             , ST_AsEWKB(ST_Transform(region.breakpoints, %(srid)s)) breakpoints_wkb
+        from region
+        where region.division_id = %(division_id)s
+      """
+      params = {
+          "srid": self.m.srid,
+          "division_id": self.m.division_id,
+      }
+    sql += self._region_filter(params)
+    
+    rows = utils.stream_rows(self.db, sql, params, self.options.fetch_size)
+    for region_id, region_name, geom_wkb, breakpoints_wkb in self.stats.timed("query", rows):
+      if region_name in self.exclude_regions:
+        continue
+      yield region_name, str(geom_wkb), None if breakpoints_wkb is None else str(breakpoints_wkb)
   
   def print_region_paths(self):
     self._init_carts()
     
-    if self.options.format != "geojson":
+    if self.options.format in ("js", "actionscript"):
         print >>self.out, "// This file is auto-generated. Please do not edit."
         print >>self.out, "// Generated at {t} UTC.".format(t=str(datetime.datetime.utcnow()))
         print >>self.out, "// Generated by {c}".format(c=" ".join(map(shell_quote, sys.argv)))
@@ -265,184 +1199,759 @@ class AsJSON(object):
         "js": self.print_region_paths_js,
         "actionscript": self.print_region_paths_actionscript,
         "geojson": self.print_region_paths_geojson,
+        "binary": self.print_region_paths_binary,
+        "topojson": self.print_region_paths_topojson,
+        "bundle": self.print_region_paths_bundle,
     }[self.options.format]()
 
   def print_region_paths_js(self):
-    empty_object_json = json.dumps( dict(( (k, {}) for k in self.interpolators.keys() )) )
+    empty_object_json = json.dumps( dict(( (k, {}) for k in self.keys )) )
     print >>self.out, "var %s = %s;" % (self.options.data_var, empty_object_json,)
     
-    for region in self.region_paths():
-      print >>sys.stderr, "Extracting paths for {region_name}...".format(region_name=region.region_name)
-      for k, path in self.multipolygon_as_svg(region).items():
-        print >>self.out, "{data_var}[{k}][{region_name}] = {path};".format(
-          data_var=self.options.data_var,
+    if self.options.levels:
+      print >>self.out, "var %s_levels = %s;" % (self.options.data_var, json.dumps({
+        "simplification": self.options.levels, "regions": {},
+      }))
+    
+    for region, paths in self.rendered_regions():
+      self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+      with self.stats.stage("write"):
+        for k, path in paths.items():
+          print >>self.out, "{data_var}[{k}][{region_name}] = {path};".format(
+            data_var=self.options.data_var,
+            k=json.dumps(k),
+            region_name=json.dumps(region.region_name),
+            path=json.dumps(path),
+          )
+        if self.options.levels:
+          print >>self.out, "{data_var}_levels[\"regions\"][{region_name}] = {levels};".format(
+            data_var=self.options.data_var,
+            region_name=json.dumps(region.region_name),
+            levels=json.dumps(self.path_levels(region)),
+          )
+  
+  def print_region_paths_actionscript(self):
+    paths_by_key = {}
+    for region, paths in self.rendered_regions():
+      self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+      for k, path in paths.items():
+        paths_by_key.setdefault(k, {})[region.region_name] = path
+    
+    with self.stats.stage("write"):
+      print >>self.out, "package {"
+      print >>self.out, "public class MapData {"
+      print >>self.out, "  public var paths : Object = {};"
+      print >>self.out, "  public function MapData() {"
+      
+      for k, paths in paths_by_key.iteritems():
+        print >>self.out, "    paths[{k}] = {paths};".format(
+          paths=json.dumps(paths),
           k=json.dumps(k),
-          region_name=json.dumps(region.region_name),
-          path=json.dumps(path),
         )
+      
+      print >>self.out, "  }"
+      print >>self.out, "}}"
   
-  def print_region_paths_actionscript(self):
-    def try_int(x):
-      try: return int(x)
-      except ValueError: return x
+  def print_region_paths_geojson(self):
+    # Each region is written to the file for each key as soon as it
+    # has been rendered, so only one region is held in memory at a time
+    writers = self._geojson_writers(self.keys)
+    try:
+      for region, coords_by_key in self.rendered_regions():
+        self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+        levels = self.coords_levels(region) if self.options.levels else None
+        with self.stats.stage("write"):
+          for k, coords in coords_by_key.items():
+            writers[k].write_feature(region.region_name, coords, levels)
+    except:
+      self._abort_writers(writers.values())
+      raise
+    with self.stats.stage("write"):
+      for writer in writers.values():
+        writer.commit()
+  
+  def print_region_paths_binary(self):
+    """Write the paths in the binary format of pathcodec.py, all the
+    regions for each key together, and a manifest giving the offset of
+    each path to the output file name with .json added.
+    """
+    region_names = []
+    paths_by_key = dict(( (k, []) for k in self.keys ))
+    for region, encoded in self.rendered_regions():
+      self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+      region_names.append(region.region_name)
+      for k in self.keys:
+        paths_by_key[k].append(encoded[k])
+    
+    manifest = {
+      "version": pathcodec.VERSION,
+      "generated": str(datetime.datetime.utcnow()),
+      "generated_by": " ".join(map(shell_quote, sys.argv)),
+      "scale": self._quantization_scale(),
+      "decimal_digits": self.options.decimal_digits,
+      "regions": region_names,
+      "keys": self.keys,
+      "paths": {},
+    }
+    with self.stats.stage("write"):
+      offset = 0
+      for k in self.keys:
+        # The offsets of the paths for each region, relative to the start
+        # of the key, followed by the length of the paths for the key
+        offsets = [0]
+        for path in paths_by_key[k]:
+          self.out.write(path)
+          offsets.append(offsets[-1] + len(path))
+        manifest["paths"][k] = { "offset": offset, "offsets": offsets }
+        offset += offsets[-1]
+      self.out.close()
+      
+      with open(self.options.output + ".json", 'w') as f:
+        json.dump(manifest, f)
+  
+  def print_region_paths_bundle(self):
+    """Write the paths to the output directory as a bundle, so that a web
+    page can fetch just the keys it shows: a JSON chunk for each key (the
+    raw key included) of region name => SVG path, each with precompressed
+    .gz and (if the brotli module is installed) .br copies, and a manifest
+    in manifest.json that lists the regions, keys and chunk files.
+    With --levels, there is also a chunk of region name => path_levels,
+    given by "levels" in the manifest.
+    
+    The manifest is written last, once every chunk is in place, so a page
+    that reads it never finds a chunk missing.
+    """
+    directory = self.options.output
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    
+    # The levels are not a key, so their chunk has a name of its own
+    levels_filename = "levels.levels.json" if self.options.levels else None
+    chunk_filenames = {}
+    for k in self.keys:
+      chunk_filename = re.sub(r"[^A-Za-z0-9_.-]", "_", k) + ".json"
+      if chunk_filename in chunk_filenames.values() or chunk_filename == levels_filename:
+        raise Exception("Two chunks would both be written to " + chunk_filename)
+      chunk_filenames[k] = chunk_filename
+    
+    # Each chunk is written as the regions are rendered, as for GeoJSON.
+    # The writers are listed in the order of self.keys, then the levels.
+    region_names = []
+    writers = []
+    try:
+      for k in self.keys:
+        writers.append(BundleChunkWriter(os.path.join(directory, chunk_filenames[k]), self.stats))
+      if self.options.levels:
+        writers.append(BundleChunkWriter(os.path.join(directory, levels_filename), self.stats))
+      writer_by_key = dict(zip(self.keys, writers))
+      
+      for region, paths in self.rendered_regions():
+        self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+        with self.stats.stage("write"):
+          for k, path in paths.items():
+            writer_by_key[k].write_region(region.region_name, path)
+          if self.options.levels:
+            writers[-1].write_region(region.region_name, self.path_levels(region))
+        region_names.append(region.region_name)
+      
+      if brotli is None:
+        print >>sys.stderr, "The brotli module is not installed, so there will be no .br files"
+      pool = multiprocessing.pool.ThreadPool(min(len(writers), multiprocessing.cpu_count()))
+      try:
+        with self.stats.stage("compress"):
+          chunks = pool.map(BundleChunkWriter.close, writers)
+      finally:
+        pool.close()
+        pool.join()
+      for writer in writers:
+        writer.commit()
+    except:
+      self._abort_writers(writers)
+      raise
     
+    for k, chunk in zip(self.keys, chunks):
+      chunk["file"] = chunk_filenames[k]
+    manifest = {
+      "version": BUNDLE_VERSION,
+      "generated": str(datetime.datetime.utcnow()),
+      "generated_by": " ".join(map(shell_quote, sys.argv)),
+      "decimal_digits": self.options.decimal_digits,
+      "raw_key": self.options.raw_key,
+      "regions": region_names,
+      "keys": self.keys,
+      "chunks": dict(zip(self.keys, chunks)),
+    }
+    if self.options.levels:
+      manifest["levels"] = dict(chunks[-1], file=levels_filename, simplification=self.options.levels)
+    
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix="manifest.json.", suffix=".tmp")
+    with os.fdopen(fd, 'w') as f:
+      json.dump(manifest, f, indent=2, sort_keys=True)
+    os.chmod(tmp_filename, 0666 & ~gridcache._umask())
+    os.rename(tmp_filename, os.path.join(directory, "manifest.json"))
+  
+  def print_region_paths_topojson(self):
+    """Write a TopoJSON topology with an object for each key, holding the
+    regions as MultiPolygons. The rings of the regions are cut into arcs at
+    the breakpoints, and an arc that is shared by neighbouring regions is
+    only stored once, in the direction it was first seen.
+    
+    The arcs for every key have the same structure, so the arcs for the
+    i-th key are just the arcs for the raw map offset by i times the number
+    of arcs. Coordinates are transformed as for the js output, and
+    quantized to --decimal-digits.
+    """
+    arc_index = {}
+    arcs_by_key = dict(( (k, []) for k in self.keys ))
+    regions = []
+    for region, polygons in self.rendered_regions():
+      self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+      region_arcs = []
+      for polygon in polygons:
+        polygon_arcs = []
+        for raw, cuts, quantized in polygon:
+          ring_arcs = []
+          for arc in self._ring_arcs(len(raw), cuts):
+            # Arcs are identified by their unquantized map coordinates
+            forwards, backwards = raw[arc].tostring(), raw[arc[::-1]].tostring()
+            if forwards in arc_index:
+              ring_arcs.append(arc_index[forwards])
+            elif backwards in arc_index:
+              ring_arcs.append(~arc_index[backwards])
+            else:
+              arc_index[forwards] = len(arcs_by_key[self.options.raw_key])
+              ring_arcs.append(arc_index[forwards])
+              for k in self.keys:
+                deltas = quantized[k][arc]
+                deltas[1:] -= quantized[k][arc[:-1]]
+                arcs_by_key[k].append(deltas.tolist())
+          polygon_arcs.append(ring_arcs)
+        region_arcs.append(polygon_arcs)
+      regions.append((region.region_name, region_arcs))
+    
+    n_arcs = len(arcs_by_key[self.options.raw_key])
+    print >>sys.stderr, "{n_arcs} arcs for {n_regions} regions".format(n_arcs=n_arcs, n_regions=len(regions))
+    
+    def shift(arc, offset):
+      return arc + offset if arc >= 0 else ~(~arc + offset)
+    
+    topology = {
+      "type": "Topology",
+      "transform": {
+        "scale": [ self._quantization_scale(), self._quantization_scale() ],
+        "translate": [ 0, 0 ],
+      },
+      "objects": {},
+      "arcs": [],
+    }
+    for i, k in enumerate(self.keys):
+      topology["arcs"].extend(arcs_by_key[k])
+      topology["objects"][k] = {
+        "type": "GeometryCollection",
+        "geometries": [
+          {
+            "type": "MultiPolygon",
+            "id": region_name,
+            "properties": { "name": region_name },
+            "arcs": [
+              [ [ shift(arc, i * n_arcs) for arc in ring ] for ring in polygon ]
+              for polygon in region_arcs
+            ],
+          }
+          for region_name, region_arcs in regions
+        ],
+      }
+    
+    with self.stats.stage("write"):
+      json.dump(topology, self.out, separators=(",", ":"))
+      print >>self.out
+  
+  @staticmethod
+  def _ring_arcs(n, cuts):
+    """Arrays of indices for the arcs of a closed ring of n points (the last
+    repeating the first) cut at the points whose indices are in cuts.
+    """
+    if len(cuts) == 0:
+      return [ numpy.arange(n) ]
+    arcs = [ numpy.arange(start, end + 1) for start, end in zip(cuts[:-1], cuts[1:]) ]
+    arcs.append(numpy.concatenate([ numpy.arange(cuts[-1], n - 1), numpy.arange(0, cuts[0] + 1) ]))
+    return arcs
+  
+  def _geojson_writers(self, keys):
+    """A GeoJSONWriter for the file for each key, as a dict."""
+    srid = self.m.srid - 900000 if self.m.srid > 900000 else self.m.srid
+    writers = {}
+    try:
+      for k in keys:
+        out_filename = self.options.output % (k,)
+        print >>sys.stderr, "Writing %s..." % (out_filename,)
+        writers[k] = GeoJSONWriter(out_filename, srid, self.options.levels, self.stats)
+    except:
+      self._abort_writers(writers.values())
+      raise
+    return writers
+  
+  @staticmethod
+  def _abort_writers(writers):
+    """Abort writers, after an error that is to be raised again, so
+    that nothing they have written is left behind.
+    """
+    for writer in writers:
+      try:
+        writer.abort()
+      except Exception:
+        # The error that is being handled matters more
+        pass
+  
+  # Adding carts to an existing output
+  #
+  # The regions are loaded from the region file that the output was made
+  # from, so the new paths have exactly the same vertices as the existing
+  # ones, and the raw paths are rendered again and checked against those
+  # in the output to make sure that it really was made from these regions.
+  
+  def add_region_paths(self):
+    self._init_carts()
+    existing = {
+        "js": self._read_paths_js,
+        "actionscript": self._read_paths_actionscript,
+        "geojson": self._read_coords_geojson,
+    }[self.options.format]()
+    
+    for k in self.cart_names:
+      if k in existing:
+        raise Exception("{output} already has paths for {k}".format(output=self.options.output, k=k))
+    raw = existing.get(self.options.raw_key)
+    if raw is None:
+      raise Exception("{output} has no {raw_key} paths to check the regions against".format(
+        output=self.options.output, raw_key=self.options.raw_key))
+    
+    added = []
+    for region, rendered in self.rendered_regions():
+      self._progress("Extracting paths for {region_name}...", region_name=region.region_name)
+      if raw.get(region.region_name) != rendered[self.options.raw_key]:
+        raise Exception("The paths for {region_name} in {output} were not made from the regions in {regions}".format(
+          region_name=region.region_name, output=self.options.output, regions=self.options.load_regions))
+      added.append((region.region_name, rendered))
+    
+    missing = set(raw) - set(region_name for region_name, rendered in added)
+    if missing:
+      raise Exception("{output} has regions that are not in {regions}: {missing}".format(
+        output=self.options.output, regions=self.options.load_regions,
+        missing=", ".join(sorted(missing))))
+    
+    with self.stats.stage("write"):
+      {
+          "js": self._add_paths_js,
+          "actionscript": self._add_paths_actionscript,
+          "geojson": self._add_coords_geojson,
+      }[self.options.format](added)
+  
+  def _parse_js_assignment(self, line):
+    """Parse a line of js output of the form data[k1][k2]... = value;
+    returning ([k1, k2, ...], value), or None if it is not of that form.
+    """
+    decoder = json.JSONDecoder()
+    if not line.startswith(self.options.data_var + "["):
+      return None
+    i = len(self.options.data_var)
+    keys = []
+    while line.startswith("[", i):
+      k, i = decoder.raw_decode(line, i + 1)
+      if not line.startswith("]", i):
+        return None
+      keys.append(k)
+      i += 1
+    if not line.startswith(" = ", i):
+      return None
+    value, i = decoder.raw_decode(line, i + 3)
+    if line[i:] != ";":
+      return None
+    return keys, value
+  
+  def _read_paths_js(self):
+    """The paths in the existing js output, as a dict of key => dict of
+    region name => path.
+    """
+    paths_by_key = {}
+    declaration = "var {data_var} = ".format(data_var=self.options.data_var)
+    with open(self.options.output, 'r') as f:
+      for line in f:
+        line = line.rstrip("\n")
+        if line.startswith(declaration) and line.endswith(";"):
+          for k in json.loads(line[len(declaration):-1]):
+            paths_by_key.setdefault(k, {})
+          continue
+        
+        assignment = self._parse_js_assignment(line)
+        if assignment is None:
+          continue
+        keys, value = assignment
+        if len(keys) == 1:
+          paths_by_key.setdefault(keys[0], {})
+        elif len(keys) == 2:
+          paths_by_key.setdefault(keys[0], {})[keys[1]] = value
+    return paths_by_key
+  
+  def _add_paths_js(self, added):
+    with open(self.options.output, 'a') as out:
+      print >>out, "// Added {keys} at {t} UTC.".format(
+        keys=", ".join(self.cart_names), t=str(datetime.datetime.utcnow()))
+      print >>out, "// Added by {c}".format(c=" ".join(map(shell_quote, sys.argv)))
+      for k in self.cart_names:
+        print >>out, "{data_var}[{k}] = {{}};".format(data_var=self.options.data_var, k=json.dumps(k))
+      for region_name, paths in added:
+        for k in self.cart_names:
+          print >>out, "{data_var}[{k}][{region_name}] = {path};".format(
+            data_var=self.options.data_var,
+            k=json.dumps(k),
+            region_name=json.dumps(region_name),
+            path=json.dumps(paths[k]),
+          )
+  
+  def _read_paths_actionscript(self):
     paths_by_key = {}
-    for region in self.region_paths():
-      print >>sys.stderr, "Extracting paths for {region_name}...".format(region_name=region.region_name)
-      for k, path in self.multipolygon_as_svg(region).items():
-        paths_by_key.setdefault(k, {})[region.region_name] = map(try_int, path.split(" "))
-    
-    print >>self.out, "package {"
-    print >>self.out, "public class MapData {"
-    print >>self.out, "  public var paths : Object = {};"
-    print >>self.out, "  public function MapData() {"
-    
-    for k, paths in paths_by_key.iteritems():
-      print >>self.out, "    paths[{k}] = {paths};".format(
-        paths=json.dumps(paths),
+    with open(self.options.output, 'r') as f:
+      for line in f:
+        mo = re.match(r"^    paths\[(.*?)\] = (\{.*\});$", line.rstrip("\n"))
+        if mo:
+          paths_by_key[json.loads(mo.group(1))] = json.loads(mo.group(2))
+    return paths_by_key
+  
+  def _add_paths_actionscript(self, added):
+    with open(self.options.output, 'r') as f:
+      lines = f.readlines()
+    
+    # The new paths go at the end of the constructor
+    if lines[-2:] != ["  }\n", "}}\n"]:
+      raise Exception("Unrecognised ActionScript file: " + self.options.output)
+    new_lines = [
+      "    paths[{k}] = {paths};\n".format(
+        paths=json.dumps(dict(( (region_name, paths[k]) for region_name, paths in added ))),
         k=json.dumps(k),
       )
+      for k in self.cart_names
+    ]
     
-    print >>self.out, "  }"
-    print >>self.out, "}}"
+    with open(self.options.output + ".new", 'w') as out:
+      out.writelines(lines[:-2] + new_lines + lines[-2:])
+    os.rename(self.options.output + ".new", self.options.output)
   
-  def print_region_paths_geojson(self):
-    by_cart = {}
-    for region in self.region_paths():
-      print >>sys.stderr, "Extracting paths for {region_name}...".format(region_name=region.region_name)
-      for k, coords in self.multipolygon_as_coords(region).items():
-        by_cart.setdefault(k, {})[region.region_name] = coords
-    
-    for k,d in by_cart.iteritems():
-      out_filename = self.options.output % (k,)
-      print >>sys.stderr, "Writing %s..." % (out_filename,)
-      with open(out_filename, 'w') as out:
-        print >>out, """{ "type": "FeatureCollection", """
-        print >>out, """    "crs": {{
-            "type": "name",
-            "properties": {{
-                "name": "urn:ogc:def:crs:EPSG::{srid}"
-            }}
-        }},""".format(srid=self.m.srid - 900000 if self.m.srid > 900000 else self.m.srid)
-        print >>out, '"features": ['
-        
-        first_time = True
-        for region_name, coords in d.iteritems():
-          if first_time:
-            print >>out
-            first_time = False
-          else:
-            print >>out, ","
-          
-          json.dump({
-            "type": "Feature",
-            "id": region_name,
-            "properties": {
-              "name": region_name,
-            },
-            "geometry": {
-              "type": "MultiPolygon",
-              "coordinates": coords
-            }
-          }, out)
-        
-        print >>out, "]}"
+  def _read_coords_geojson(self):
+    coords_by_key = {}
+    out_filename = self.options.output % (self.options.raw_key,)
+    with (gzip.open if out_filename.endswith(".gz") else open)(out_filename, 'rb') as f:
+      coords_by_key[self.options.raw_key] = dict((
+        (feature["id"], feature["geometry"]["coordinates"])
+        for feature in json.load(f)["features"]
+      ))
+    for k in self.cart_names:
+      if os.path.exists(self.options.output % (k,)):
+        coords_by_key[k] = {}
+    return coords_by_key
   
-  def _transform(self, x, y):
+  def _add_coords_geojson(self, added):
+    writers = self._geojson_writers(self.cart_names)
+    try:
+      for region_name, coords in added:
+        for k in self.cart_names:
+          writers[k].write_feature(region_name, coords[k])
+    except:
+      self._abort_writers(writers.values())
+      raise
+    for writer in writers.values():
+      writer.commit()
+  
+  def _output_unit(self):
+    """The size of a unit of the output coordinates, in map units,
+    as (x, y).
+    """
     if not self.options.output_grid:
-      return x, -y
+      return (1, 1)
     return (
-      (x - self.m.x_min) * self.options.output_grid_width / (self.m.x_max - self.m.x_min),
-      self.options.output_grid_height - (y - self.m.y_min) * self.options.output_grid_height / (self.m.y_max - self.m.y_min),
+      (self.m.x_max - self.m.x_min) / float(self.options.output_grid_width),
+      (self.m.y_max - self.m.y_min) / float(self.options.output_grid_height),
     )
   
-  def polygon_ring_as_svg(self, ring, path_arrs):
-    for k, path_arr in path_arrs.items():
-      path_arr.append("M")
-      first = True
-      interpolator = self.interpolators.get(k)
-      for x, y in interpolator.map(ring.coords) if interpolator else ring.coords:
-        x, y = self._transform(x, y)
-        path_arr.append("%.*f" % (self.options.decimal_digits, x))
-        path_arr.append("%.*f" % (self.options.decimal_digits, y))
-        if first:
-          path_arr.append("L")
-          first = False
-      
-      if path_arr[-1] == "L":
-        # The path contains only one point, so skip it
-        path_arr[-4:] = []
-        return
-      
-      path_arr[-2:] = ["Z"] # The last point is presumably equal to the first
-      
-      if path_arr[-2] == "L":
-        # The path contains only one point, so skip it
-        path_arr[-5:] = []
-        return
-
-  def multipolygon_as_svg(self, region):
-    path_arrs = dict((
-      (k, []) for k in self.interpolators.keys()
+  def _transform_array(self, coords):
+    """Transform an (N,2) array of map coordinates to output coordinates.
+    """
+    if not self.options.output_grid:
+      return coords * [1, -1]
+    return numpy.column_stack([
+      (coords[:,0] - self.m.x_min) * self.options.output_grid_width / (self.m.x_max - self.m.x_min),
+      self.options.output_grid_height - (coords[:,1] - self.m.y_min) * self.options.output_grid_height / (self.m.y_max - self.m.y_min),
+    ])
+  
+  def region_arrays_by_key(self, region):
+    """The points of all the rings of region, raw and interpolated for
+    every cart, as a dict of key => (N,2) array.
+    """
+    arrays_by_key = { self.options.raw_key: region.points }
+    if self.interpolator:
+      cart_points = region.cart_points
+      if cart_points is None:
+        with self.stats.stage("interpolate"):
+          cart_points = self.interpolator.map_array(region.points)
+      arrays_by_key.update(zip(self.cart_names, cart_points))
+    return arrays_by_key
+  
+  def ring_arrays_by_key(self, ring):
+    """The coordinates of ring, raw and interpolated for every cart,
+    as a dict of key => (N,2) array.
+    """
+    coords = utils.as_coords_array(ring.coords)
+    arrays_by_key = { self.options.raw_key: coords }
+    if self.interpolator:
+      cart_coords = getattr(ring, "cart_coords", None)
+      if cart_coords is None:
+        with self.stats.stage("interpolate"):
+          cart_coords = self.interpolator.map_array(coords)
+      arrays_by_key.update(zip(self.cart_names, cart_coords))
+    return arrays_by_key
+  
+  def _quantization_scale(self):
+    return 10.0 ** -self.options.decimal_digits
+  
+  def multipolygon_as_binary(self, region):
+    """The paths of region for every key, encoded by pathcodec."""
+    rings_by_key = dict(( (k, []) for k in self.keys ))
+    for g in region.geoms:
+      for ring in [ g.exterior ] + list(g.interiors):
+        # As in the SVG paths, leave out the last point, which repeats
+        # the first, and skip rings that are only one point after that
+        if len(ring.coords) <= 2:
+          continue
+        for k, coords in self.ring_arrays_by_key(ring).items():
+          rings_by_key[k].append(pathcodec.quantize(self._transform_array(coords[:-1]), self._quantization_scale()))
+          self.stats.count("vertices_out", len(coords) - 1, k)
+    
+    return dict((
+      (k, pathcodec.encode_path(rings)) for k, rings in rings_by_key.items()
     ))
+  
+  def multipolygon_as_topology_rings(self, region):
+    """The rings of region, for the TopoJSON output: a list of polygons,
+    each a list of rings, each a tuple (raw, cuts, quantized) where raw is
+    the (N,2) array of map coordinates of the ring, cuts is an array of the
+    indices of the breakpoints in it, and quantized is a dict of key => (N,2)
+    array of quantized output coordinates. As for GeoJSON, degenerate rings
+    are left out, along with any polygon whose exterior is degenerate.
+    """
+    breakpoints = getattr(region, "breakpoints", None)
+    if breakpoints:
+      bp = numpy.array(breakpoints, dtype=numpy.float64)
+      bp = bp[:,0] + 1j * bp[:,1]
+    
+    polygons = []
     for g in region.geoms:
-      self.polygon_ring_as_svg(g.exterior, path_arrs)
-      for interior in g.interiors:
-        self.polygon_ring_as_svg(interior, path_arrs)
+      rings = []
+      for ring in [ g.exterior ] + list(g.interiors):
+        if len(ring.coords) < 4:
+          if not rings:
+            break
+          continue
+        arrays_by_key = self.ring_arrays_by_key(ring)
+        raw = arrays_by_key[self.options.raw_key]
+        if breakpoints:
+          cuts = numpy.flatnonzero(numpy.in1d(raw[:-1,0] + 1j * raw[:-1,1], bp))
+        else:
+          cuts = numpy.zeros(0, dtype=numpy.intp)
+        rings.append((raw, cuts, dict((
+          (k, pathcodec.quantize(self._transform_array(coords), self._quantization_scale()))
+          for k, coords in arrays_by_key.items()
+        ))))
+        for k in arrays_by_key:
+          self.stats.count("vertices_out", len(raw), k)
+      if rings:
+        polygons.append(rings)
+    return polygons
+  
+  # The js, ActionScript and GeoJSON outputs are all written from the
+  # rounded output coordinates of multipolygon_as_arrays, so each ring
+  # is rounded and formatted once for each key, a whole ring at a time.
+  
+  def multipolygon_as_arrays(self, region, transform=True):
+    """The rings of region for every key, as a dict of key => list of
+    polygons, each a list of (N,2) arrays of coordinates rounded to
+    --decimal-digits: the exterior ring followed by any interior rings.
+    If transform is true, the coordinates are output coordinates (see
+    _transform_array) rather than map coordinates. Small features are
+    left out for each key separately (see _without_small_features).
+    """
+    cull = self.options.min_feature_extent or self.options.min_feature_area
+    arrays = {}
+    for k, points in self.region_arrays_by_key(region).items():
+      output_points = self._transform_array(points) if transform or cull else None
+      if transform:
+        points = output_points
+      polygons = region.split(numpy.round(points, self.options.decimal_digits))
+      if cull:
+        polygons = self._without_small_features(region, polygons, output_points)
+      if self.stats.enabled:
+        self.stats.count("vertices_out", sum(( len(ring) for rings in polygons for ring in rings )), k)
+      arrays[k] = polygons
+    return arrays
+  
+  @staticmethod
+  def _ring_sizes(region, points):
+    """The extent (the larger of the width and the height) and the area
+    of every ring of region, given the output coordinates of its points,
+    as two arrays.
+    """
+    starts, ends = region.ring_offsets[:-1], region.ring_offsets[1:]
+    extent, area = numpy.zeros(len(starts)), numpy.zeros(len(starts))
+    nonempty = ends > starts
+    if not nonempty.any():
+      return extent, area
+    
+    # Leaving out the empty rings, each ring runs from its start to the
+    # start of the next
+    starts, ends = starts[nonempty], ends[nonempty]
+    x, y = points[:,0], points[:,1]
+    extent[nonempty] = numpy.maximum(
+      numpy.maximum.reduceat(x, starts) - numpy.minimum.reduceat(x, starts),
+      numpy.maximum.reduceat(y, starts) - numpy.minimum.reduceat(y, starts))
+    
+    # The shoelace formula, for which the rings must be closed, as they are
+    cross = numpy.zeros(len(points))
+    cross[:-1] = x[:-1] * y[1:] - x[1:] * y[:-1]
+    cross[ends - 1] = 0
+    area[nonempty] = numpy.abs(numpy.add.reduceat(cross, starts)) / 2
+    return extent, area
+  
+  def _without_small_features(self, region, polygons, output_points):
+    """Leave out of polygons (as from region.split) the rings whose size
+    in the output, given by output_points, is less than --min-feature-extent
+    or --min-feature-area, and every polygon whose exterior ring is. If
+    that would leave out every polygon, the largest is kept, so that
+    the region does not disappear.
+    """
+    extent, area = self._ring_sizes(region, output_points)
+    small = (extent < (self.options.min_feature_extent or 0)) | (area < (self.options.min_feature_area or 0))
+    polygon_starts = region.polygon_offsets[:-1]
+    if len(polygons) and small[polygon_starts].all():
+      small[polygon_starts[numpy.argmax(area[polygon_starts])]] = False
+    
+    small = small.tolist()
+    return [
+      [ ring for i, ring in enumerate(rings, start) if not small[i] ]
+      for start, rings in zip(polygon_starts.tolist(), polygons)
+      if not small[start]
+    ]
+  
+  def _without_small_polygons(self, multipolygon):
+    """Leave out of multipolygon, before it is simplified, the polygons
+    that _without_small_features would leave out for every key whatever
+    the cartograms did to them.
+    
+    For the raw key, the extent of a polygon is that of its bounding box.
+    Two points of a polygon are never further apart than the diagonal of
+    its bounding box, so for a cart its extent is at most the diagonal
+    times the max_stretch of the cart grid, and its area at most the
+    square of that. If every polygon would be left out, they are all
+    kept, for _without_small_features to keep the largest in each key,
+    and otherwise the largest is only chosen from the polygons kept here.
+    """
+    unit_x, unit_y = self._output_unit()
+    bounds = numpy.array([ geom.bounds for geom in multipolygon.geoms ]).reshape(-1, 4)
+    width, height = bounds[:,2] - bounds[:,0], bounds[:,3] - bounds[:,1]
+    
+    # The most each polygon could measure in each key, as (polygons, keys) arrays
+    extent = numpy.outer(numpy.hypot(width, height) / min(unit_x, unit_y), self.early_cull_stretches)
+    area = extent ** 2
+    extent[:,0] = numpy.maximum(width / unit_x, height / unit_y)
+    area[:,0] = width * height / (unit_x * unit_y)
+    
+    small = ((extent < (self.options.min_feature_extent or 0)) | (area < (self.options.min_feature_area or 0))).all(axis=1)
+    if small.all() or not small.any():
+      return multipolygon
+    self.stats.count("polygons_left_out_early", int(small.sum()))
+    return shapely.geometry.MultiPolygon([ geom for geom, s in zip(multipolygon.geoms, small.tolist()) if not s ])
+  
+  @staticmethod
+  def _path_rings(polygons):
+    """The rings of polygons (as from multipolygon_as_arrays) that go in
+    a path, without the last point of each, which repeats the first.
+    Rings that are only one point after that are left out.
+    """
+    return [ ring[:-1] for rings in polygons for ring in rings if len(ring) > 2 ]
   
+  def _format_coords(self, coords):
+    """Format the numbers in an array of coordinates, returning a string
+    of them separated by spaces.
+    """
+    values = coords.ravel().tolist()
+    return " ".join(( "%.{d}f".format(d=self.options.decimal_digits), ) * len(values)) % tuple(values)
+  
+  def multipolygon_as_svg(self, region):
     return dict((
-      (k, " ".join(path_arr))
-      for k, path_arr in path_arrs.items()
+      (k, " ".join([
+        "M " + self._format_coords(ring[:1]) + " L " + self._format_coords(ring[1:]) + " Z"
+        for ring in self._path_rings(polygons)
+      ]))
+      for k, polygons in self.multipolygon_as_arrays(region).items()
     ))
-
+  
+  def multipolygon_as_actionscript(self, region):
+    """The SVG path of region for every key, as a list of the commands
+    and numbers in it. The numbers are integers if --decimal-digits is 0,
+    and otherwise strings.
+    """
+    paths = {}
+    for k, polygons in self.multipolygon_as_arrays(region).items():
+      path = []
+      for ring in self._path_rings(polygons):
+        if self.options.decimal_digits == 0:
+          numbers = ring.astype(numpy.int64).ravel().tolist()
+        else:
+          numbers = self._format_coords(ring).split(" ")
+        path += [ "M" ] + numbers[:2] + [ "L" ] + numbers[2:] + [ "Z" ]
+      # An empty path has always been written as [""]
+      paths[k] = path or [ "" ]
+    return paths
+  
+  def path_levels(self, region):
+    """For --levels, the level index of each point of the SVG paths of
+    region, as a list with a list of them for each ring in the path.
+    The path for level i is made of the points whose index is at least i.
+    """
+    return [
+      ring.levels[:-1].tolist()
+      for g in region.geoms for ring in [ g.exterior ] + list(g.interiors)
+      if len(ring.coords) > 2
+    ]
+  
+  def coords_levels(self, region):
+    """For --levels, the level index of each point of the GeoJSON
+    coordinates of region, as from multipolygon_as_coords.
+    """
+    return [
+      [ ring.levels.tolist() for ring in [ g.exterior ] + list(g.interiors) if len(ring.coords) >= 4 ]
+      for g in region.geoms
+      if len(g.exterior.coords) >= 4
+    ]
+  
   def multipolygon_as_coords(self, region):
-    coords_arrs = dict((
-      (k, []) for k in self.interpolators.keys()
+    """The coordinates of region for every key, as GeoJSON MultiPolygon
+    coordinates. Degenerate rings are left out, along with any polygon
+    whose exterior is degenerate. (The first point of each ring is repeated
+    at the end, so a ring needs at least four points.)
+    """
+    return dict((
+      (k, [
+        [ ring.tolist() for ring in rings if len(ring) >= 4 ]
+        for rings in polygons
+        if len(rings[0]) >= 4
+      ])
+      for k, polygons in self.multipolygon_as_arrays(region, transform=False).items()
     ))
-    for i, g in enumerate(region.geoms):
-      self.polygon_ring_as_coords(g.exterior, coords_arrs, i, 0)
-      for j, interior in enumerate(g.interiors):
-        self.polygon_ring_as_coords(interior, coords_arrs, i, j+1)
-    
-    # Exclude degenerate polygons
-    for k in self.interpolators.keys():
-      coords_arrs[k] = [
-        [ polygon[0] ] + [
-          inner_ring
-          for inner_ring in polygon[1:]
-          if len(inner_ring) > 0
-        ]
-        for polygon in coords_arrs[k]
-        if len(polygon[0]) > 0
-      ]
-    
-    return coords_arrs
-
-  def polygon_ring_as_coords(self, ring, coords_arrs, i, j):
-    for k, coords_arr in coords_arrs.items():
-      interpolator = self.interpolators.get(k)
-
-      if len(coords_arr) == i:
-        coords_arr.append([])
-      elif len(coords_arr) < i+1:
-        raise Exception("Can't access element %d of %r" % (i, coords_arr))
-    
-      if len(coords_arr[i]) == j:
-        coords_arr[i].append([])
-      elif len(coords_arr[i]) < j+1:
-        raise Exception("Can't access element %d of %r" % (j, coords_arr[i]))
-
-      for x, y in interpolator.map(ring.coords) if interpolator else ring.coords:
-        coords_arr[i][j].append([
-          float("%.*f" % (self.options.decimal_digits, x)),
-          float("%.*f" % (self.options.decimal_digits, y)),
-        ])
-      # Degenerate polygons should be suppressed. (Note that the first point is repeated at the end.)
-      if len(coords_arr[i][j]) < 4:
-        coords_arr[i][j] = []
 
   def print_json(self):
-    self.print_region_paths()
+    if self.options.add_carts:
+      self.add_region_paths()
+    else:
+      self.print_region_paths()
 
 def main():
   global options
@@ -462,19 +1971,46 @@ def main():
                     action="store",
                     help="A JSON-encoded dict of region name => simplification")
   
+  parser.add_option("", "--max-vertices",
+                    action="store", type="int",
+                    help="choose the simplification that keeps at most this many points in all, instead of using --simplification")
+  parser.add_option("", "--min-region-vertices",
+                    action="store", default=0, type="int",
+                    help="with --max-vertices, simplify each region less if need be to keep at least this many of its points (default %default)")
+  
+  parser.add_option("", "--levels",
+                    action="store",
+                    help="simplify for several levels of detail at once: a comma-separated list of simplifications, output as the paths for the finest along with the coarsest level that keeps each point (js, geojson and bundle formats only)")
+  
   parser.add_option("", "--segmentize",
                     action="store", default=None, type="float",
                     help="max length of path segments (default is not to segment at all)")
+  parser.add_option("", "--densify-tolerance",
+                    action="store", default=None, type="float",
+                    help="add points along edges where the carts would bend them by more than this many output units (pixels, with --output-grid), so they come out curved (default is not to)")
+  
+  parser.add_option("", "--min-feature-extent",
+                    action="store", default=None, type="float",
+                    help="leave out rings whose width and height in the output are both less than this many output units (pixels, with --output-grid), separately for each cart (default is to keep them all)")
+  parser.add_option("", "--min-feature-area",
+                    action="store", default=None, type="float",
+                    help="leave out rings whose area in the output is less than this many square output units, separately for each cart (default is to keep them all)")
   
   parser.add_option("", "--exclude-regions",
                     action="store",
                     help="Regions to exclude. Space-separated (shell-quoted)")
+  parser.add_option("", "--region",
+                    action="store",
+                    help="output just the specified region")
+  parser.add_option("", "--bbox",
+                    action="store",
+                    help="output just the regions that intersect this bounding box, in map coordinates: <x_min>,<y_min>,<x_max>,<y_max>")
 
   parser.add_option("", "--format",
                     action="store",
                     default="js",
-                    choices=["js", "actionscript", "geojson"],
-                    help="output format: js, actionscript or geojson (default %default).")
+                    choices=["js", "actionscript", "geojson", "binary", "topojson", "bundle"],
+                    help="output format: js, actionscript, geojson, binary, topojson or bundle (default %default).")
   parser.add_option("", "--data-var",
                     action="store",
                     default="data",
@@ -520,9 +2056,41 @@ def main():
                     action="store",
                     help="acts like --load-regions if the file exists, or like --dump-regions if it doesn't")
   
+  # A region cache file records what each region's simplification depends on,
+  # so only the regions that have changed need to be simplified again.
+  parser.add_option("", "--region-cache",
+                    action="store",
+                    help="name of a region cache file: regions in it that are unchanged are reused, and it is updated with the rest")
+  
+  parser.add_option("", "--add-carts",
+                    action="store_true", default=False,
+                    help="add paths for the carts to the existing output file (-o), using the regions it was made from (--load-regions)")
+  
+  parser.add_option("-v", "--verbose",
+                    action="store_true", default=False,
+                    help="print a progress message for each region")
+  
+  parser.add_option("", "--stats",
+                    action="store", metavar="FILE",
+                    help="write a JSON summary of the wall and CPU time spent in each stage, the vertices read and written for each key and the bytes written, to FILE")
+  parser.add_option("", "--region-stats",
+                    action="store", metavar="FILE",
+                    help="write the times and vertices of each region to FILE, as a line of JSON per region")
+  
+  parser.add_option("-j", "--jobs",
+                    action="store", type="int", default=1,
+                    help="number of processes to simplify and interpolate regions in (default %default)")
+  
+  parser.add_option("", "--fetch-size",
+                    action="store", type="int", default=100,
+                    help="number of regions to fetch from the database at a time (default %default)")
+  parser.add_option("", "--prefetch",
+                    action="store", type="int", default=100,
+                    help="number of regions to fetch ahead of the ones being processed (default %default)")
+  
   parser.add_option("-o", "--output",
                     action="store",
-                    help="the name of the output file (defaults to stdout)")
+                    help="the name of the output file (defaults to stdout). For geojson, a pattern where %s is replaced by the key, and the files are gzipped if it ends with .gz")
   
   (options, carts) = parser.parse_args()
   
@@ -543,6 +2111,77 @@ def main():
     else:
       options.dump_regions = options.dump_or_load_regions
   
+  if options.region_cache:
+    if options.dump_regions or options.load_regions:
+      parser.error("Cannot use --region-cache with --dump-regions or --load-regions")
+    if options.region or options.bbox:
+      parser.error("Cannot use --region-cache with --region or --bbox, since the cache would only hold some of the regions")
+  
+  if options.format == "binary" and not options.output:
+    parser.error("--format=binary needs an output file, with -o")
+  if options.format == "bundle" and not options.output:
+    parser.error("--format=bundle needs an output directory, with -o")
+  
+  if options.add_carts:
+    if options.format in ("binary", "topojson", "bundle"):
+      parser.error("--add-carts does not support --format=" + options.format)
+    if not options.load_regions:
+      parser.error("--add-carts needs the regions the output was made from, with --load-regions")
+    if not options.output:
+      parser.error("--add-carts needs the output file to add to, with -o")
+    if not carts:
+      parser.error("--add-carts needs at least one cart to add")
+  
+  if options.levels:
+    try:
+      options.levels = sorted(set(map(int, options.levels.split(","))))
+    except ValueError:
+      parser.error("Unrecognised value for --levels: expected a comma-separated list of simplifications")
+    if options.format not in ("js", "geojson", "bundle"):
+      parser.error("--levels does not support --format=" + options.format)
+    if options.segmentize or options.densify_tolerance:
+      parser.error("Cannot use --levels with --segmentize or --densify-tolerance, since the points added to each level would not be in the others")
+    if options.dump_regions or options.load_regions or options.region_cache or options.add_carts:
+      parser.error("Cannot use --levels with --dump-regions, --load-regions, --region-cache or --add-carts")
+  
+  if options.max_vertices is not None:
+    if options.max_vertices < 1 or options.min_region_vertices < 0:
+      parser.error("--max-vertices must be at least 1, and --min-region-vertices at least 0")
+    if options.simplification_json or options.levels:
+      parser.error("Cannot use --max-vertices with --simplification-json or --levels, since it chooses the simplifications itself")
+    if options.segmentize or options.densify_tolerance:
+      parser.error("Cannot use --max-vertices with --segmentize or --densify-tolerance, since the points they add are not counted")
+    if options.load_regions or options.add_carts:
+      parser.error("Cannot use --max-vertices with --load-regions or --add-carts: the loaded regions are already simplified")
+  elif options.min_region_vertices:
+    parser.error("--min-region-vertices only applies with --max-vertices")
+  
+  if options.densify_tolerance is not None and options.densify_tolerance <= 0:
+    parser.error("--densify-tolerance must be greater than 0")
+  
+  if options.min_feature_extent or options.min_feature_area:
+    if options.format not in ("js", "actionscript", "geojson", "bundle"):
+      parser.error("--min-feature-extent and --min-feature-area do not support --format=" + options.format)
+    if options.levels:
+      parser.error("Cannot use --min-feature-extent or --min-feature-area with --levels, since the rings left out differ from one cart to another")
+  
+  if options.jobs < 1:
+    parser.error("--jobs must be at least 1")
+  if options.fetch_size < 1 or options.prefetch < 1:
+    parser.error("--fetch-size and --prefetch must be at least 1")
+  
+  if options.region and options.bbox:
+    parser.error("Cannot specify both --region and --bbox")
+  if options.bbox:
+    try:
+      options.bbox = tuple(map(float, options.bbox.split(",")))
+    except ValueError:
+      options.bbox = ()
+    if len(options.bbox) != 4:
+      parser.error("Unrecognised value for --bbox: expected <x_min>,<y_min>,<x_max>,<y_max>")
+  if (options.region or options.bbox) and options.load_regions:
+    parser.error("Cannot use --region or --bbox with --load-regions: the loaded regions are used as they are")
+  
   if options.output_grid:
     mo = re.match(r"^(\d+)x(\d+)$", options.output_grid)
     if mo is None:
@@ -552,5 +2191,7 @@ def main():
   
   as_json = AsJSON(options=options, carts=carts)
   as_json.print_json()
+  as_json.write_stats()
 
-main()
+if __name__ == "__main__":
+  main()
@@ -10,19 +10,14 @@ import sys
 import cairo
 import PIL.Image, PIL.ImageDraw
 import shapely.geometry, shapely.wkb
-import psycopg2
 
 import utils
 
 class AsPNG(object):
     def __init__(self, options):
         self.options = options
-        self.db = self.db_connect()
+        self.db = utils.db_connect(options)
         self.m = utils.Map(self.db, options.map)
-        if options.cart:
-            self.interpolator = utils.Interpolator(options.cart, self.m)
-        else:
-            self.interpolator = None
         
         if options.output:
             self.out = options.output
@@ -40,8 +35,7 @@ class AsPNG(object):
             self.srid = self.m.srid
         
         if options.region:
-            region_name, p, has_data = self.region_paths().next()
-            self.x_min, self.y_min, self.x_max, self.y_max = p.bounds
+            self.x_min, self.y_min, self.x_max, self.y_max = self.region_bounds(options.region)
         else:
             # TODO if --srid is specified then this is wrong
             self.x_min = self.m.x_min
@@ -49,6 +43,15 @@ class AsPNG(object):
             self.y_min = self.m.y_min
             self.y_max = self.m.y_max
         
+        if options.cart and options.region:
+            # Only load the part of the grid we need
+            self.interpolator = utils.Interpolator(options.cart, self.m,
+                bbox=(self.x_min, self.y_min, self.x_max, self.y_max))
+        elif options.cart:
+            self.interpolator = utils.Interpolator(options.cart, self.m)
+        else:
+            self.interpolator = None
+        
         aspect_ratio = (self.x_max - self.x_min) / (self.y_max - self.y_min)
         
         # If width and height are both specified, use them
@@ -85,17 +88,6 @@ class AsPNG(object):
             self.output_width = self.m.width
             self.output_height = self.m.height
     
-    def db_connect(self):
-        options = self.options
-        db_connection_data = []
-        if options.db_host:
-            db_connection_data.append("host=" + options.db_host)
-        if options.db_name:
-            db_connection_data.append(" dbname=" + options.db_name)
-        if options.db_user:
-            db_connection_data.append(" user=" + options.db_user)
-        return psycopg2.connect(" ".join(db_connection_data))
-    
     def _parse_colour(self, colour_string):
         if colour_string == "None":
             return None
@@ -109,51 +101,72 @@ class AsPNG(object):
             fill_colour = self.fill_colour if has_data else self.fill_colour_no_data
             self.render_multipolygon(p, fill_colour, slide)
     
-    def region_paths(self):
+    def region_bounds(self, region_name):
+        """The bounds of the named region, simplified as region_paths does."""
         c = self.db.cursor()
-        try:
-            params = {
-                "srid": self.srid,
-                "simplification": self.options.simplification,
-                "dataset_name": self.options.dataset,
-                "division_id": self.m.division_id,
-            }
-            if self.options.dataset:
-                sql = """
-                    select region.name
-                             , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), %(simplification)s)) g
-                             , exists(
-                                    select *
-                                    from data_value
-                                    join dataset on data_value.dataset_id = dataset.id
-                                    where dataset.name = %(dataset_name)s
-                                    and data_value.region_id = region.id) has_data
-                    from region
-                    where region.division_id = %(division_id)s
-                """
-            else:
-                sql = """
-                    select region.name
-                             , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), %(simplification)s)) g
-                             , true
-                    from region
-                    where region.division_id = %(division_id)s
-                """
-            
-            if self.options.region:
-                sql += "and region.name = %(region_name)s"
-                params["region_name"] = self.options.region
-            
-            c.execute(sql, params)
-            
-            for region_name, g, has_data in c:
-                p = shapely.wkb.loads(str(g))
-                if self.options.omit_small_islands:
-                    p = self.omit_small_islands(p)
-                yield region_name, p, has_data
-                
-        finally:
-            c.close()
+        c.execute("""
+            select ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), %(simplification)s))
+            from region
+            where region.division_id = %(division_id)s
+            and region.name = %(region_name)s
+        """, {
+            "srid": self.srid,
+            "simplification": self.options.simplification,
+            "division_id": self.m.division_id,
+            "region_name": region_name,
+        })
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            raise Exception("No such region: " + region_name)
+        
+        p = shapely.wkb.loads(str(row[0]))
+        if self.options.omit_small_islands:
+            p = self.omit_small_islands(p)
+        return p.bounds
+    
+    def region_paths(self):
+        params = {
+            "srid": self.srid,
+            "simplification": self.options.simplification,
+            "dataset_name": self.options.dataset,
+            "division_id": self.m.division_id,
+        }
+        if self.options.dataset:
+            sql = """
+                select region.name
+                         , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), %(simplification)s)) g
+                         , exists(
+                                select *
+                                from data_value
+                                join dataset on data_value.dataset_id = dataset.id
+                                where dataset.name = %(dataset_name)s
+                                and data_value.region_id = region.id) has_data
+                from region
+                where region.division_id = %(division_id)s
+            """
+        else:
+            sql = """
+                select region.name
+                         , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), %(simplification)s)) g
+                         , true
+                from region
+                where region.division_id = %(division_id)s
+            """
+        
+        if self.options.region:
+            sql += "and region.name = %(region_name)s"
+            params["region_name"] = self.options.region
+        
+        rows = utils.prefetch(
+            utils.stream_rows(self.db, sql, params, self.options.fetch_size),
+            self.options.prefetch)
+        
+        for region_name, g, has_data in rows:
+            p = shapely.wkb.loads(str(g))
+            if self.options.omit_small_islands:
+                p = self.omit_small_islands(p)
+            yield region_name, p, has_data
     
     def omit_small_islands(self, multipolygon):
         max_area = max([ polygon.area for polygon in multipolygon.geoms ])
@@ -170,10 +183,12 @@ class AsPNG(object):
         if fill_colour is None:
             fill_colour = self.fill_colour
         
+        coords = ring.coords
+        if self.interpolator:
+            coords = self.interpolator.map(coords, slide)
+        
         first = True
-        for x, y in ring.coords:
-            if self.interpolator:
-                x, y = self.interpolator(x, y, slide)
+        for x, y in coords:
             if first:
                 self.c.move_to(x, y)
                 first = False
@@ -195,15 +210,15 @@ class AsPNG(object):
     def render_polygon_ring_pil(self, ring, fill_colour=None, slide=1.0):
         if fill_colour is None:
             fill_colour = self.fill_colour
-        polygon_coords = []
-        for x, y in ring.coords:
-            if self.interpolator:
-                x, y = self.interpolator(x, y, slide)
-            polygon_coords.append((
-                (x - self.x_min) * self.output_width / (self.x_max - self.x_min),
-                self.output_height - (y - self.y_min) * self.output_height / (self.y_max - self.y_min),
-            ))
-            
+        if self.interpolator:
+            coords = self.interpolator.map_array(ring.coords, slide)
+        else:
+            coords = utils.as_coords_array(ring.coords)
+        
+        xs = (coords[:,0] - self.x_min) * self.output_width / (self.x_max - self.x_min)
+        ys = self.output_height - (coords[:,1] - self.y_min) * self.output_height / (self.y_max - self.y_min)
+        polygon_coords = zip(xs.tolist(), ys.tolist())
+        
         self.draw.polygon(polygon_coords, outline=self.stroke_colour, fill=fill_colour)
 
     def render_polygon_ring(self, *args, **kwargs):
@@ -233,9 +248,10 @@ class AsPNG(object):
         
         r,g,b = self.circle_fill_colour
         self.c.set_source_rgba(r,g,b, self.options.circle_opacity)
-        for x, y in c:
-                if self.interpolator:
-                    x, y = self.interpolator(x, y, slide)
+        points = c.fetchall()
+        if self.interpolator:
+            points = self.interpolator.map(points, slide)
+        for x, y in points:
                 self.c.arc(x, y, self.options.circle_radius, 0, 2*math.pi)
                 self.c.fill()
         c.close()
@@ -405,6 +421,12 @@ def main():
     parser.add_option("", "--exclude-region",
                       action="append", dest="exclude_regions", default=[],
                       help="name of region to exclude. Can be used more than once")
+    parser.add_option("", "--fetch-size",
+                      action="store", type="int", default=100,
+                      help="number of regions to fetch from the database at a time (default %default)")
+    parser.add_option("", "--prefetch",
+                      action="store", type="int", default=100,
+                      help="number of regions to fetch ahead of the ones being drawn (default %default)")
     
     (options, args) = parser.parse_args()
     if args:
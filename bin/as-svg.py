@@ -6,15 +6,17 @@ import re
 import shlex
 import sys
 
+import numpy
 import shapely.wkb
 import psycopg2
 
+import dpranks
 import utils
 
 class AsSVG(object):
   def __init__(self, options):
     self.options = options
-    self.db = self.db_connect()
+    self.db = utils.db_connect(options)
     self.m = utils.Map(self.db, options.map)
     
     if options.srid:
@@ -23,8 +25,7 @@ class AsSVG(object):
       self.srid = self.m.srid
     
     if options.region:
-      region_name, p, has_data = self.region_paths().next()
-      self.x_min, self.y_min, self.x_max, self.y_max = p.bounds
+      self.x_min, self.y_min, self.x_max, self.y_max = self.region_bounds(options.region)
     else:
       # TODO if --srid is specified then this is wrong
       self.x_min = self.m.x_min
@@ -33,7 +34,11 @@ class AsSVG(object):
       self.y_max = self.m.y_max
     
     self.init_output_grid()
-    if options.cart:
+    if options.cart and options.region:
+      # Only load the part of the grid we need
+      self.f = utils.Interpolator(options.cart, self.m,
+        bbox=(self.x_min, self.y_min, self.x_max, self.y_max))
+    elif options.cart:
       self.f = utils.Interpolator(options.cart, self.m)
     else:
       self.f = None
@@ -47,18 +52,10 @@ class AsSVG(object):
       self.exclude_regions = set(shlex.split(options.exclude_regions))
     else:
       self.exclude_regions = set()
+    
+    if options.max_vertices is not None:
+      self.fit_vertex_budget()
 
-  def db_connect(self):
-    options = self.options
-    db_connection_data = []
-    if options.db_host:
-      db_connection_data.append("host=" + options.db_host)
-    if options.db_name:
-      db_connection_data.append(" dbname=" + options.db_name)
-    if options.db_user:
-      db_connection_data.append(" user=" + options.db_user)
-    return psycopg2.connect(" ".join(db_connection_data))
-  
   def init_output_grid(self):
       aspect_ratio = (self.x_max - self.x_min) / (self.y_max - self.y_min)
     
@@ -131,6 +128,32 @@ class AsSVG(object):
     else:
       return q(self.options.simplification)
   
+  def fit_vertex_budget(self):
+    """For --max-vertices, choose the simplification, and a larger one
+    for any region that needs it to keep --min-region-vertices, by ranking
+    the points of the unsimplified regions. (ST_Simplify is also
+    Douglas-Peucker, ring by ring, but may drop rings that collapse, so
+    the number of points is an upper bound.)
+    """
+    region_ranks = {}
+    for region_name, p, has_data in self.region_paths(simplified=False):
+      ranks = []
+      for polygon in p.geoms:
+        for ring in [ polygon.exterior ] + list(polygon.interiors):
+          # The ends of a ring are the same point, so only count it once
+          ranks.append(dpranks.ranks(utils.as_coords_array(ring.coords))[:-1])
+      region_ranks[region_name] = numpy.concatenate(ranks) if ranks else numpy.zeros(0)
+    
+    simplification, self.simplification_dict, n_vertices = dpranks.fit_budget(
+      region_ranks, self.options.max_vertices, self.options.min_region_vertices)
+    if n_vertices > self.options.max_vertices:
+      print >>sys.stderr, "Warning: cannot simplify to {max_vertices} points: --min-region-vertices needs {n_vertices}".format(
+        max_vertices=self.options.max_vertices, n_vertices=n_vertices)
+    print >>sys.stderr, "Simplifying to at most {n_vertices} points with simplification {simplification!r}{by_region}".format(
+      n_vertices=n_vertices, simplification=simplification,
+      by_region=", and by region " + json.dumps(self.simplification_dict, sort_keys=True) if self.simplification_dict else "")
+    self.options.simplification = simplification
+  
   def _transform(self, x, y):
     if not self.output_width:
       return x, -y
@@ -139,72 +162,97 @@ class AsSVG(object):
       self.output_height - (y - self.y_min) * self.output_height / (self.y_max - self.y_min),
     )
   
-  def region_paths(self):
+  def region_bounds(self, region_name):
+    """The bounds of the named region, simplified as region_paths does."""
     c = self.db.cursor()
-    try:
-      if self.options.dataset:
-        sql = """
-          select region.name
-               , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), {simplification})) g
-               , exists(
-                  select *
-                  from data_value
-                  join dataset on data_value.dataset_id = dataset.id
-                  where dataset.name = %(dataset)s
-                  and data_value.region_id = region.id) has_data
-          from region
-          where region.division_id = %(division_id)s
-        """
-      else:
-        sql = """
-          select region.name
-               , ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), {simplification})) g
-               , false
-          from region
-          where region.division_id = %(division_id)s
-        """
-      
-      params = {
-          "srid": self.srid,
-          "simplification": self.options.simplification,
-          "division_id": self.m.division_id
-      }
-      
-      if hasattr(self, "x_min"):
-        sql += """  and ST_Intersects(
-            ST_Transform(region.the_geom, %(srid)s),
-            ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s)
-          )
-        """
-        
-        params.update({
-          "xmin": self.x_min,
-          "ymin": self.y_min,
-          "xmax": self.x_max,
-          "ymax": self.y_max,
-        })
-      
-      sql = sql.format(simplification=self._simplification())
-      
-      if self.options.dataset:
-        params["dataset"] = self.options.dataset
-      
-      if self.options.region:
-        sql += "and region.name = %(region_name)s"
-        params["region_name"] = self.options.region
-      
-      c.execute(sql, params)
+    c.execute("""
+      select ST_AsEWKB(ST_Simplify(ST_Transform(region.the_geom, %(srid)s), {simplification}))
+      from region
+      where region.division_id = %(division_id)s
+      and region.name = %(region_name)s
+    """.format(simplification=self._simplification()), {
+      "srid": self.srid,
+      "division_id": self.m.division_id,
+      "region_name": region_name,
+    })
+    row = c.fetchone()
+    c.close()
+    if row is None:
+      raise Exception("No such region: " + region_name)
+    
+    p = shapely.wkb.loads(str(row[0]))
+    if self.options.omit_small_islands:
+      p = self.omit_small_islands(p, self.options.small_island_threshold)
+    return p.bounds
+  
+  def region_paths(self, simplified=True):
+    if simplified:
+      geom = "ST_Simplify(ST_Transform(region.the_geom, %(srid)s), {simplification})"
+    else:
+      geom = "ST_Transform(region.the_geom, %(srid)s)"
+    
+    if self.options.dataset:
+      sql = """
+        select region.name
+             , ST_AsEWKB({geom}) g
+             , exists(
+                select *
+                from data_value
+                join dataset on data_value.dataset_id = dataset.id
+                where dataset.name = %(dataset)s
+                and data_value.region_id = region.id) has_data
+        from region
+        where region.division_id = %(division_id)s
+      """
+    else:
+      sql = """
+        select region.name
+             , ST_AsEWKB({geom}) g
+             , false
+        from region
+        where region.division_id = %(division_id)s
+      """
+    
+    params = {
+        "srid": self.srid,
+        "simplification": self.options.simplification,
+        "division_id": self.m.division_id
+    }
+    
+    if hasattr(self, "x_min"):
+      sql += """  and ST_Intersects(
+          ST_Transform(region.the_geom, %(srid)s),
+          ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s)
+        )
+      """
       
-      for region_name, g, has_data in c.fetchall():
-        if hasattr(self, "exclude_regions") and region_name in self.exclude_regions:
-          continue
-        p = shapely.wkb.loads(str(g))
-        if self.options.omit_small_islands:
-          p = self.omit_small_islands(p, self.options.small_island_threshold)
-        yield region_name, p, has_data
+      params.update({
+        "xmin": self.x_min,
+        "ymin": self.y_min,
+        "xmax": self.x_max,
+        "ymax": self.y_max,
+      })
     
-    finally:
-      c.close()
+    sql = sql.format(geom=geom.format(simplification=self._simplification()) if simplified else geom)
+    
+    if self.options.dataset:
+      params["dataset"] = self.options.dataset
+    
+    if self.options.region:
+      sql += "and region.name = %(region_name)s"
+      params["region_name"] = self.options.region
+    
+    rows = utils.prefetch(
+      utils.stream_rows(self.db, sql, params, self.options.fetch_size),
+      self.options.prefetch)
+    
+    for region_name, g, has_data in rows:
+      if hasattr(self, "exclude_regions") and region_name in self.exclude_regions:
+        continue
+      p = shapely.wkb.loads(str(g))
+      if self.options.omit_small_islands:
+        p = self.omit_small_islands(p, self.options.small_island_threshold)
+      yield region_name, p, has_data
   
   def omit_small_islands(self, multipolygon, threshold):
     max_area = max([ polygon.area for polygon in multipolygon.geoms ])
@@ -250,9 +298,7 @@ class AsSVG(object):
   def polygon_ring_as_svg(self, ring, f):
       poly_arr = ["M"]
       first = True
-      for x, y in ring.coords:
-        if f:
-          x, y = f(x, y)
+      for x, y in f.map(ring.coords) if f else ring.coords:
         x, y = self._transform(x, y)
         poly_arr.append("%.*f" % (self.options.decimal_places, x))
         poly_arr.append("%.*f" % (self.options.decimal_places, y))
@@ -281,16 +327,16 @@ class AsSVG(object):
     with t as (select ST_Transform(location, %s) p from {table_name})
     select ST_X(t.p), ST_Y(t.p) from t
     """.format(table_name=self.options.circles), (self.srid,) )
+    points = c.fetchall()
+    transformed_points = self.f.map(points) if self.f else points
     if self.f is None:
-      for x, y in c:
+      for x, y in points:
         print >>self.out, '<circle cx="{x:.0f}" cy="{y:.0f}" r="{r}"/>'.format(x=x, y=-y, r=self.options.circle_radius)
     elif self.options.static:
-      for x, y in c:
-        tx, ty = self.f(x, y)
+      for tx, ty in transformed_points:
         print >>self.out, '<circle cx="{x:.0f}" cy="{y:.0f}" r="{r}"/>'.format(x=tx, y=-ty, r=self.options.circle_radius)
     else:
-      for x, y in c:
-        tx, ty = self.f(x, y)
+      for (x, y), (tx, ty) in zip(points, transformed_points):
         print >>self.out, '<circle cx="{x:.0f}" cy="{y:.0f}" r="{r}">'.format(x=x, y=-y, r=self.options.circle_radius)
         print >>self.out, '<animate dur="10s" repeatCount="indefinite" attributeName="cx" ' + \
                        'values="{x:.0f};{tx:.0f};{tx:.0f};{x:.0f};{x:.0f}"/>'.format(x=x, tx=tx)
@@ -397,6 +443,13 @@ def main():
                     action="store_true",
                     help="Output in JSON format")
   
+  parser.add_option("", "--fetch-size",
+                    action="store", type="int", default=100,
+                    help="number of regions to fetch from the database at a time (default %default)")
+  parser.add_option("", "--prefetch",
+                    action="store", type="int", default=100,
+                    help="number of regions to fetch ahead of the ones being output (default %default)")
+  
   parser.add_option("", "--simplification",
                     action="store", default=1000,
                     help="how much to simplify the paths (default %default)")
@@ -409,6 +462,12 @@ def main():
   parser.add_option("", "--simplification-json",
                     action="store",
                     help="A JSON-encoded dict of region name => simplification")
+  parser.add_option("", "--max-vertices",
+                    action="store", type="int",
+                    help="choose the simplification that keeps at most this many points in all, instead of using --simplification")
+  parser.add_option("", "--min-region-vertices",
+                    action="store", default=0, type="int",
+                    help="with --max-vertices, simplify each region less if need be to keep at least this many of its points (default %default)")
   parser.add_option("", "--exclude-regions",
                     action="store",
                     help="Regions to exclude. Space-separated (shell-quoted)")
@@ -497,6 +556,14 @@ def main():
     if options.robinson:
       parser.error("--robinson is not yet supported in JSON output mode")
   
+  if options.max_vertices is not None:
+    if options.max_vertices < 1 or options.min_region_vertices < 0:
+      parser.error("--max-vertices must be at least 1, and --min-region-vertices at least 0")
+    if options.simplification_json or options.alternate_simplification_regions:
+      parser.error("Cannot use --max-vertices with --simplification-json or --alternate-simplification-regions, since it chooses the simplifications itself")
+  elif options.min_region_vertices:
+    parser.error("--min-region-vertices only applies with --max-vertices")
+  
   if options.output_grid:
     if not re.match(r"^(\d+)x(\d+)$", options.output_grid):
       parser.error("Unrecognised value for --output-grid: " + options.output_grid)
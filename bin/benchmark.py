@@ -0,0 +1,561 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for the cartogram grid code.
+
+Each benchmark runs against a binary grid file (see cart-grid.py), or
+against a synthetic grid if none is given, so no database is needed:
+
+  benchmark.py interpolate --grid foo.grid
+  benchmark.py interpolate --size 1500x750 --points 100000
+  benchmark.py inverse --grid foo.grid
+  benchmark.py simplify --wkb region.hexwkb --grid foo.grid
+  benchmark.py borders --points 200000
+  benchmark.py levels --points 200000
+  benchmark.py regions --points 2000000
+  benchmark.py check-cart --size 1500x750
+
+The simplify benchmark runs as-js.py's MultipolygonSimplifier on a real
+region, given as hex EWKB, such as the output of
+
+  psql -At -c "select ST_AsHexEWKB(ST_Transform(the_geom, 954030)) from region where name = 'Norway'"
+
+or on a synthetic multipolygon if none is given. The borders benchmark
+simplifies a synthetic division of the map into regions, whose borders
+are shared by the regions either side of them, and reports how many
+simplified arcs are kept waiting for a neighbour. The levels benchmark
+compares simplifying for several levels of detail at once, as with
+as-js.py --levels, with simplifying for each of them separately. The
+regions benchmark measures the memory that simplified regions take, and
+how long they take to pickle (as --jobs does) and to write to and read
+from a region cache file (as --dump-regions and --load-regions do). The
+check-cart benchmark times check-cart.py's fold check on a grid file,
+memory-mapped as it would be after cart-grid.py, which needs to be well
+under a second for a 1500x750 map so that it can run after every cart.
+"""
+
+from __future__ import division
+
+import imp
+import math
+import optparse
+import os
+import re
+import resource
+import tempfile
+import time
+import cPickle as pickle
+
+import numpy
+from shapely.geometry import LineString, MultiPolygon, Polygon
+import shapely.wkb
+
+import gridfile
+import inverse
+import regioncache
+import utils
+
+def synthetic_grid(width, height, seed=0):
+  """A smooth, fold-free distortion of the padded grid for a width x height map.
+  """
+  header = gridfile.GridHeader(width, height, -17005833.0, 17005833.0, -8625154.0, 8625154.0)
+  ys, xs = numpy.mgrid[0:3*height+1, 0:3*width+1].astype(numpy.float64)
+  rng = numpy.random.RandomState(seed)
+  phase_x, phase_y = rng.uniform(0, 2*math.pi, 2)
+  amplitude = min(width, height) / 20
+  grid = numpy.dstack([
+    xs + amplitude * numpy.sin(2*math.pi * xs / (3*width) + phase_x) * numpy.sin(math.pi * ys / (3*height)),
+    ys + amplitude * numpy.sin(2*math.pi * ys / (3*height) + phase_y) * numpy.sin(math.pi * xs / (3*width)),
+  ])
+  return header, grid
+
+class GridInterpolator(utils.Interpolator):
+  """An Interpolator for a grid that is already in memory.
+  """
+  def __init__(self, grid, the_map):
+    self.m = the_map
+    self.a = grid
+
+def random_points(m, n, seed=1):
+  rng = numpy.random.RandomState(seed)
+  return numpy.column_stack([
+    rng.uniform(m.x_min, m.x_max, n),
+    rng.uniform(m.y_min, m.y_max, n),
+  ])
+
+def resident_bytes():
+  """The resident memory of this process, or None where there is no
+  /proc to tell.
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except (IOError, OSError):
+    return None
+
+def timed(f, *args):
+  start = time.time()
+  result = f(*args)
+  return time.time() - start, result
+
+def report(name, n, seconds):
+  print "{name:<32} {n:>10d} points {seconds:>9.4f}s {rate:>14,.0f} points/s".format(
+    name=name, n=n, seconds=seconds, rate=n / seconds if seconds else float("inf"))
+
+
+# The code paths that the vectorised interpolator replaced,
+# kept here so that we can compare against them.
+
+def scalar_interpolate(a, m, rx, ry, slide=1.0):
+  x = (rx - m.x_min) * m.width  / (m.x_max - m.x_min) + m.width
+  y = (ry - m.y_min) * m.height / (m.y_max - m.y_min) + m.height
+  if x < 0 or x > 3 * m.width or y < 0 or y > 3 * m.height:
+    return rx, ry
+
+  ix, iy = int(x), int(y)
+  dx, dy = x - ix, y - iy
+
+  tx, ty = (1-dx)*(1-dy)*a[iy][ix] \
+         + dx*(1-dy)*a[iy][ix+1]   \
+         + (1-dx)*dy*a[iy+1][ix]   \
+         + dx*dy*a[iy+1][ix+1]
+
+  ix, iy = (
+    (tx - m.width)  * (m.x_max - m.x_min) / m.width  + m.x_min,
+    (ty - m.height) * (m.y_max - m.y_min) / m.height + m.y_min,
+  )
+  return (
+    (1.0 - slide) * rx + slide * ix,
+    (1.0 - slide) * ry + slide * iy,
+  )
+
+def splines(grid, m):
+  import scipy.interpolate
+  x_pts = (numpy.arange(3*m.width+1) - m.width) * (m.x_max - m.x_min) / m.width  + m.x_min
+  y_pts = (numpy.arange(3*m.height+1) - m.height) * (m.y_max - m.y_min) / m.height  + m.y_min
+  x_grid = (grid[:,:,0] - m.width) * (m.x_max - m.x_min) / m.width  + m.x_min
+  y_grid = (grid[:,:,1] - m.height) * (m.y_max - m.y_min) / m.height  + m.y_min
+  sx = scipy.interpolate.RectBivariateSpline(y_pts, x_pts, x_grid, kx=1, ky=1)
+  sy = scipy.interpolate.RectBivariateSpline(y_pts, x_pts, y_grid, kx=1, ky=1)
+  return sx, sy
+
+def spline_map(sx, sy, coords):
+  ys, xs = coords[:,1], coords[:,0]
+  return zip(sx.ev(ys, xs), sy.ev(ys, xs))
+
+def load_as_js():
+  return imp.load_source("as_js", os.path.join(os.path.dirname(os.path.abspath(__file__)), "as-js.py"))
+
+def load_check_cart():
+  return imp.load_source("check_cart", os.path.join(os.path.dirname(os.path.abspath(__file__)), "check-cart.py"))
+
+def scalar_simplifier_class(as_js):
+  """A MultipolygonSimplifier that uses the old per-point Python loops.
+  """
+  class ScalarSimplifier(as_js.MultipolygonSimplifier):
+    def simplify(self, region_name, multipolygon, breakpoints):
+      return [
+        as_js.SimplifiedGeom(
+          exterior=self._simplify(region_name, geom.exterior, breakpoints),
+          interiors=[
+            self._simplify(region_name, interior, breakpoints)
+            for interior in geom.interiors
+          ]
+        )
+        for geom in multipolygon.geoms
+      ]
+    
+    def _simplify(self, region_name, ring, breakpoints):
+      simplification = self.simplification_dict.get(region_name, self.simplification)
+      
+      prev = None
+      ret = []
+      for segment in self._scalar_segments(ring.coords, breakpoints):
+        max_stretch = self._scalar_max_stretch(segment)
+        ls = LineString(segment).simplify(tolerance=simplification / max_stretch, preserve_topology=False)
+        max_segment_length = None if self.max_segment_length is None else self.max_segment_length / max_stretch
+        
+        for coord in ls.coords:
+          if coord != prev:
+            
+            if max_segment_length and prev:
+              d = self._distance(prev, coord)
+              if d > max_segment_length:
+                fraction = max_segment_length / d
+                dx, dy = (coord[0]-prev[0])*fraction, (coord[1]-prev[1])*fraction
+                while d > max_segment_length:
+                  prev = (prev[0] + dx, prev[1] + dy)
+                  ret.append(prev)
+                  d -= max_segment_length
+            
+            ret.append(coord)
+          
+          prev = coord
+      
+      return as_js.SimplifiedPolygonRing(ret)
+    
+    def _scalar_segments(self, coords, breakpoints):
+      segments = [[]]
+      for coord in coords:
+        segments[-1].append(coord)
+        if coord in breakpoints:
+          segments.append([coord])
+      
+      if len(segments) > 1:
+        segments[0] = segments.pop() + segments[0]
+      
+      return segments
+    
+    def _scalar_segment_length(self, segment):
+      return sum([
+        self._distance(p1, p2)
+        for p1, p2 in zip(segment, segment[1:])
+      ])
+    
+    def _distance(self, (x1,y1), (x2,y2)):
+      return math.sqrt((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))
+    
+    def _scalar_max_stretch(self, segment):
+      l = self._scalar_segment_length(segment)
+      if l == 0 or not self.interpolator:
+        return 1
+      
+      max_stretch = max([
+        self._scalar_segment_length(cart_segment)
+        for cart_segment in self.interpolator.map_array(segment).tolist()
+      ])
+      
+      if max_stretch > l:
+        return max_stretch / l
+      else:
+        return 1
+  
+  return ScalarSimplifier
+
+def synthetic_multipolygon(m, n_points, seed=2):
+  """A multipolygon with n_points points in all, made of wiggly rings
+  spread over the map, and breakpoints every hundred or so points.
+  """
+  rng = numpy.random.RandomState(seed)
+  polygons, breakpoints = [], set()
+  n_rings = max(1, n_points // 20000)
+  radius = min(m.x_max - m.x_min, m.y_max - m.y_min) / (4 * math.sqrt(n_rings))
+  for i in range(n_rings):
+    cx = rng.uniform(m.x_min + radius, m.x_max - radius)
+    cy = rng.uniform(m.y_min + radius, m.y_max - radius)
+    t = numpy.linspace(0, 2*math.pi, n_points // n_rings, endpoint=False)
+    r = radius * (1 + 0.1 * numpy.sin(7*t) + 0.02 * rng.standard_normal(len(t)))
+    ring = zip(cx + r * numpy.cos(t), cy + r * numpy.sin(t))
+    polygons.append(Polygon(ring))
+    breakpoints.update(ring[::rng.randint(50, 150)])
+  return MultiPolygon(polygons), breakpoints
+
+def synthetic_division(m, n_points, n_regions=64, seed=3):
+  """A division of the map into about n_regions square regions, with
+  n_points points in all along the wiggly borders between them, returned
+  as a list of (name, multipolygon, breakpoints). The breakpoints are the
+  corners, where the borders meet.
+  """
+  rng = numpy.random.RandomState(seed)
+  side = max(1, int(round(math.sqrt(n_regions))))
+  xs = numpy.linspace(m.x_min, m.x_max, side + 1)
+  ys = numpy.linspace(m.y_min, m.y_max, side + 1)
+  edge_points = max(2, n_points // (2 * side * (side + 1)))
+  wiggle = 0.05 * min(xs[1] - xs[0], ys[1] - ys[0])
+  
+  def edge(start, end, wiggly):
+    t = numpy.linspace(0, 1, edge_points)
+    points = numpy.outer(1 - t, start) + numpy.outer(t, end)
+    if wiggly:
+      normal = numpy.array([ start[1] - end[1], end[0] - start[0] ])
+      normal /= numpy.hypot(*normal)
+      offset = wiggle * numpy.sin(math.pi * t) * rng.standard_normal(len(t)).cumsum() / math.sqrt(len(t))
+      offset[[0, -1]] = 0
+      points += numpy.outer(offset, normal)
+    return [ tuple(p) for p in points ]
+  
+  # The border along the bottom and the left of each cell, from its
+  # bottom-left corner, wiggly unless it lies on the edge of the map
+  bottom, left = {}, {}
+  for i in range(side + 1):
+    for j in range(side + 1):
+      if i < side:
+        bottom[i, j] = edge((xs[i], ys[j]), (xs[i+1], ys[j]), 0 < j < side)
+      if j < side:
+        left[i, j] = edge((xs[i], ys[j]), (xs[i], ys[j+1]), 0 < i < side)
+  
+  regions = []
+  for i in range(side):
+    for j in range(side):
+      ring = bottom[i, j][:-1] + left[i+1, j][:-1] + bottom[i, j+1][::-1][:-1] + left[i, j][::-1]
+      corners = set([ (xs[i], ys[j]), (xs[i+1], ys[j]), (xs[i+1], ys[j+1]), (xs[i], ys[j+1]) ])
+      regions.append(("region %d,%d" % (i, j), MultiPolygon([ Polygon(ring) ]), corners))
+  return regions
+
+
+def benchmark_interpolate(m, grid, options):
+  n = options.points
+  coords = random_points(m, n)
+  interpolator = GridInterpolator(grid, m)
+
+  seconds, batch = timed(interpolator.map_array, coords)
+  report("Interpolator.map_array", n, seconds)
+
+  # Rings of a realistic size, one call per ring
+  rings = numpy.array_split(coords, max(1, n // options.ring_size))
+  seconds, _ = timed(lambda: [ interpolator.map_array(ring) for ring in rings ])
+  report("Interpolator.map_array (rings)", n, seconds)
+
+  n_scalar = min(n, options.scalar_points)
+  seconds, scalar = timed(lambda: [ scalar_interpolate(grid, m, x, y) for x, y in coords[:n_scalar] ])
+  report("per-point (old Interpolator)", n_scalar, seconds)
+  print "  max difference from per-point: %g" % (numpy.abs(batch[:n_scalar] - numpy.array(scalar)).max(),)
+
+  try:
+    import scipy
+  except ImportError:
+    print "  (scipy is not installed: skipping the spline comparison)"
+  else:
+    # The old FastInterpolator pickled its splines, so don't count building them
+    sx, sy = splines(grid, m)
+    seconds, splined = timed(spline_map, sx, sy, coords)
+    report("RectBivariateSpline (old Fast)", n, seconds)
+    print "  max difference from spline: %g" % (numpy.abs(batch - numpy.array(splined)).max(),)
+
+def benchmark_inverse(m, grid, options):
+  n = options.points
+  seconds, inverse_interpolator = timed(inverse.InverseInterpolator.for_grid, grid, m, options.bucket_size)
+  print "Built index of {cells:,} cells in {seconds:.3f}s ({entries:,} bucket entries)".format(
+    cells=(grid.shape[0]-1) * (grid.shape[1]-1), seconds=seconds, entries=len(inverse_interpolator.cells))
+
+  coords = random_points(m, n)
+  cart_coords = GridInterpolator(grid, m).map_array(coords)
+
+  seconds, (result, folded) = timed(inverse_interpolator.map_array, cart_coords)
+  report("InverseInterpolator.map_array", n, seconds)
+  unfolded = ~folded
+  print "  max round-trip error (unfolded points): %g" % (numpy.nanmax(numpy.abs(result[unfolded] - coords[unfolded])),)
+  print "  folded points: %d, points not found: %d" % (folded.sum(), numpy.isnan(result[:,0]).sum())
+
+def benchmark_simplify(m, grid, options):
+  as_js = load_as_js()
+  if options.wkb:
+    with open(options.wkb, 'r') as f:
+      multipolygon = shapely.wkb.loads(f.read().strip(), hex=True)
+    if multipolygon.geom_type == "Polygon":
+      multipolygon = MultiPolygon([multipolygon])
+    breakpoints = set()
+  else:
+    multipolygon, breakpoints = synthetic_multipolygon(m, options.points)
+  n = sum(len(g.exterior.coords) + sum(len(i.coords) for i in g.interiors) for g in multipolygon.geoms)
+  print "{polygons} polygons, {n:,} points, {breakpoints:,} breakpoints, {carts} carts".format(
+    polygons=len(multipolygon.geoms), n=n, breakpoints=len(breakpoints), carts=options.carts)
+  
+  interpolator = GridInterpolator(numpy.array([grid] * options.carts), m)
+  results = {}
+  for name, cls in (
+    ("MultipolygonSimplifier", as_js.MultipolygonSimplifier),
+    ("per-point (old Simplifier)", scalar_simplifier_class(as_js)),
+  ):
+    simplifier = cls({}, options.simplification, interpolator, options.segmentize)
+    seconds, results[name] = timed(simplifier.simplify, "benchmark", multipolygon, breakpoints)
+    report(name, n, seconds)
+  
+  rings = lambda geoms: [ ring.coords for g in geoms for ring in [g.exterior] + g.interiors ]
+  new, old = rings(results["MultipolygonSimplifier"]), rings(results["per-point (old Simplifier)"])
+  print "  simplified to {n:,} points ({old:,} with the old simplifier)".format(
+    n=sum(map(len, new)), old=sum(map(len, old)))
+  if map(len, new) == map(len, old):
+    print "  max difference from per-point: %g" % (max(
+      numpy.abs(numpy.array(a) - numpy.array(b)).max() for a, b in zip(new, old)),)
+
+def benchmark_borders(m, grid, options):
+  as_js = load_as_js()
+  regions = synthetic_division(m, options.points)
+  n = sum(len(multipolygon.geoms[0].exterior.coords) for name, multipolygon, breakpoints in regions)
+  print "{regions} regions, {n:,} points, {carts} carts".format(regions=len(regions), n=n, carts=options.carts)
+  
+  interpolator = GridInterpolator(numpy.array([grid] * options.carts), m)
+  results, most_kept = {}, {}
+  for name, share_arcs, expect in (
+    ("each border twice", False, False),
+    ("each border once", True, False),
+    ("each border once, expecting regions", True, True),
+  ):
+    simplifier = as_js.MultipolygonSimplifier({}, options.simplification, interpolator, options.segmentize, share_arcs=share_arcs)
+    if expect:
+      simplifier.expect_regions([ (region_name, breakpoints) for region_name, multipolygon, breakpoints in regions ])
+    def simplify_all():
+      result = []
+      most_kept[name] = 0
+      for region_name, multipolygon, breakpoints in regions:
+        result.append(simplifier.simplify(region_name, multipolygon, breakpoints))
+        most_kept[name] = max(most_kept[name], len(simplifier._arcs))
+      return result
+    seconds, results[name] = timed(simplify_all)
+    report(name, n, seconds)
+    print "  at most {kept} arcs kept at once, {left} left at the end".format(kept=most_kept[name], left=len(simplifier._arcs))
+  
+  points = lambda result: sum(len(geoms[0].exterior.coords) for geoms in result)
+  print "  simplified to {n:,} points ({old:,} simplifying each border twice)".format(
+    n=points(results["each border once"]), old=points(results["each border twice"]))
+  same = all(
+    numpy.array_equal(a.exterior.coords, b.exterior.coords)
+    for geoms_a, geoms_b in zip(results["each border once"], results["each border once, expecting regions"])
+    for a, b in zip(geoms_a, geoms_b)
+  )
+  if not same:
+    print "  (DIFFERENT when expecting regions)"
+
+def benchmark_levels(m, grid, options):
+  as_js = load_as_js()
+  multipolygon, breakpoints = synthetic_multipolygon(m, options.points)
+  n = sum(len(g.exterior.coords) for g in multipolygon.geoms)
+  levels = [ options.simplification * f for f in (1, 2, 5, 10) ]
+  print "{n:,} points, levels {levels}, {carts} carts".format(n=n, levels=levels, carts=options.carts)
+  
+  interpolator = GridInterpolator(numpy.array([grid] * options.carts), m)
+  def separately():
+    return [
+      as_js.MultipolygonSimplifier({}, level, interpolator, None).simplify("benchmark", multipolygon, breakpoints)
+      for level in levels
+    ]
+  seconds, separate = timed(separately)
+  report("each level separately", n, seconds)
+  
+  simplifier = as_js.MultipolygonSimplifier({}, options.simplification, interpolator, None, levels=levels)
+  seconds, together = timed(simplifier.simplify, "benchmark", multipolygon, breakpoints)
+  report("all levels at once", n, seconds)
+  
+  # Check that each level is the same as simplifying for it alone
+  for i, geoms in enumerate(separate):
+    same = all(
+      numpy.array_equal(numpy.array(a.exterior.coords), numpy.array(b.exterior.coords)[b.exterior.levels >= i])
+      for a, b in zip(geoms, together)
+    )
+    print "  level {level}: {n:,} points{same}".format(
+      level=levels[i], n=sum(len(g.exterior.coords) for g in geoms), same="" if same else " (DIFFERENT)")
+
+def benchmark_regions(m, grid, options):
+  as_js = load_as_js()
+  fd, filename = tempfile.mkstemp(suffix=".regions")
+  os.close(fd)
+  try:
+    # Write the regions to a region cache file from a child process, so
+    # that this one's memory is not taken up by making them
+    pid = os.fork()
+    if pid == 0:
+      writer = regioncache.RegionCacheWriter(filename)
+      for region_name, multipolygon, breakpoints in synthetic_division(m, options.points):
+        writer.add(region_name, None, [ [ polygon.exterior.coords ] for polygon in multipolygon.geoms ], sorted(breakpoints))
+      writer.commit()
+      os._exit(0)
+    os.waitpid(pid, 0)
+    
+    def load():
+      with regioncache.RegionCache(filename) as cache:
+        return [ as_js.SimplifiedMultipolygon.from_polygons(region_name, *cache.region(region_name)) for region_name in cache.names ]
+    rss = resident_bytes()
+    seconds, regions = timed(load)
+    n = sum(len(rings[0]) for region in regions for rings in region.polygons())
+    print "{regions} regions, {n:,} points".format(regions=len(regions), n=n)
+    report("load from region cache", n, seconds)
+    if rss is not None:
+      print "  resident memory grew by {mb:.1f} MB".format(mb=(resident_bytes() - rss) / 2**20)
+    
+    def dump():
+      writer = regioncache.RegionCacheWriter(filename)
+      for region in regions:
+        writer.add(region.region_name, None, region.polygons(), region.breakpoints)
+      writer.commit()
+    seconds, _ = timed(dump)
+    report("dump to region cache", n, seconds)
+  finally:
+    os.unlink(filename)
+  
+  seconds, pickled = timed(lambda: [ pickle.dumps(region, pickle.HIGHEST_PROTOCOL) for region in regions ])
+  report("pickle", n, seconds)
+  print "  {mb:.1f} MB pickled".format(mb=sum(map(len, pickled)) / 2**20)
+  seconds, _ = timed(lambda: map(pickle.loads, pickled))
+  report("unpickle", n, seconds)
+
+def benchmark_check_cart(m, grid, options):
+  check_cart = load_check_cart()
+  if not isinstance(grid, numpy.memmap):
+    fd, filename = tempfile.mkstemp(suffix=".grid")
+    os.close(fd)
+    try:
+      gridfile.write_binary_grid(filename, grid, m)
+      m, grid = gridfile.open_binary_grid(filename)
+    finally:
+      # (The open memory map keeps the file until it is closed)
+      os.unlink(filename)
+
+  n_cells = (grid.shape[0] - 1) * (grid.shape[1] - 1)
+  check_cart.check_grid(grid)
+  times = [ timed(check_cart.check_grid, grid)[0] for i in range(options.repeat) ]
+  print "check_grid on a {width}x{height} map ({n_cells:,} cells): best {best:.3f}s, worst {worst:.3f}s of {repeat}".format(
+    width=m.width, height=m.height, n_cells=n_cells, best=min(times), worst=max(times), repeat=options.repeat)
+
+BENCHMARKS = {
+  "borders": benchmark_borders,
+  "check-cart": benchmark_check_cart,
+  "interpolate": benchmark_interpolate,
+  "levels": benchmark_levels,
+  "inverse": benchmark_inverse,
+  "regions": benchmark_regions,
+  "simplify": benchmark_simplify,
+}
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] (" + "|".join(sorted(BENCHMARKS)) + ")")
+  parser.add_option("", "--grid",
+                    action="store",
+                    help="a binary grid file to use (default is a synthetic grid)")
+  parser.add_option("", "--size",
+                    action="store", default="1500x750",
+                    help="map size of the synthetic grid (default %default)")
+  parser.add_option("", "--points",
+                    action="store", type="int", default=1000000,
+                    help="number of points to interpolate (default %default)")
+  parser.add_option("", "--ring-size",
+                    action="store", type="int", default=200,
+                    help="number of points per ring (default %default)")
+  parser.add_option("", "--bucket-size",
+                    action="store", type="float", default=1.0,
+                    help="bucket size of the inverse index, in grid units (default %default)")
+  parser.add_option("", "--wkb",
+                    action="store",
+                    help="a file containing a region as hex EWKB, for the simplify benchmark (default is a synthetic region)")
+  parser.add_option("", "--carts",
+                    action="store", type="int", default=4,
+                    help="number of carts for the simplify benchmark (default %default)")
+  parser.add_option("", "--simplification",
+                    action="store", type="float", default=20000,
+                    help="simplification for the simplify benchmark (default %default)")
+  parser.add_option("", "--segmentize",
+                    action="store", type="float", default=50000,
+                    help="max segment length for the simplify benchmark (default %default)")
+  parser.add_option("", "--repeat",
+                    action="store", type="int", default=5,
+                    help="number of times to repeat the check-cart benchmark (default %default)")
+  parser.add_option("", "--scalar-points",
+                    action="store", type="int", default=100000,
+                    help="number of points to use for per-point code paths (default %default)")
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1 or args[0] not in BENCHMARKS:
+    parser.error("Specify one of: " + ", ".join(sorted(BENCHMARKS)))
+
+  if options.grid:
+    m, grid = gridfile.open_binary_grid(options.grid)
+  else:
+    mo = re.match(r"^(\d+)x(\d+)$", options.size)
+    if mo is None:
+      parser.error("Unrecognised value for --size: " + options.size)
+    m, grid = synthetic_grid(int(mo.group(1)), int(mo.group(2)))
+
+  BENCHMARKS[args[0]](m, grid, options)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+"""
+Inspect and prune the cache of derived grid data (see gridcache.py).
+
+  cache-admin.py info
+  cache-admin.py list
+  cache-admin.py prune [--max-size=1G]
+  cache-admin.py clear
+  cache-admin.py remove-sidecars DIRECTORY...
+
+The last of these removes the <cart>.pickled files that older versions
+wrote alongside each cart file.
+"""
+
+import datetime
+import optparse
+import os
+
+import gridcache
+
+def format_size(n):
+  for unit in ("", "K", "M", "G"):
+    if n < 1024:
+      return "%.1f%s" % (n, unit) if unit else "%d" % (n,)
+    n /= 1024.0
+  return "%.1fT" % (n,)
+
+def format_time(t):
+  return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+
+def remove_sidecars(directory):
+  for dirpath, dirnames, filenames in os.walk(directory):
+    for filename in filenames:
+      if filename.endswith(".pickled"):
+        path = os.path.join(dirpath, filename)
+        print "Removing {path}".format(path=path)
+        os.unlink(path)
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] (info|list|prune|clear|remove-sidecars)")
+  parser.add_option("", "--cache-dir",
+                    action="store",
+                    help="the cache directory (default $CARTOGRAM_CACHE_DIR, or %s)" % (gridcache.default_directory(),))
+  parser.add_option("", "--max-size",
+                    action="store",
+                    help="the size to prune the cache to (default $CARTOGRAM_CACHE_SIZE, or %s)" % (gridcache.DEFAULT_MAX_SIZE,))
+  (options, args) = parser.parse_args()
+  if not args:
+    parser.error("Missing command")
+  command, args = args[0], args[1:]
+
+  cache = gridcache.Cache(options.cache_dir, options.max_size)
+
+  if command == "info":
+    entries = cache.entries()
+    print "Directory: {directory}".format(directory=cache.directory)
+    print "Entries: {n}".format(n=len(entries))
+    print "Size: {size} (cap {max_size})".format(
+      size=format_size(sum(entry.size for entry in entries)), max_size=format_size(cache.max_size))
+
+  elif command == "list":
+    for entry in reversed(cache.entries()):
+      print "{last_used}  {size:>8}  {key}  {source}".format(
+        last_used=format_time(entry.last_used), size=format_size(entry.size),
+        key=entry.key, source=entry.meta.get("source", ""))
+
+  elif command == "prune":
+    for entry in cache.prune():
+      print "Removed {key} ({size})".format(key=entry.key, size=format_size(entry.size))
+
+  elif command == "clear":
+    removed = cache.clear()
+    print "Removed {n} entries".format(n=len(removed))
+
+  elif command == "remove-sidecars":
+    if not args:
+      parser.error("Usage: remove-sidecars DIRECTORY...")
+    for directory in args:
+      remove_sidecars(directory)
+
+  else:
+    parser.error("Unknown command: " + command)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+"""
+Convert cartogram grids between the text format written by cart
+and the binary format used by the interpolators (see gridfile.py).
+
+  cart-grid.py --map=world-robinson to-binary foo.cart foo.grid
+  cart-grid.py to-text foo.grid foo.cart
+  cart-grid.py info foo.grid
+"""
+
+import optparse
+import sys
+
+
+import gridfile
+import utils
+
+def print_header(header, grid_filename):
+  print "File: {grid_filename}".format(grid_filename=grid_filename)
+  print "Map size: {width}x{height}".format(width=header.width, height=header.height)
+  print "Bounds: {x_min} {y_min} {x_max} {y_max}".format(
+    x_min=header.x_min, y_min=header.y_min, x_max=header.x_max, y_max=header.y_max)
+  print "Precision: float{bits}".format(bits=8*header.itemsize)
+  if header.itemsize == 4:
+    print "Max float32 error: {max_error:g}".format(max_error=header.max_error)
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] (to-binary|to-text|info) input [output]")
+  parser.add_option("", "--map",
+                    action="store",
+                    help="the name of the map the grid was made for (needed by to-binary)")
+  parser.add_option("", "--float32",
+                    action="store_true", default=False,
+                    help="store the binary grid as float32 rather than float64")
+
+  parser.add_option("", "--db-host",
+                    action="store",
+                    default="localhost",
+                    help="database hostname (default %default)")
+  parser.add_option("", "--db-name",
+                    action="store",
+                    help="database name")
+  parser.add_option("", "--db-user",
+                    action="store",
+                    help="database username")
+
+  (options, args) = parser.parse_args()
+  if not args:
+    parser.error("Missing command")
+  command, args = args[0], args[1:]
+
+  if command == "to-binary":
+    if len(args) != 2:
+      parser.error("Usage: to-binary input.cart output.grid")
+    if not options.map:
+      parser.error("Missing option --map")
+    m = utils.Map(utils.db_connect(options), options.map)
+    grid = gridfile.read_text_grid(args[0], m.width, m.height)
+    header = gridfile.write_binary_grid(args[1], grid, m, float32=options.float32)
+    if options.float32:
+      print >>sys.stderr, "Max float32 error: {max_error:g}".format(max_error=header.max_error)
+
+  elif command == "to-text":
+    if len(args) != 2:
+      parser.error("Usage: to-text input.grid output.cart")
+    header, grid = gridfile.open_binary_grid(args[0])
+    gridfile.write_text_grid(args[1], grid)
+
+  elif command == "info":
+    if len(args) != 1:
+      parser.error("Usage: info input.grid")
+    header = gridfile.read_header(args[0])
+    if header is None:
+      parser.error("Not a binary grid file: " + args[0])
+    print_header(header, args[0])
+
+  else:
+    parser.error("Unknown command: " + command)
+
+if __name__ == "__main__":
+  main()
@@ -1,24 +1,187 @@
 #!/usr/bin/python
 
-# Check for places where the cart grid folds over itself
-# XXXX This is buggy because it also picks up twisting, which is okay
+"""
+Check a cart grid for places where it folds over itself.
 
+The bilinear map from a cell of the original grid to its deformed image
+is one-to-one exactly when the Jacobian has the same sign at all four
+corners of the cell, so a cell is folded if any of its corner Jacobians
+is zero or negative. (Twisting, where the grid is rotated or sheared but
+keeps its orientation, is fine.) The signed area of each deformed cell
+is also the local area scale of the cartogram, since the original cells
+have unit area.
+
+Prints a JSON report of the folded cells and the distribution of area
+scales, and exits with status 1 if any cells are folded.
+
+  check-cart.py foo.grid
+  check-cart.py --map=world-robinson foo.cart
+  check-cart.py --size=1500x750 foo.cart
+"""
+
+import json
+import optparse
+import re
 import sys
 
 import numpy
 
-W, H = 1200, 1800
-TOLERANCE = 3
-
-a = numpy.fromfile(sys.argv[1], sep=' ').reshape(H+1, W+1, 2)
-
-for x in range(1, W):
-  for y in range(1, H):
-    tx, ty = a[y][x]
-    lx, ly = a[y][x-1]
-    ux, uy = a[y-1][x]
-    
-    if lx > tx + TOLERANCE:
-      print "(%d,%d) -> (%f,%f), but (%d,%d) -> (%f,%f)" % (x,y, tx,ty, x-1,y, lx, ly)
-    if uy > ty + TOLERANCE:
-      print "(%d,%d) -> (%f,%f), but (%d,%d) -> (%f,%f)" % (x,y, tx,ty, x,y-1, ux, uy)
+import gridfile
+import utils
+
+# The histogram of area scales has bins of equal width in log2(scale),
+# a whole number of them to each power of two
+HISTOGRAM_LOG2_MIN, HISTOGRAM_LOG2_MAX, HISTOGRAM_BINS_PER_OCTAVE = -8, 8, 2
+
+# The number of cells checked at a time, in whole rows: few enough that
+# the arrays for them stay in the processor's cache
+CELLS_AT_A_TIME = 1 << 14
+
+def _histogram_bins(area, n_bins):
+  """The histogram bin of each value in area, counting from 1 for the bin
+  that starts at 2**HISTOGRAM_LOG2_MIN, with 0 for the values below that
+  (and the values that are not positive) and n_bins + 1 for those above.
+
+  With k bins to an octave, the bin is the floor of k * log2(area), which
+  is the binary exponent of area**k, as numpy.frexp gives it: this is
+  much quicker than taking logarithms.
+  """
+  # (Raising the values below the histogram first, so that none of
+  # them underflows to zero when raised to the power k)
+  powers = numpy.maximum(area, 2.0 ** (HISTOGRAM_LOG2_MIN - 1))
+  powers **= HISTOGRAM_BINS_PER_OCTAVE
+  # frexp gives powers = mantissa * 2**exponent, with 0.5 <= mantissa < 1
+  bins = numpy.frexp(powers)[1]
+  bins += -HISTOGRAM_LOG2_MIN * HISTOGRAM_BINS_PER_OCTAVE
+  return numpy.clip(bins, 0, n_bins + 1, bins)
+
+def _check_rows(rows):
+  """The corner Jacobians of the cells between the rows of grid points
+  in rows, an (R+1, W+1, 2) array, as (area, min_jacobian), each (R, W).
+  """
+  x, y = rows[..., 0], rows[..., 1]
+
+  # The deformed horizontal edges (p00 to p10) and vertical edges (p00 to p01)
+  hx, hy = x[:, 1:] - x[:, :-1], y[:, 1:] - y[:, :-1]
+  vx, vy = x[1:, :] - x[:-1, :], y[1:, :] - y[:-1, :]
+
+  def cross(h, v):
+    r = hx[h] * vy[:, v]
+    r -= hy[h] * vx[:, v]
+    return r
+
+  # The Jacobian at each corner of a cell is the cross product
+  # of the two edges that meet there
+  bottom, top = slice(None, -1), slice(1, None)
+  left, right = slice(None, -1), slice(1, None)
+  j00, j11 = cross(bottom, left), cross(top, right)
+
+  # The two corner Jacobians on either side of a diagonal are twice the
+  # areas of the triangles it divides the cell into
+  area = j00 + j11
+  area *= 0.5
+
+  min_jacobian = numpy.minimum(j00, j11, j00)
+  numpy.minimum(min_jacobian, cross(bottom, right), min_jacobian)
+  numpy.minimum(min_jacobian, cross(top, left), min_jacobian)
+  return area, min_jacobian
+
+def check_grid(grid, max_folds=100):
+  """Check the (3H+1, 3W+1, 2) grid for folds, returning a dict.
+
+  The grid is read a few rows at a time (see CELLS_AT_A_TIME), so a
+  memory-mapped grid is never copied whole. The grid of a 1500x750 map
+  takes well under a second. (See benchmark.py check-cart.)
+  """
+  n_rows, n_cols = grid.shape[0] - 1, grid.shape[1] - 1
+  rows_at_a_time = max(1, CELLS_AT_A_TIME // n_cols)
+  n_bins = (HISTOGRAM_LOG2_MAX - HISTOGRAM_LOG2_MIN) * HISTOGRAM_BINS_PER_OCTAVE
+  histogram = numpy.zeros(n_bins + 2, dtype=numpy.intp)
+  n_folded = n_non_positive = 0
+  folds = []
+  min_area, max_area = numpy.inf, -numpy.inf
+
+  for row0 in range(0, n_rows, rows_at_a_time):
+    rows = numpy.asarray(grid[row0 : row0 + rows_at_a_time + 1], dtype=numpy.float64)
+    area, min_jacobian = _check_rows(rows)
+
+    folded = min_jacobian <= 0
+    n_block_folded = int(numpy.count_nonzero(folded))
+    if n_block_folded:
+      n_folded += n_block_folded
+      if len(folds) < max_folds:
+        fold_rows, fold_cols = numpy.nonzero(folded)
+        folds.extend(
+          { "x": int(x), "y": int(y) + row0, "area": float(area[y, x]) }
+          for y, x in zip(fold_rows[:max_folds - len(folds)], fold_cols[:max_folds - len(folds)])
+        )
+
+    min_area, max_area = min(min_area, area.min()), max(max_area, area.max())
+    n_non_positive += int(numpy.count_nonzero(area <= 0))
+    histogram += numpy.bincount(_histogram_bins(area, n_bins).ravel(), minlength=n_bins + 2)
+
+  edges = HISTOGRAM_LOG2_MIN + numpy.arange(n_bins + 1) / float(HISTOGRAM_BINS_PER_OCTAVE)
+  return {
+    "width": n_cols,
+    "height": n_rows,
+    "cells": n_rows * n_cols,
+    "folded_cells": n_folded,
+    "folds": folds,
+    "min_area_scale": float(min_area),
+    "max_area_scale": float(max_area),
+    "area_scale_histogram": {
+      "log2_bin_edges": edges.tolist(),
+      "counts": histogram[1:-1].tolist(),
+      "below": int(histogram[0]) - n_non_positive,
+      "above": int(histogram[-1]),
+      "non_positive": n_non_positive,
+    },
+  }
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options] grid-file")
+  parser.add_option("", "--map",
+                    action="store",
+                    help="the name of the map the grid was made for (not needed for a binary grid)")
+  parser.add_option("", "--size",
+                    action="store",
+                    help="the size of the map the grid was made for, as <width>x<height>, instead of --map")
+  parser.add_option("", "--max-folds",
+                    action="store", type="int", default=100,
+                    help="the maximum number of folded cells to list (default %default)")
+
+  parser.add_option("", "--db-host",
+                    action="store",
+                    default="localhost",
+                    help="database hostname (default %default)")
+  parser.add_option("", "--db-name",
+                    action="store",
+                    help="database name")
+  parser.add_option("", "--db-user",
+                    action="store",
+                    help="database username")
+
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("Wrong number of arguments")
+  grid_filename = args[0]
+
+  if gridfile.is_binary_grid(grid_filename):
+    header, grid = gridfile.open_binary_grid(grid_filename)
+  elif options.map:
+    grid = gridfile.load_grid(grid_filename, utils.Map(utils.db_connect(options), options.map))
+  elif options.size:
+    mo = re.match(r"^(\d+)x(\d+)$", options.size)
+    if mo is None:
+      parser.error("Unrecognised value for --size: " + options.size)
+    grid = gridfile.read_text_grid(grid_filename, int(mo.group(1)), int(mo.group(2)))
+  else:
+    parser.error("A text grid needs --map or --size")
+
+  report = check_grid(grid, options.max_folds)
+  json.dump(report, sys.stdout, indent=2, sort_keys=True)
+  print
+  sys.exit(1 if report["folded_cells"] else 0)
+
+if __name__ == "__main__":
+  main()
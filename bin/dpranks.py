@@ -0,0 +1,144 @@
+"""
+Douglas-Peucker ranks, and choosing a simplification to fit a budget.
+
+The rank of a point of a line is the largest tolerance at which
+Douglas-Peucker simplification keeps it, so simplifying with tolerance t
+keeps exactly the points whose rank is greater than t. Once the ranks are
+known, the number of points that any tolerance would keep can be counted
+without simplifying again, which is what --levels and --max-vertices of
+as-js.py and as-svg.py rely on.
+"""
+
+import numpy
+
+def segment_distances(points, a, b):
+  """The distance of each of the (N,2) points from the segment from the
+  corresponding point of a to that of b (each also (N,2)), computed as
+  GEOS computes it, so that ties between points are broken the same way
+  as by LineString.simplify.
+  """
+  x, y = points[:,0], points[:,1]
+  ax, ay, bx, by = a[:,0], a[:,1], b[:,0], b[:,1]
+  dx, dy = bx - ax, by - ay
+  len2 = dx * dx + dy * dy
+  to_a = numpy.sqrt((x - ax) * (x - ax) + (y - ay) * (y - ay))
+  to_b = numpy.sqrt((x - bx) * (x - bx) + (y - by) * (y - by))
+  # (Where a and b are the same point, r and s are nan, and to_a is used)
+  with numpy.errstate(divide="ignore", invalid="ignore"):
+    r = ((x - ax) * dx + (y - ay) * dy) / len2
+    s = ((ay - y) * dx - (ax - x) * dy) / len2
+    return numpy.where((len2 == 0) | (r <= 0), to_a, numpy.where(r >= 1, to_b, numpy.abs(s) * numpy.sqrt(len2)))
+
+def ranks(line, min_tolerance=0):
+  """The rank of each point of the (N,2) array line. The end points have
+  infinite rank, and points that are not kept with min_tolerance have
+  rank 0.
+  """
+  return ranks_of_lines(line, [ 0, len(line) ], [ min_tolerance ])
+
+def ranks_of_lines(points, offsets, min_tolerances):
+  """The rank of each point of many lines at once, where line i is
+  points[offsets[i]:offsets[i+1]] and the points of line i that are not
+  kept with min_tolerances[i] have rank 0. Ranking all the lines together
+  is much quicker than ranking them one at a time, when they are short.
+  """
+  offsets = numpy.asarray(offsets, dtype=numpy.intp)
+  result = numpy.zeros(len(points))
+  nonempty = offsets[1:] > offsets[:-1]
+  result[offsets[:-1][nonempty]] = result[offsets[1:][nonempty] - 1] = numpy.inf
+
+  # Each span from start to end is split at the point furthest from the
+  # segment between its ends, which is kept only as long as the span
+  # itself is. All the spans at the same depth are split together.
+  start = offsets[:-1][nonempty]
+  end = offsets[1:][nonempty] - 1
+  span_rank = numpy.repeat(numpy.inf, len(start))
+  span_min_tolerance = numpy.asarray(min_tolerances, dtype=numpy.float64)[nonempty]
+  while True:
+    n_inside = end - start - 1
+    has_inside = n_inside > 0
+    start, end, n_inside = start[has_inside], end[has_inside], n_inside[has_inside]
+    span_rank, span_min_tolerance = span_rank[has_inside], span_min_tolerance[has_inside]
+    if len(start) == 0:
+      return result
+
+    # The points inside each span, and the span each one is in
+    first = numpy.cumsum(n_inside) - n_inside
+    span = numpy.repeat(numpy.arange(len(start)), n_inside)
+    inside = numpy.arange(len(span)) - first[span] + start[span] + 1
+    distances = segment_distances(points[inside], points[start[span]], points[end[span]])
+
+    # The first point in each span at the greatest distance
+    max_distance = numpy.maximum.reduceat(distances, first)
+    is_max = distances == max_distance[span]
+    furthest = inside[numpy.minimum.reduceat(numpy.where(is_max, numpy.arange(len(span)), len(span)), first)]
+
+    split = max_distance > span_min_tolerance
+    start, end, furthest = start[split], end[split], furthest[split]
+    result[furthest] = span_rank = numpy.minimum(max_distance[split], span_rank[split])
+    start, end = numpy.concatenate([ start, furthest ]), numpy.concatenate([ furthest, end ])
+    span_rank = numpy.concatenate([ span_rank, span_rank ])
+    span_min_tolerance = numpy.tile(span_min_tolerance[split], 2)
+
+def fit_budget(region_ranks, max_vertices, min_region_vertices=0):
+  """Choose the smallest simplification that keeps no more than
+  max_vertices points in all, given region_ranks, a dict of region name
+  => array of the ranks of the region's points. Each region keeps at
+  least min_region_vertices points (or all of its points, if it has
+  fewer), using a smaller simplification of its own if need be.
+
+  A region whose points are tied in rank at its minimum keeps all of
+  the tied points, since no simplification can keep only some of them.
+
+  Returns (simplification, simplification_dict, n_vertices), where
+  simplification_dict gives the simplification of each region that needs
+  its own, and n_vertices is the number of points they keep. If even the
+  points that are always kept, and those needed for the minimums, come to
+  more than max_vertices, this is the largest simplification of all.
+
+  The arrays of ranks are sorted in place, so that they are not copied.
+  """
+  names = sorted(region_ranks)
+  sorted_ranks = [ region_ranks[name] for name in names ]
+  for r in sorted_ranks:
+    r.sort()
+
+  def min_kept(r):
+    """The fewest points that a region with ranks r can keep,
+    if it keeps at least min_region_vertices."""
+    if min_region_vertices >= len(r):
+      return len(r)
+    if min_region_vertices == 0:
+      return 0
+    return len(r) - numpy.searchsorted(r, r[-min_region_vertices], side="left")
+  minimums = numpy.array([ min_kept(r) for r in sorted_ranks ], dtype=numpy.intp)
+
+  def kept(simplification):
+    """The number of points kept by each region."""
+    return numpy.array([ len(r) - numpy.searchsorted(r, simplification, side="right") for r in sorted_ranks ], dtype=numpy.intp)
+
+  def total(simplification):
+    return int(numpy.maximum(kept(simplification), minimums).sum())
+
+  # The candidates are 0 and every finite rank, in increasing order, and
+  # the total is smaller for each one than the last
+  candidates = numpy.unique(numpy.concatenate([ [ 0.0 ] ] + [ r[:numpy.searchsorted(r, numpy.inf)] for r in sorted_ranks ]))
+  lo, hi = 0, len(candidates) - 1
+  if total(candidates[hi]) > max_vertices:
+    lo = hi
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if total(candidates[mid]) <= max_vertices:
+      hi = mid
+    else:
+      lo = mid + 1
+  simplification = float(candidates[lo])
+
+  # A region that would keep fewer than its minimum keeps the points
+  # ranked above its (minimum + 1)th highest rank. (As the minimum takes
+  # in every tied rank, that rank is lower than all the points kept.)
+  simplification_dict = {}
+  for name, r, n_kept, minimum in zip(names, sorted_ranks, kept(simplification), minimums):
+    if n_kept < minimum:
+      simplification_dict[name] = float(r[-minimum-1]) if minimum < len(r) else 0.0
+  return simplification, simplification_dict, total(simplification)
@@ -0,0 +1,276 @@
+"""
+A managed cache directory for data derived from cart grids,
+such as the binary grids of gridfile.py.
+
+Entries are keyed by a hash of the content of the source file, the kind
+of data, any parameters that affect it, and FORMAT_VERSION, so a cached
+entry is never used for a source file that has changed, however its
+modification time looks. Entries are written to a temporary file and
+renamed into place, and are built under a lock, so that several jobs
+using the same cart at once build it only once and never see a partial
+file. Once the cache is larger than its size cap, the least recently
+used entries are deleted.
+
+The cache lives in $CARTOGRAM_CACHE_DIR, or ~/.cache/cartograms if that
+is not set, and the cap is $CARTOGRAM_CACHE_SIZE (default 4G).
+Use cache-admin.py to inspect and prune it.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+FORMAT_VERSION = 1
+
+DEFAULT_MAX_SIZE = "4G"
+
+_META_SUFFIX = ".json"
+_HASH_SUFFIX = ".sha1"
+_LOCK_SUFFIX = ".lock"
+
+def parse_size(s):
+  """Parse a size such as 500M or 4G into a number of bytes.
+  """
+  mo = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", str(s), re.I)
+  if mo is None:
+    raise Exception("Unrecognised size: " + str(s))
+  return int(float(mo.group(1)) * 1024 ** " KMGT".index(mo.group(2).upper() or " "))
+
+def default_directory():
+  if "CARTOGRAM_CACHE_DIR" in os.environ:
+    return os.environ["CARTOGRAM_CACHE_DIR"]
+  cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(cache_home, "cartograms")
+
+def _makedirs(directory):
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def _write_file(filename, s):
+  with open(filename, 'w') as f:
+    f.write(s)
+
+def _umask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+@contextlib.contextmanager
+def _locked(lock_filename):
+  with open(lock_filename, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+class CacheEntry(object):
+  def __init__(self, key, path, size, last_used, meta):
+    self.key, self.path, self.size, self.last_used, self.meta = key, path, size, last_used, meta
+
+class Cache(object):
+  def __init__(self, directory=None, max_size=None):
+    if directory is None:
+      directory = default_directory()
+    if max_size is None:
+      max_size = os.environ.get("CARTOGRAM_CACHE_SIZE", DEFAULT_MAX_SIZE)
+    self.directory = os.path.join(directory, "v%d" % (FORMAT_VERSION,))
+    self.max_size = parse_size(max_size)
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def content_hash(self, filename):
+    """The SHA-1 of the contents of filename.
+
+    The hash is remembered for as long as the file's size, modification
+    time and inode stay the same, so large files are not hashed every time.
+    """
+    st = os.stat(filename)
+    stat_key = hashlib.sha1("%s:%d:%r:%d" % (
+      os.path.abspath(filename), st.st_size, st.st_mtime, st.st_ino)).hexdigest()
+    hash_filename = self._path(stat_key + _HASH_SUFFIX)
+    try:
+      with open(hash_filename, 'r') as f:
+        digest = f.read().strip()
+      # So that prune can tell the hashes still in use from the stale ones
+      self._touch(hash_filename)
+      return digest
+    except IOError:
+      pass
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), ""):
+        h.update(block)
+    digest = h.hexdigest()
+
+    _makedirs(self.directory)
+    self._write_atomically(hash_filename, lambda tmp_filename: _write_file(tmp_filename, digest))
+    return digest
+
+  def key(self, source_filename, kind, params=None):
+    """The cache key for data of the given kind derived from source_filename.
+    params is a JSON-serialisable dict of anything else the data depends on.
+    """
+    return hashlib.sha1(json.dumps({
+      "version": FORMAT_VERSION,
+      "kind": kind,
+      "source": self.content_hash(source_filename),
+      "params": params or {},
+    }, sort_keys=True)).hexdigest() + "." + kind
+
+  def _write_atomically(self, filename, create):
+    fd, tmp_filename = tempfile.mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+      os.chmod(tmp_filename, 0666 & ~_umask())
+      create(tmp_filename)
+      os.rename(tmp_filename, filename)
+    except:
+      if os.path.exists(tmp_filename):
+        os.unlink(tmp_filename)
+      raise
+
+  def lookup(self, key):
+    """Return the path of the cached entry for key, or None if it has
+    not been built.
+    """
+    path = self._path(key)
+    if not os.path.isfile(path):
+      return None
+    self._touch(path)
+    return path
+
+  def get(self, key, create, meta=None):
+    """Return the path of the cached entry for key, first calling
+    create(filename) to build it if necessary.
+
+    create must write the entry to the file it is given. Only one process
+    builds a given entry at a time; any others wait for it to finish.
+
+    Another process may prune the entry before the caller opens it, so
+    a caller that finds the path gone should call get again.
+    """
+    path = self.lookup(key)
+    if path is not None:
+      return path
+
+    path = self._path(key)
+    _makedirs(self.directory)
+    with _locked(path + _LOCK_SUFFIX):
+      # Someone else may have built it while we waited for the lock
+      if os.path.isfile(path):
+        return path
+      self._write_atomically(path, create)
+      meta = dict(meta or {}, created=time.time(), version=FORMAT_VERSION)
+      self._write_atomically(path + _META_SUFFIX,
+        lambda tmp_filename: _write_file(tmp_filename, json.dumps(meta)))
+
+    # The cache only grows here, so this is the only place it can go over
+    if self.size() > self.max_size:
+      self.prune(keep=path)
+    return path
+
+  def _touch(self, path):
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+
+  def entries(self):
+    """All the entries in the cache, least recently used first.
+    """
+    if not os.path.isdir(self.directory):
+      return []
+
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.startswith(".") or name.endswith((_META_SUFFIX, _HASH_SUFFIX, _LOCK_SUFFIX)):
+        continue
+      path = self._path(name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      try:
+        with open(path + _META_SUFFIX, 'r') as f:
+          meta = json.load(f)
+      except (IOError, ValueError):
+        meta = {}
+      entries.append(CacheEntry(name, path, st.st_size, st.st_mtime, meta))
+
+    entries.sort(key=lambda entry: entry.last_used)
+    return entries
+
+  def size(self):
+    return sum(entry.size for entry in self.entries())
+
+  def remove(self, entry):
+    # The lock file is left alone: another process may have it open and
+    # be waiting for the lock, and if it were unlinked, a third could
+    # create a new one and build the entry at the same time
+    for filename in (entry.path, entry.path + _META_SUFFIX):
+      try:
+        os.unlink(filename)
+      except OSError:
+        pass
+
+  def prune(self, max_size=None, keep=None):
+    """Delete least recently used entries until the cache is no larger
+    than max_size (by default, the size cap), apart from the entry
+    whose path is keep. Returns the removed entries.
+
+    The remembered content hashes (see content_hash) that have not been
+    used since the last of the removed entries are deleted along with them.
+    """
+    if max_size is None:
+      max_size = self.max_size
+    if not os.path.isdir(self.directory):
+      return []
+
+    removed = []
+    with _locked(self._path(".prune" + _LOCK_SUFFIX)):
+      entries = self.entries()
+      total = sum(entry.size for entry in entries)
+      for entry in entries:
+        if total <= max_size:
+          break
+        if entry.path == keep:
+          continue
+        self.remove(entry)
+        total -= entry.size
+        removed.append(entry)
+      if removed:
+        self._remove_hashes(removed[-1].last_used)
+    return removed
+
+  def _remove_hashes(self, last_used):
+    """Delete the remembered content hashes not used since last_used."""
+    for name in os.listdir(self.directory):
+      if not name.endswith(_HASH_SUFFIX):
+        continue
+      path = self._path(name)
+      try:
+        if os.stat(path).st_mtime <= last_used:
+          os.unlink(path)
+      except OSError:
+        pass
+
+  def clear(self):
+    """Delete everything in the cache.
+    """
+    removed = self.prune(0)
+    for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+      if name.endswith(_HASH_SUFFIX):
+        os.unlink(self._path(name))
+    return removed
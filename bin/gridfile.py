@@ -0,0 +1,350 @@
+"""
+Binary storage for cartogram grids.
+
+cart writes its output grid as text, one "x y" pair per line for each
+of the (3W+1)x(3H+1) points of the padded grid, and parsing that text
+takes a long time for a large map. A binary grid file holds the same
+points as raw little-endian floats behind a small header, so it can be
+memory-mapped and is ready to use almost at once.
+
+The header records the map dimensions and bounds, so a binary grid can
+be checked against the map it is used with, and the size and accuracy
+of the payload: float64 by default, or optionally float32, in which
+case the largest rounding error (in grid units) is recorded as well.
+"""
+
+import errno
+import itertools
+import math
+import os
+import struct
+import tempfile
+
+import numpy
+
+import gridcache
+
+MAGIC = "CARTGRID"
+VERSION = 1
+
+# magic, version, itemsize, width, height, x_min, x_max, y_min, y_max, max_error
+HEADER_FORMAT = "<8sHHIIddddd"
+HEADER_SIZE = 64
+
+class GridHeader(object):
+  """The header of a binary grid file.
+
+  It has the same width, height and bounds attributes as utils.Map,
+  so it can be used in place of one where there is no database.
+  """
+  def __init__(self, width, height, x_min, x_max, y_min, y_max, itemsize=8, max_error=0.0):
+    self.width, self.height = width, height
+    self.x_min, self.x_max, self.y_min, self.y_max = x_min, x_max, y_min, y_max
+    self.itemsize = itemsize
+    self.max_error = max_error
+
+  @classmethod
+  def for_map(cls, m, itemsize=8, max_error=0.0):
+    return cls(m.width, m.height, m.x_min, m.x_max, m.y_min, m.y_max, itemsize, max_error)
+
+  @property
+  def dtype(self):
+    return numpy.dtype("<f%d" % (self.itemsize,))
+
+  @property
+  def shape(self):
+    return (3*self.height+1, 3*self.width+1, 2)
+
+  def pack(self):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.itemsize,
+      self.width, self.height,
+      self.x_min, self.x_max, self.y_min, self.y_max,
+      self.max_error)
+    return header + "\0" * (HEADER_SIZE - len(header))
+
+  @classmethod
+  def unpack(cls, s):
+    magic, version, itemsize, width, height, x_min, x_max, y_min, y_max, max_error \
+      = struct.unpack(HEADER_FORMAT, s[:struct.calcsize(HEADER_FORMAT)])
+    if magic != MAGIC:
+      return None
+    if version != VERSION:
+      raise Exception("Unsupported binary grid version %d (expected %d)" % (version, VERSION))
+    return cls(width, height, x_min, x_max, y_min, y_max, itemsize, max_error)
+
+  def check_map(self, m, grid_filename):
+    """Raise an exception unless this grid was made for the map m.
+    """
+    if (self.width, self.height) != (m.width, m.height):
+      raise Exception("Grid %s is for a %dx%d map, but the map is %dx%d" % (
+        grid_filename, self.width, self.height, m.width, m.height))
+
+    tolerance = 1e-6 * max(m.x_max - m.x_min, m.y_max - m.y_min)
+    for a, b in zip((self.x_min, self.x_max, self.y_min, self.y_max), (m.x_min, m.x_max, m.y_min, m.y_max)):
+      if abs(a - b) > tolerance:
+        raise Exception("Grid %s has different bounds from the map" % (grid_filename,))
+
+def read_header(grid_filename):
+  """Read the header of a binary grid file.
+  Returns None if the file is not a binary grid.
+  """
+  with open(grid_filename, 'rb') as f:
+    s = f.read(HEADER_SIZE)
+  if len(s) < HEADER_SIZE:
+    return None
+  return GridHeader.unpack(s)
+
+def is_binary_grid(grid_filename):
+  with open(grid_filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def open_binary_grid(grid_filename):
+  """Memory-map a binary grid file, returning (header, grid).
+  """
+  header = read_header(grid_filename)
+  if header is None:
+    raise Exception("Not a binary grid file: " + grid_filename)
+  grid = numpy.memmap(grid_filename, mode='r', dtype=header.dtype,
+    offset=HEADER_SIZE, shape=header.shape)
+  return header, grid
+
+def read_text_grid(grid_filename, width, height):
+  """Parse a grid in the text format written by cart.
+  """
+  return numpy.fromfile(grid_filename, sep=' ').reshape(3*height+1, 3*width+1, 2)
+
+def read_text_grid_window(grid_filename, width, height, rows, cols):
+  """Parse just the rows and columns rows[0]:rows[1], cols[0]:cols[1]
+  of a grid in the text format written by cart.
+
+  Each line of the file is one point, so the lines before and after
+  the window are skipped without being parsed.
+  """
+  row_length = 3*width+1
+  with open(grid_filename, 'r') as f:
+    lines = itertools.islice(f, rows[0] * row_length, rows[1] * row_length)
+    window = numpy.fromstring("".join(lines), sep=' ')
+  return window.reshape(rows[1] - rows[0], row_length, 2)[:, cols[0]:cols[1]]
+
+def float32_error(grid):
+  """The largest error, in grid units, from storing grid as float32.
+  """
+  return float(numpy.abs(grid - grid.astype(numpy.float32)).max())
+
+def _atomic_write(filename, write):
+  fd, tmp_filename = tempfile.mkstemp(
+    dir=os.path.dirname(os.path.abspath(filename)),
+    prefix=os.path.basename(filename) + ".", suffix=".tmp")
+  try:
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_filename, 0666 & ~umask)
+    with os.fdopen(fd, 'wb') as f:
+      write(f)
+    os.rename(tmp_filename, filename)
+  except:
+    os.unlink(tmp_filename)
+    raise
+
+def write_binary_grid(grid_filename, grid, m, float32=False):
+  """Write grid to a binary grid file for the map m.
+
+  The file is written to a temporary name and renamed into place,
+  so readers never see a partly-written grid. Returns the header.
+  """
+  grid = numpy.asarray(grid, dtype=numpy.float64)
+  if float32:
+    header = GridHeader.for_map(m, itemsize=4, max_error=float32_error(grid))
+  else:
+    header = GridHeader.for_map(m)
+
+  if grid.shape != header.shape:
+    raise Exception("Grid has shape %r, but the map needs %r" % (grid.shape, header.shape))
+
+  def write(f):
+    f.write(header.pack())
+    grid.astype(header.dtype).tofile(f)
+  _atomic_write(grid_filename, write)
+
+  return header
+
+def write_text_grid(grid_filename, grid):
+  """Write grid in the text format written by cart.
+  """
+  def write(f):
+    numpy.savetxt(f, numpy.asarray(grid, dtype=numpy.float64).reshape(-1, 2), fmt="%.17g")
+  _atomic_write(grid_filename, write)
+
+def _binary_grid_filename(grid_filename, m, cache, build=True):
+  """The name of a binary grid file for the grid in grid_filename, which
+  may be a binary grid itself or a text cart file. In the latter case the
+  text is parsed once and the binary grid is kept in the cache (a
+  gridcache.Cache, by default the shared one). Returns None if the cache
+  can't be used, or if build is false and the grid is not in it yet.
+  """
+  if is_binary_grid(grid_filename):
+    return grid_filename
+
+  if cache is None:
+    cache = gridcache.Cache()
+
+  try:
+    key = cache.key(grid_filename, "grid", {
+      "width": m.width, "height": m.height,
+      "bounds": [m.x_min, m.x_max, m.y_min, m.y_max],
+    })
+    if not build:
+      return cache.lookup(key)
+    return cache.get(key,
+      lambda filename: write_binary_grid(filename, read_text_grid(grid_filename, m.width, m.height), m),
+      meta={ "source": os.path.abspath(grid_filename) })
+  except (IOError, OSError):
+    return None
+
+def _open_checked(binary_filename, m):
+  header, grid = open_binary_grid(binary_filename)
+  header.check_map(m, binary_filename)
+  return grid
+
+def _open_grid(grid_filename, m, cache, build=True):
+  """Memory-map the binary grid for grid_filename (see
+  _binary_grid_filename), or return None if there is none.
+
+  Another process may prune a cached grid between the cache giving its
+  name and the grid being opened, in which case it is asked for again, once.
+  """
+  for attempt in (1, 2):
+    binary_filename = _binary_grid_filename(grid_filename, m, cache, build)
+    if binary_filename is None:
+      return None
+    try:
+      return _open_checked(binary_filename, m)
+    except (IOError, OSError) as e:
+      if e.errno != errno.ENOENT or binary_filename == grid_filename or attempt == 2:
+        raise
+
+def load_grid(grid_filename, m, cache=None):
+  """Load a cartogram grid for the map m, as a (3H+1, 3W+1, 2) array.
+
+  The grid is memory-mapped from a binary grid file, which is made
+  from a text cart file when needed (see _binary_grid_filename).
+  """
+  grid = _open_grid(grid_filename, m, cache)
+  if grid is None:
+    # If the cache can't be used, just parse the text
+    return read_text_grid(grid_filename, m.width, m.height)
+  return grid
+
+class GridWindow(object):
+  """The part of one or more cart grids that covers a bounding box.
+
+  a holds the rows row0 onwards and the columns col0 onwards of each
+  grid, with shape (h, w, 2) for a single grid or (K, h, w, 2) for a
+  stack. Indexing a window with [..., iy, ix, :], where iy and ix are
+  arrays of row and column numbers in the whole grid, gives the same
+  result as indexing the whole grid, as utils.interpolate expects.
+
+  Points outside the window are looked up in the whole grids, if they
+  are memory-mapped (full is a list of them), and are otherwise an error,
+  since there is nothing to look them up in.
+  """
+  def __init__(self, a, row0, col0, full=None):
+    self.a = a
+    self.row0, self.col0 = row0, col0
+    self.full = full
+
+  @property
+  def shape(self):
+    return self.a.shape
+
+  def __getitem__(self, key):
+    _, iy, ix, _ = key
+    h, w = self.a.shape[-3:-1]
+    wy, wx = iy - self.row0, ix - self.col0
+    inside = (wy >= 0) & (wy < h) & (wx >= 0) & (wx < w)
+    if inside.all():
+      return self.a[..., wy, wx, :]
+    if self.full is None:
+      raise Exception("{n} points are outside the part of the cart grid that was loaded (rows {row0} to {row1}, columns {col0} to {col1})".format(
+        n=(~inside).sum(), row0=self.row0, row1=self.row0 + h - 1, col0=self.col0, col1=self.col0 + w - 1))
+
+    r = numpy.empty(self.a.shape[:-3] + (len(iy), 2), dtype=self.a.dtype)
+    r[..., inside, :] = self.a[..., wy[inside], wx[inside], :]
+    outside = ~inside
+    r[..., outside, :] = numpy.array([
+      grid[iy[outside], ix[outside]] for grid in self.full
+    ]).reshape(self.a.shape[:-3] + (outside.sum(), 2))
+    return r
+
+class GridStack(object):
+  """Several cart grids for the same map, each as load_grid returned
+  it, that index like a (K, 3H+1, 3W+1, 2) stack of them.
+
+  Indexing with [..., iy, ix, :], as utils.interpolate does, gathers
+  the points from each grid in turn, so memory-mapped grids are only
+  read where they are needed and are never copied into one array.
+  """
+  def __init__(self, grids):
+    self.grids = grids
+    self.dtype = numpy.result_type(*grids)
+
+  @property
+  def shape(self):
+    return (len(self.grids),) + self.grids[0].shape
+
+  def __getitem__(self, key):
+    _, iy, ix, _ = key
+    r = numpy.empty((len(self.grids), len(iy), 2), dtype=self.dtype)
+    for i, grid in enumerate(self.grids):
+      r[i] = grid[iy, ix]
+    return r
+
+def window_bounds(m, bbox, margin=None):
+  """The rows and columns of the padded grid for m that cover
+  bbox = (x_min, y_min, x_max, y_max), in map coordinates, as
+  ((row0, row1), (col0, col1)), where the end points are exclusive.
+
+  The window is enlarged by margin cells on every side: by default,
+  two cells plus a tenth of the size of the bounding box.
+  """
+  x_min, y_min, x_max, y_max = bbox
+  gx_min = (x_min - m.x_min) * m.width  / (m.x_max - m.x_min) + m.width
+  gx_max = (x_max - m.x_min) * m.width  / (m.x_max - m.x_min) + m.width
+  gy_min = (y_min - m.y_min) * m.height / (m.y_max - m.y_min) + m.height
+  gy_max = (y_max - m.y_min) * m.height / (m.y_max - m.y_min) + m.height
+  if margin is None:
+    margin = 2 + int(0.1 * max(gx_max - gx_min, gy_max - gy_min))
+
+  def clamp(v, n):
+    return min(max(v, 0), n)
+  return (
+    (clamp(int(math.floor(gy_min)) - margin, 3*m.height), clamp(int(math.ceil(gy_max)) + 1 + margin, 3*m.height+1)),
+    (clamp(int(math.floor(gx_min)) - margin, 3*m.width),  clamp(int(math.ceil(gx_max)) + 1 + margin, 3*m.width+1)),
+  )
+
+def load_grid_window(grid_filenames, m, bbox, margin=None, cache=None):
+  """Load just the part of each of the cart grids in grid_filenames
+  that covers bbox = (x_min, y_min, x_max, y_max), as a GridWindow
+  holding a (K, h, w, 2) stack of windows.
+
+  The window is copied out of the memory-mapped binary grid, so only
+  the pages that hold it are read. A text cart file that is not in the
+  cache yet is not parsed whole to put it there: only the lines of the
+  text that hold the window are parsed, as when the cache can't be used,
+  and points outside the window can't be looked up.
+  """
+  rows, cols = window_bounds(m, bbox, margin)
+  windows = []
+  full = []
+  for grid_filename in grid_filenames:
+    grid = _open_grid(grid_filename, m, cache, build=False)
+    if grid is None:
+      windows.append(read_text_grid_window(grid_filename, m.width, m.height, rows, cols))
+      full = None
+    else:
+      windows.append(grid[rows[0]:rows[1], cols[0]:cols[1]])
+      if full is not None:
+        full.append(grid)
+
+  # numpy.array keeps the dtype of the grids, if they are all single precision
+  return GridWindow(numpy.array(windows), rows[0], cols[0], full)
@@ -0,0 +1,186 @@
+"""
+The inverse of the cartogram transform: from cartogram coordinates
+back to map coordinates.
+
+utils.Interpolator maps a point on the map to the cartogram by bilinear
+interpolation in the cell of the cart grid that contains it. To go the
+other way we must find which deformed cell of the grid contains a point
+of the cartogram, and then invert the bilinear map within that cell.
+
+The deformed cells are indexed in a bucketed grid over cartogram space:
+each cell is listed in every bucket that its bounding box overlaps, so a
+query only has to look at the few cells listed in its own bucket. Where
+the cart grid folds over itself a point lies in more than one cell, and
+has more than one preimage; such points are reported as folded.
+
+This is used for hit-testing on a rendered cartogram, for placing clicks
+back on the real map, and for warping rasters.
+"""
+
+import numpy
+
+import gridfile
+
+def _cross(a, b):
+  return a[...,0] * b[...,1] - a[...,1] * b[...,0]
+
+def invert_bilinear(p00, p10, p01, p11, p):
+  """Find (u, v) such that bilinear interpolation in the quadrilateral
+  p00, p10, p11, p01 at (u, v) gives p. All arguments are (N,2) arrays.
+
+  Returns an (N,2) array of (u, v), which lie between 0 and 1 when p is
+  inside the quadrilateral, and NaN where there is no solution.
+  """
+  e, f, g, h = p10 - p00, p01 - p00, p00 - p10 - p01 + p11, p - p00
+  k2 = _cross(g, f)
+  k1 = _cross(e, f) + _cross(h, g)
+  k0 = _cross(h, e)
+
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    linear = numpy.abs(k2) < 1e-12 * (numpy.abs(k1) + 1e-300)
+    w = numpy.sqrt(k1*k1 - 4*k0*k2)
+    v_linear = -k0 / k1
+    v1 = numpy.where(linear, v_linear, (-k1 - w) / (2*k2))
+    v2 = numpy.where(linear, v_linear, (-k1 + w) / (2*k2))
+
+    def u_for(v):
+      dx, dy = e[:,0] + g[:,0] * v, e[:,1] + g[:,1] * v
+      return numpy.where(numpy.abs(dx) > numpy.abs(dy),
+        (h[:,0] - f[:,0] * v) / dx,
+        (h[:,1] - f[:,1] * v) / dy)
+    u1, u2 = u_for(v1), u_for(v2)
+
+    # Of the two roots, prefer the one inside the unit square
+    eps = 1e-9
+    first_ok = (u1 >= -eps) & (u1 <= 1+eps) & (v1 >= -eps) & (v1 <= 1+eps)
+  return numpy.column_stack([
+    numpy.where(first_ok, u1, u2),
+    numpy.where(first_ok, v1, v2),
+  ])
+
+class InverseInterpolator(object):
+  """Map cartogram coordinates back to map coordinates, for a cart grid.
+
+  bucket_size is the size of the buckets of the spatial index, in grid
+  units; the default of one is about the size of an average cell.
+  """
+  def __init__(self, grid_filename, the_map, cache=None, bucket_size=1.0):
+    self._build(gridfile.load_grid(grid_filename, the_map, cache), the_map, bucket_size)
+
+  @classmethod
+  def for_grid(cls, grid, the_map, bucket_size=1.0):
+    """An InverseInterpolator for a grid that is already loaded.
+    """
+    self = cls.__new__(cls)
+    self._build(grid, the_map, bucket_size)
+    return self
+
+  def _build(self, grid, the_map, bucket_size):
+    self.m = the_map
+    self.a = numpy.asarray(grid, dtype=numpy.float64)
+    self.bucket_size = float(bucket_size)
+    rows, cols = self.a.shape[0] - 1, self.a.shape[1] - 1
+
+    corners = numpy.array([
+      self.a[:-1, :-1], self.a[:-1, 1:], self.a[1:, :-1], self.a[1:, 1:]
+    ]).reshape(4, -1, 2)
+    lo, hi = corners.min(axis=0), corners.max(axis=0)
+    del corners
+
+    # The bucket grid covers the whole of the deformed grid
+    self.origin = lo.min(axis=0)
+    self.n_buckets = (numpy.floor((hi.max(axis=0) - self.origin) / self.bucket_size) + 1).astype(numpy.intp)
+    b_lo = numpy.floor((lo - self.origin) / self.bucket_size).astype(numpy.intp)
+    b_hi = numpy.floor((hi - self.origin) / self.bucket_size).astype(numpy.intp)
+    del lo, hi
+
+    # List each cell in every bucket its bounding box overlaps
+    nx = b_hi[:,0] - b_lo[:,0] + 1
+    ny = b_hi[:,1] - b_lo[:,1] + 1
+    counts = nx * ny
+    cell = numpy.repeat(numpy.arange(rows * cols, dtype=numpy.int32), counts)
+    k = numpy.arange(len(cell)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    bucket = (b_lo[cell,1] + k // nx[cell]) * self.n_buckets[0] + (b_lo[cell,0] + k % nx[cell])
+    del k, nx, ny, counts, b_lo, b_hi
+
+    order = numpy.argsort(bucket, kind="mergesort")
+    self.cells = cell[order]
+    self.bucket_start = numpy.searchsorted(bucket[order],
+      numpy.arange(self.n_buckets[0] * self.n_buckets[1] + 1))
+    self.cols = cols
+
+  def _to_grid(self, coords):
+    m = self.m
+    return numpy.column_stack([
+      (coords[:,0] - m.x_min) * m.width  / (m.x_max - m.x_min) + m.width,
+      (coords[:,1] - m.y_min) * m.height / (m.y_max - m.y_min) + m.height,
+    ])
+
+  def _from_grid(self, g):
+    m = self.m
+    return numpy.column_stack([
+      (g[:,0] - m.width)  * (m.x_max - m.x_min) / m.width  + m.x_min,
+      (g[:,1] - m.height) * (m.y_max - m.y_min) / m.height + m.y_min,
+    ])
+
+  def map_array(self, coords, chunk_size=100000):
+    """Map an (N,2) array of cartogram coordinates back to map coordinates.
+
+    Returns (result, folded), where result is an (N,2) array and folded
+    is a boolean array that is True for each point that has more than
+    one preimage because the grid is folded there; for these points,
+    result holds one of the preimages. Points outside the padded grid
+    are returned unchanged, as utils.Interpolator does, and points
+    that no cell contains are NaN.
+    """
+    coords = numpy.array(coords, dtype=numpy.float64).reshape(-1, 2)
+    result = numpy.empty_like(coords)
+    folded = numpy.zeros(len(coords), dtype=bool)
+    for start in xrange(0, len(coords), chunk_size):
+      chunk = slice(start, start + chunk_size)
+      result[chunk], folded[chunk] = self._map_chunk(coords[chunk])
+    return result, folded
+
+  def _map_chunk(self, coords):
+    n = len(coords)
+    p = self._to_grid(coords)
+    g = numpy.empty_like(p)
+    g.fill(numpy.nan)
+    folded = numpy.zeros(n, dtype=bool)
+
+    b = numpy.floor((p - self.origin) / self.bucket_size).astype(numpy.intp)
+    in_index = (b[:,0] >= 0) & (b[:,0] < self.n_buckets[0]) & (b[:,1] >= 0) & (b[:,1] < self.n_buckets[1])
+    bucket = numpy.where(in_index, b[:,1] * self.n_buckets[0] + b[:,0], 0)
+    start = self.bucket_start[bucket]
+    counts = numpy.where(in_index, self.bucket_start[bucket + 1] - start, 0)
+
+    # One row for each (point, candidate cell) pair
+    point = numpy.repeat(numpy.arange(n), counts)
+    k = numpy.arange(len(point)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    cell = self.cells[start[point] + k]
+    iy, ix = cell // self.cols, cell % self.cols
+
+    uv = invert_bilinear(
+      self.a[iy, ix], self.a[iy, ix+1], self.a[iy+1, ix], self.a[iy+1, ix+1], p[point])
+    eps = 1e-9
+    with numpy.errstate(invalid='ignore'):
+      hit = (uv[:,0] >= -eps) & (uv[:,0] <= 1+eps) & (uv[:,1] >= -eps) & (uv[:,1] <= 1+eps)
+    point, preimage = point[hit], numpy.column_stack([ix[hit], iy[hit]]) + numpy.clip(uv[hit], 0, 1)
+
+    if len(point):
+      # The hits are in point order. A point on an edge between two cells
+      # hits both, with the same preimage; a folded point has several.
+      first = numpy.flatnonzero(numpy.r_[True, point[1:] != point[:-1]])
+      spread = numpy.maximum.reduceat(preimage, first) - numpy.minimum.reduceat(preimage, first)
+      g[point[first]] = preimage[first]
+      folded[point[first]] = (spread > 1e-6).any(axis=1)
+
+    result = self._from_grid(g)
+    m = self.m
+    outside = (p[:,0] < 0) | (p[:,0] > 3 * m.width) | (p[:,1] < 0) | (p[:,1] > 3 * m.height)
+    result[outside] = coords[outside]
+    return result, folded
+
+  def __call__(self, x, y):
+    (result,), _ = self.map_array([(x, y)])
+    return tuple(result)
@@ -0,0 +1,105 @@
+"""
+A compact binary encoding of the paths that as-js.py writes, for
+--format=binary.
+
+Coordinates are quantized to integer multiples of a scale (by default
+one unit of the output, as with --decimal-digits=0), and the path of
+each region in each cart is encoded as a sequence of unsigned LEB128
+varints:
+
+  the number of rings
+  for each ring:
+    the number of points
+    the x and y of each point, zigzag-encoded, where every point after
+    the first is given as the difference from the point before
+
+As in the SVG paths, the last point of each ring, which repeats the
+first, is left out. The paths are concatenated, all the regions for one
+key after another, and a JSON manifest gives the offsets of each path.
+js/cartogram-paths.js decodes them in the browser.
+"""
+
+import numpy
+
+VERSION = 1
+
+def quantize(coords, scale):
+  """Round an (N,2) array of coordinates to integer multiples of scale.
+  """
+  return numpy.round(numpy.asarray(coords, dtype=numpy.float64) / scale).astype(numpy.int64)
+
+def zigzag(values):
+  """Map signed integers to unsigned ones: 0, -1, 1, -2, ... to 0, 1, 2, 3, ...
+  """
+  values = numpy.asarray(values, dtype=numpy.int64)
+  return ((values << 1) ^ (values >> 63)).astype(numpy.uint64)
+
+def unzigzag(values):
+  values = numpy.asarray(values, dtype=numpy.uint64)
+  return ((values >> numpy.uint64(1)).astype(numpy.int64)) ^ -((values & numpy.uint64(1)).astype(numpy.int64))
+
+def encode_varints(values):
+  """Encode an array of unsigned integers as LEB128 varints, returning a string.
+  """
+  values = numpy.asarray(values, dtype=numpy.uint64)
+  n_bytes = numpy.ones(len(values), dtype=numpy.intp)
+  for k in range(1, 10):
+    n_bytes += values >= numpy.uint64(1 << (7*k))
+
+  start = numpy.cumsum(n_bytes) - n_bytes
+  out = numpy.zeros(n_bytes.sum(), dtype=numpy.uint8)
+  for k in range(n_bytes.max() if len(values) else 0):
+    has_byte = n_bytes > k
+    byte = (values[has_byte] >> numpy.uint64(7*k)) & numpy.uint64(0x7f)
+    more = (n_bytes[has_byte] > k + 1).astype(numpy.uint64) << numpy.uint64(7)
+    out[start[has_byte] + k] = byte | more
+  return out.tostring()
+
+def decode_varints(data):
+  """Decode a string of LEB128 varints into an array of unsigned integers.
+  """
+  data = numpy.fromstring(data, dtype=numpy.uint8)
+  last = numpy.flatnonzero(data < 0x80)
+  first = numpy.r_[0, last[:-1] + 1]
+  values = numpy.zeros(len(last), dtype=numpy.uint64)
+  length = last - first + 1
+  for k in range(length.max() if len(last) else 0):
+    has_byte = length > k
+    values[has_byte] |= (data[first[has_byte] + k] & 0x7f).astype(numpy.uint64) << numpy.uint64(7*k)
+  return values
+
+def encode_path(rings):
+  """Encode a path, given as a list of rings, each an (N,2) array of
+  quantized coordinates.
+  """
+  parts = [ numpy.array([ len(rings) ], dtype=numpy.uint64) ]
+  for ring in rings:
+    ring = numpy.asarray(ring, dtype=numpy.int64).reshape(-1, 2)
+    deltas = ring.copy()
+    deltas[1:] -= ring[:-1]
+    parts.append(numpy.array([ len(ring) ], dtype=numpy.uint64))
+    parts.append(zigzag(deltas.ravel()))
+  return encode_varints(numpy.concatenate(parts))
+
+def decode_path(data):
+  """Decode a path, returning a list of rings, each an (N,2) array of
+  quantized coordinates.
+  """
+  values = decode_varints(data)
+  n_rings, i = int(values[0]), 1
+  rings = []
+  for _ in range(n_rings):
+    n = int(values[i])
+    deltas = unzigzag(values[i+1:i+1+2*n]).reshape(n, 2)
+    rings.append(numpy.cumsum(deltas, axis=0))
+    i += 1 + 2*n
+  return rings
+
+def path_as_svg(rings, scale, decimal_digits):
+  """The SVG path for a decoded path, as as-js.py would write it.
+  """
+  path_arr = []
+  for ring in rings:
+    points = [ "%.*f %.*f" % (decimal_digits, x * scale, decimal_digits, y * scale) for x, y in ring.tolist() ]
+    path_arr.append("M " + points[0] + " L " + " ".join(points[1:]) + " Z")
+  return " ".join(path_arr)
@@ -0,0 +1,229 @@
+"""
+Region cache files, which hold the simplified regions made by as-js.py.
+
+A region cache file holds, for each region, the coordinates of its
+simplified rings as raw little-endian floats, and ends with an index
+that gives the byte offset of each region, so that a single region can
+be read without reading the rest. The index also records a key for
+each region, made from everything its simplification depends on: the
+region's geometry and breakpoints, its simplification, the segment
+length, the densify tolerance, the carts used to measure stretch and
+the version of the simplification code. (See region_key.) Along with
+the index is a dict of metadata recording the settings that made the
+file.
+
+  header:  MAGIC, VERSION, offset of the index
+  regions: for each region, the number of polygons, the number of rings
+           in each polygon and the number of points in each ring, as
+           int32s, followed by the points as float64 (x, y) pairs, and
+           then the region's breakpoints, also as (x, y) pairs
+  index:   JSON {"meta": {...}, "regions": [[name, offset, key], ...]}
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy
+
+import gridcache
+
+MAGIC = "CARTRGNS"
+VERSION = 2
+
+# The version of the simplification in as-js.py, which goes into the key
+# of every region. Change it whenever the same settings would give
+# different simplified regions, so that cached regions are made again.
+SIMPLIFICATION_VERSION = 2
+
+# magic, version, index offset, index length
+HEADER_FORMAT = "<8sHQQ"
+HEADER_SIZE = 32
+
+# the number of int32 counts, of (x, y) points and of breakpoints in a region record
+RECORD_FORMAT = "<III"
+
+# Version 1 files have no breakpoints, and so no count of them
+V1_RECORD_FORMAT = "<II"
+
+def file_hash(filename):
+  """The SHA-1 of the contents of filename, remembered in the grid cache
+  if possible.
+  """
+  try:
+    return gridcache.Cache().content_hash(filename)
+  except (IOError, OSError):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), ""):
+        h.update(block)
+    return h.hexdigest()
+
+def region_key(geom_wkb, breakpoints_wkb, simplification, max_segment_length, cart_hashes, densify=None):
+  """The key for a region simplified from geom_wkb and breakpoints_wkb
+  (which may be None), with the given simplification and maximum segment
+  length (or None), and measuring stretch with the carts whose content
+  hashes are cart_hashes. densify is the densify tolerance and the (x, y)
+  size of the output unit it is measured in, or None.
+  """
+  settings = {
+    "version": VERSION,
+    "simplification_version": SIMPLIFICATION_VERSION,
+    "simplification": simplification,
+    "max_segment_length": max_segment_length,
+    "carts": sorted(cart_hashes),
+  }
+  # (Left out when not used, so as not to change the keys of older files)
+  if densify is not None:
+    settings["densify"] = list(densify)
+  h = hashlib.sha1()
+  h.update(json.dumps(settings, sort_keys=True))
+  h.update(hashlib.sha1(geom_wkb).digest())
+  if breakpoints_wkb is not None:
+    h.update(hashlib.sha1(breakpoints_wkb).digest())
+  return h.hexdigest()
+
+def is_region_cache(filename):
+  with open(filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def is_current(filename):
+  """Whether filename is a region cache file of the current version.
+  """
+  with open(filename, 'rb') as f:
+    s = f.read(struct.calcsize(HEADER_FORMAT))
+  if len(s) < struct.calcsize(HEADER_FORMAT):
+    return False
+  magic, version, index_offset, index_length = struct.unpack(HEADER_FORMAT, s)
+  return magic == MAGIC and version == VERSION
+
+class RegionCache(object):
+  """A region cache file, open for reading.
+
+  region(region_name) returns (polygons, breakpoints) for a region,
+  where polygons is a list of polygons, each a list of (N,2) arrays (the
+  exterior ring followed by any interior rings) and breakpoints is an
+  (M,2) array.
+
+  Files of version 1, which do not store breakpoints, can also be read,
+  and give every region an empty array of them.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.f = open(filename, 'rb')
+    magic, version, index_offset, index_length = struct.unpack(
+      HEADER_FORMAT, self.f.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != MAGIC:
+      raise Exception("Not a region cache file: " + filename)
+    if version not in (1, VERSION):
+      raise Exception("Unsupported region cache version %d (expected %d)" % (version, VERSION))
+
+    self.version = version
+
+    self.f.seek(index_offset)
+    index = json.loads(self.f.read(index_length))
+    self.meta = index["meta"]
+    self.names = [ name for name, offset, key in index["regions"] ]
+    self._offsets = dict(( (name, offset) for name, offset, key in index["regions"] ))
+    self._keys = dict(( (name, key) for name, offset, key in index["regions"] ))
+
+  def close(self):
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __contains__(self, region_name):
+    return region_name in self._offsets
+
+  def __len__(self):
+    return len(self.names)
+
+  def key(self, region_name):
+    return self._keys[region_name]
+
+  def region(self, region_name):
+    self.f.seek(self._offsets[region_name])
+    if self.version == 1:
+      n_counts, n_points = struct.unpack(V1_RECORD_FORMAT, self.f.read(struct.calcsize(V1_RECORD_FORMAT)))
+      n_breakpoints = 0
+    else:
+      n_counts, n_points, n_breakpoints = struct.unpack(RECORD_FORMAT, self.f.read(struct.calcsize(RECORD_FORMAT)))
+    counts = numpy.fromfile(self.f, dtype="<i4", count=n_counts)
+    points = numpy.fromfile(self.f, dtype="<f8", count=2*n_points).reshape(-1, 2)
+    breakpoints = numpy.fromfile(self.f, dtype="<f8", count=2*n_breakpoints).reshape(-1, 2)
+
+    n_polygons = counts[0]
+    rings_per_polygon = counts[1:1+n_polygons]
+    ring_ends = numpy.cumsum(counts[1+n_polygons:])
+    rings = numpy.split(points, ring_ends[:-1]) if len(ring_ends) else []
+
+    polygons, i = [], 0
+    for n_rings in rings_per_polygon:
+      polygons.append(rings[i:i+n_rings])
+      i += n_rings
+    return polygons, breakpoints
+
+  def get(self, region_name, key):
+    """(polygons, breakpoints) for a region, if it is in the cache with
+    the given key, or else None.
+    """
+    if self._keys.get(region_name) != key:
+      return None
+    return self.region(region_name)
+
+class RegionCacheWriter(object):
+  """Write a region cache file, one region at a time.
+
+  The file is written to a temporary name, and only renamed into place
+  by commit(), so an unfinished file never replaces a good one.
+  """
+  def __init__(self, filename, meta=None):
+    self.filename = filename
+    self.meta = meta or {}
+    self.regions = []
+    fd, self.tmp_filename = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(filename)),
+      prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    self.f = os.fdopen(fd, 'wb')
+    self.f.write("\0" * HEADER_SIZE)
+
+  def add(self, region_name, key, polygons, breakpoints=()):
+    """Add a region, whose polygons are each a list of rings, each an
+    (N,2) array or a list of (x, y) pairs, and whose breakpoints are an
+    (M,2) array or a list of (x, y) pairs.
+    """
+    rings = [ numpy.asarray(ring, dtype=numpy.float64).reshape(-1, 2) for polygon in polygons for ring in polygon ]
+    counts = numpy.array([ len(polygons) ] + [ len(polygon) for polygon in polygons ] + [ len(ring) for ring in rings ], dtype="<i4")
+    n_points = sum(len(ring) for ring in rings)
+    breakpoints = numpy.asarray(breakpoints, dtype=numpy.float64).reshape(-1, 2)
+
+    self.regions.append([ region_name, self.f.tell(), key ])
+    self.f.write(struct.pack(RECORD_FORMAT, len(counts), n_points, len(breakpoints)))
+    counts.tofile(self.f)
+    for ring in rings:
+      ring.astype("<f8").tofile(self.f)
+    breakpoints.astype("<f8").tofile(self.f)
+
+  def commit(self):
+    index_offset = self.f.tell()
+    index = json.dumps({ "meta": self.meta, "regions": self.regions })
+    self.f.write(index)
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, index_offset, len(index))
+    self.f.seek(0)
+    self.f.write(header + "\0" * (HEADER_SIZE - len(header)))
+    self.f.close()
+
+    os.chmod(self.tmp_filename, 0666 & ~gridcache._umask())
+    os.rename(self.tmp_filename, self.filename)
+
+  def abort(self):
+    self.f.close()
+    if os.path.exists(self.tmp_filename):
+      os.unlink(self.tmp_filename)
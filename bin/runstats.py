@@ -0,0 +1,272 @@
+"""
+Timing and counters for as-js.py --stats and --region-stats.
+
+The work of a run is divided into stages (the database query, parsing
+the WKB, simplification, interpolation and so on), and a Stats records
+the wall and CPU time spent in each, along with counters such as the
+number of vertices read and written. The time of a stage does not
+include the time of any stage inside it, so interpolating in the middle
+of simplifying counts as interpolation, and not as simplification too.
+
+While a region is being processed, inside "with stats.region(name)",
+its times and counters go to a Record of their own, which can be sent
+back from a worker process, added to the totals with Stats.add and
+written as a line of --region-stats. Stats.resume goes back to adding
+to a region's record, such as while the region is being written out.
+
+The CPU time of a stage is that of the thread it runs in, where the
+system can tell (as on Linux), so that it does not include the work of
+another thread running at the same time, such as the one that prefetches
+rows from the database. Elsewhere it is that of the whole process. The
+CPU time in the summary is always that of the whole process, and of any
+worker processes of --jobs that have finished.
+
+NULL is a Stats that records nothing, for when no statistics are wanted,
+and costs no more than a method call for each stage.
+"""
+
+import heapq
+import json
+import resource
+import sys
+import threading
+import time
+
+# Python 2 has no resource.RUSAGE_THREAD, but Linux has had it since 2.6.26
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1 if sys.platform.startswith("linux") else None)
+
+def _cpu_time(who=resource.RUSAGE_SELF):
+  usage = resource.getrusage(who)
+  return usage.ru_utime + usage.ru_stime
+
+def _thread_cpu_time():
+  return _cpu_time(RUSAGE_THREAD)
+
+try:
+  _thread_cpu_time()
+except (TypeError, ValueError, resource.error):
+  _thread_cpu_time = _cpu_time
+
+class Record(object):
+  """The time spent in each stage, as a dict of stage name => [calls,
+  wall, cpu], and the counters, as a dict of name => number, or of name
+  => dict of key => number for counters kept separately for each key.
+  """
+  def __init__(self, region_name=None):
+    self.region_name = region_name
+    self.stages = {}
+    self.counters = {}
+
+  def add_time(self, stage, wall, cpu, calls=1):
+    times = self.stages.get(stage)
+    if times is None:
+      self.stages[stage] = [ calls, wall, cpu ]
+    else:
+      times[0] += calls
+      times[1] += wall
+      times[2] += cpu
+
+  def count(self, name, n=1, key=None):
+    if key is None:
+      self.counters[name] = self.counters.get(name, 0) + n
+    else:
+      by_key = self.counters.setdefault(name, {})
+      by_key[key] = by_key.get(key, 0) + n
+
+  def add(self, record):
+    """Add the times and counters of another record to these."""
+    for stage, (calls, wall, cpu) in record.stages.items():
+      self.add_time(stage, wall, cpu, calls)
+    for name, value in record.counters.items():
+      if isinstance(value, dict):
+        for key, n in value.items():
+          self.count(name, n, key)
+      else:
+        self.count(name, value)
+
+  def wall(self):
+    return sum(( wall for calls, wall, cpu in self.stages.values() ))
+
+  def as_dict(self):
+    d = {
+      "stages": dict((
+        (stage, { "calls": calls, "wall": round(wall, 6), "cpu": round(cpu, 6) })
+        for stage, (calls, wall, cpu) in self.stages.items()
+      )),
+    }
+    if self.region_name is not None:
+      d["region"] = self.region_name
+      d["wall"] = round(self.wall(), 6)
+    d.update(self.counters)
+    return d
+
+class _Stage(object):
+  """The context manager returned by Stats.stage."""
+  __slots__ = ("stats", "name", "parent", "start_wall", "start_cpu", "inner_wall", "inner_cpu")
+
+  def __init__(self, stats, name):
+    self.stats = stats
+    self.name = name
+
+  def __enter__(self):
+    local = self.stats._local
+    self.parent = getattr(local, "stage", None)
+    local.stage = self
+    self.inner_wall = self.inner_cpu = 0.0
+    self.start_wall, self.start_cpu = time.time(), _thread_cpu_time()
+
+  def __exit__(self, *args):
+    wall, cpu = time.time() - self.start_wall, _thread_cpu_time() - self.start_cpu
+    local = self.stats._local
+    local.stage = self.parent
+    if self.parent is not None:
+      self.parent.inner_wall += wall
+      self.parent.inner_cpu += cpu
+    record = getattr(local, "record", None) or self.stats
+    record.add_time(self.name, wall - self.inner_wall, cpu - self.inner_cpu)
+
+class _Region(object):
+  """The context manager returned by Stats.region and Stats.resume."""
+  def __init__(self, stats, record):
+    self.stats = stats
+    self.record = record
+
+  def __enter__(self):
+    self.previous = getattr(self.stats._local, "record", None)
+    self.stats._local.record = self.record
+    return self.record
+
+  def __exit__(self, *args):
+    self.stats._local.record = self.previous
+
+class Stats(Record):
+  """The times and counters of a whole run."""
+  enabled = True
+
+  # The number of the slowest regions given in the summary
+  N_SLOWEST = 10
+
+  def __init__(self):
+    super(Stats, self).__init__()
+    self._local = threading.local()
+    self.start_wall, self.start_cpu = time.time(), _cpu_time()
+    self.n_regions = 0
+    # (wall, region name) of the slowest regions, as a heap
+    self._slowest = []
+
+  def stage(self, name):
+    """A context manager that times a stage."""
+    return _Stage(self, name)
+
+  def timed(self, name, iterable):
+    """Iterate over iterable, timing the work of producing each item
+    (such as fetching rows from the database) as the stage name.
+    """
+    items = iter(iterable)
+    while True:
+      with self.stage(name):
+        try:
+          item = items.next()
+        except StopIteration:
+          return
+      yield item
+
+  def region(self, region_name):
+    """A context manager that sends the times and counters recorded
+    inside it, in this thread, to a new Record for region_name, which it
+    returns. They are not added to the totals until it is passed to add.
+    """
+    return _Region(self, Record(region_name))
+
+  def resume(self, record):
+    """A context manager that sends the times and counters recorded
+    inside it, in this thread, to record, as region() does.
+    """
+    return _Region(self, record)
+
+  def count(self, name, n=1, key=None):
+    record = getattr(self._local, "record", None)
+    if record is not None:
+      record.count(name, n, key)
+    else:
+      super(Stats, self).count(name, n, key)
+
+  def add(self, record):
+    super(Stats, self).add(record)
+    if record.region_name is not None:
+      self.n_regions += 1
+      heapq.heappush(self._slowest, (record.wall(), record.region_name))
+      if len(self._slowest) > self.N_SLOWEST:
+        heapq.heappop(self._slowest)
+
+  def summary(self):
+    """The totals, as a dict, with the wall and CPU time of the whole
+    run so far. (The CPU time includes that of worker processes that
+    have finished.)
+    """
+    d = self.as_dict()
+    d["wall"] = round(time.time() - self.start_wall, 6)
+    d["cpu"] = round(_cpu_time() + _cpu_time(resource.RUSAGE_CHILDREN) - self.start_cpu, 6)
+    d["regions"] = self.n_regions
+    d["slowest_regions"] = [
+      { "region": region_name, "wall": round(wall, 6) }
+      for wall, region_name in sorted(self._slowest, reverse=True)
+    ]
+    return d
+
+  def write_summary(self, filename):
+    with open(filename, 'w') as f:
+      json.dump(self.summary(), f, indent=2, sort_keys=True)
+      f.write("\n")
+
+class CountingFile(object):
+  """A file, or anything with a write method, that counts the bytes
+  written to it as the counter name of stats.
+  """
+  def __init__(self, f, stats, name="bytes_written"):
+    self.f = f
+    self.stats = stats
+    self.name = name
+
+  def write(self, s):
+    self.stats.count(self.name, len(s))
+    self.f.write(s)
+
+  def __getattr__(self, name):
+    return getattr(self.f, name)
+
+def counted(f, stats, name="bytes_written"):
+  """f, counting the bytes written to it if stats is enabled."""
+  return CountingFile(f, stats, name) if stats.enabled else f
+
+class _NullContext(object):
+  def __enter__(self):
+    return None
+
+  def __exit__(self, *args):
+    pass
+
+class NullStats(object):
+  """A Stats that records nothing."""
+  enabled = False
+  _context = _NullContext()
+
+  def stage(self, name):
+    return self._context
+
+  def timed(self, name, iterable):
+    return iterable
+
+  def region(self, region_name):
+    return self._context
+
+  def resume(self, record):
+    return self._context
+
+  def count(self, name, n=1, key=None):
+    pass
+
+  def add(self, record):
+    pass
+
+NULL = NullStats()
@@ -1,10 +1,15 @@
 
+import itertools
 import math
-import os
+import Queue
 import re
-import cPickle as pickle
+import sys
+import threading
 
 import numpy
+import psycopg2
+
+import gridfile
 
 class Map(object):
   def __init__(self, db, map_name):
@@ -28,81 +33,320 @@ class Map(object):
     self.x_min, self.y_min, self.x_max, self.y_max = map(float, (x_min, y_min, x_max, y_max))
 
 
+def db_connect(options):
+  """Connect to the database named by the --db-host, --db-name and
+  --db-user options."""
+  db_connection_data = []
+  if options.db_host:
+    db_connection_data.append("host=" + options.db_host)
+  if options.db_name:
+    db_connection_data.append(" dbname=" + options.db_name)
+  if options.db_user:
+    db_connection_data.append(" user=" + options.db_user)
+  return psycopg2.connect(" ".join(db_connection_data))
+
+_cursor_names = itertools.count()
+
+def stream_rows(db, sql, params=None, fetch_size=100):
+  """Yield the rows of a query from a named (server-side) cursor, which
+  fetches them from the database fetch_size rows at a time, so that
+  only that many rows are held in memory at once.
+  """
+  c = db.cursor(name="stream_rows_%d" % (next(_cursor_names),))
+  try:
+    c.itersize = fetch_size
+    c.execute(sql, params)
+    for row in c:
+      yield row
+  finally:
+    c.close()
+
+_END = object()
+
+def prefetch(iterable, queue_size=100):
+  """Iterate over iterable in a background thread, keeping up to
+  queue_size items ready in a queue.
+
+  This lets a slow producer, such as a database query, run at the same
+  time as the code that consumes it, while holding no more than
+  queue_size items in memory. An exception raised by the producer is
+  raised again in the consumer.
+  """
+  q = Queue.Queue(queue_size)
+  stop = threading.Event()
+
+  def put(item):
+    # Give up if the consumer has gone away
+    while not stop.is_set():
+      try:
+        q.put(item, True, 0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put((None, item)):
+          return
+      put((_END, None))
+    except:
+      put((sys.exc_info(), None))
+
+  thread = threading.Thread(target=produce)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      exc_info, item = q.get()
+      if exc_info is _END:
+        return
+      if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      yield item
+  finally:
+    stop.set()
+    thread.join()
+
+class BackgroundWriter(object):
+  """Write strings to the file object f from a background thread, so
+  that writing (and any compression, if f compresses) happens at the
+  same time as the work of making them. Up to queue_size strings wait
+  to be written, and write() blocks when there are that many.
+
+  An exception raised when writing is raised again by the next call to
+  write() or by close().
+  """
+  def __init__(self, f, queue_size=100):
+    self.f = f
+    self.queue = Queue.Queue(queue_size)
+    self.exc_info = None
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      s = self.queue.get()
+      if s is _END:
+        return
+      # After an error, keep taking strings off the queue, so that
+      # write() never blocks for ever
+      if self.exc_info is None:
+        try:
+          self.f.write(s)
+        except:
+          self.exc_info = sys.exc_info()
+
+  def _raise(self):
+    if self.exc_info is not None:
+      exc_info, self.exc_info = self.exc_info, None
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def write(self, s):
+    self._raise()
+    self.queue.put(s)
+
+  def close(self):
+    """Wait for everything to be written, and close the file.
+    """
+    if self.thread is None:
+      return
+    self.queue.put(_END)
+    self.thread.join()
+    self.thread = None
+    try:
+      self._raise()
+    finally:
+      self.f.close()
+
+def as_coords_array(coords):
+  """Convert a sequence of (x, y) pairs to an (N,2) float array.
+  """
+  return numpy.array(coords, dtype=numpy.float64).reshape(-1, 2)
+
+def grid_cells(m, coords):
+  """Locate an (N,2) array of map coordinates in the padded cart grid for m.
+
+  Returns (inside, iy, ix, dx, dy): a boolean mask of the points that lie
+  within the grid, the row and column of the grid cell that contains each
+  point, and the offsets of each point within its cell, from 0 to 1.
+  Points outside the grid are given the nearest cell, and should be
+  ignored by the caller.
+  """
+  x = (coords[:,0] - m.x_min) * m.width  / (m.x_max - m.x_min) + m.width
+  y = (coords[:,1] - m.y_min) * m.height / (m.y_max - m.y_min) + m.height
+  inside = (x >= 0) & (x <= 3 * m.width) & (y >= 0) & (y <= 3 * m.height)
+
+  x = numpy.clip(x, 0, 3 * m.width)
+  y = numpy.clip(y, 0, 3 * m.height)
+  # A point on the far edge of the grid belongs to the last cell
+  ix = numpy.minimum(x.astype(numpy.intp), 3 * m.width - 1)
+  iy = numpy.minimum(y.astype(numpy.intp), 3 * m.height - 1)
+
+  return inside, iy, ix, x - ix, y - iy
+
+def interpolate(grid, m, coords, slide=1.0):
+  """Bilinear interpolation of many points at once.
+
+  grid is a cart grid for the map m, as returned by gridfile.load_grid,
+  and coords is an (N,2) array of map coordinates. Returns an (N,2) array
+  of the corresponding cartogram coordinates, moved a fraction slide of
+  the way from the original coordinates. Points outside the padded grid
+  are returned unchanged.
+
+  grid may also be a stack of K grids for the same map, with shape
+  (K, 3H+1, 3W+1, 2), or a gridfile.GridStack, in which case the result
+  has shape (K, N, 2). The cells and weights are only computed once for all the grids.
+  """
+  coords = as_coords_array(coords)
+  inside, iy, ix, dx, dy = grid_cells(m, coords)
+  dx, dy = dx[:,numpy.newaxis], dy[:,numpy.newaxis]
+
+  t = (1-dx)*(1-dy)*grid[..., iy, ix, :]   \
+    + dx*(1-dy)*grid[..., iy, ix+1, :]     \
+    + (1-dx)*dy*grid[..., iy+1, ix, :]     \
+    + dx*dy*grid[..., iy+1, ix+1, :]
+
+  r = numpy.empty(t.shape)
+  r[...,0] = (t[...,0] - m.width)  * (m.x_max - m.x_min) / m.width  + m.x_min
+  r[...,1] = (t[...,1] - m.height) * (m.y_max - m.y_min) / m.height + m.y_min
+
+  if slide != 1.0:
+    r = (1.0 - slide) * coords + slide * r
+  r[..., ~inside, :] = coords[~inside]
+  return r
+
+def jacobian(grid, m, coords):
+  """The Jacobian of the bilinear interpolation of grid at each point of
+  the (N,2) array coords, as an (N,2,2) array J with J[n,i,j] the
+  derivative of cartogram coordinate i with respect to map coordinate j
+  at point n. As with interpolate, grid may be a stack of K grids, giving
+  a (K,N,2,2) array. Points outside the padded grid, which interpolate
+  leaves unchanged, have the identity.
+  """
+  coords = as_coords_array(coords)
+  inside, iy, ix, dx, dy = grid_cells(m, coords)
+  dx, dy = dx[:,numpy.newaxis], dy[:,numpy.newaxis]
+
+  g00, g01 = grid[..., iy, ix, :], grid[..., iy, ix+1, :]
+  g10, g11 = grid[..., iy+1, ix, :], grid[..., iy+1, ix+1, :]
+  # The derivatives with respect to the column and row in the grid
+  d_col = (1-dy)*(g01 - g00) + dy*(g11 - g10)
+  d_row = (1-dx)*(g10 - g00) + dx*(g11 - g01)
+
+  # Grid units are a different size in x and y, in map coordinates
+  x_unit = (m.x_max - m.x_min) / float(m.width)
+  y_unit = (m.y_max - m.y_min) / float(m.height)
+  unit = numpy.array([ x_unit, y_unit ])
+  j = numpy.empty(d_col.shape + (2,))
+  j[..., 0] = d_col * unit / x_unit
+  j[..., 1] = d_row * unit / y_unit
+  j[..., ~inside, :, :] = numpy.eye(2)
+  return j
+
+def max_stretch(grid, m, rows_at_a_time=256):
+  """An upper bound on the factor by which the interpolation of grid,
+  a single (H, W, 2) cart grid or window of one, can lengthen a line
+  segment that lies within it, measured in map units.
+
+  Within a cell, each column of the Jacobian is a weighted average of
+  the differences along two opposite edges of the cell, so its length is
+  at most that of the longest difference along any edge in the same
+  direction. The grid is read a few rows at a time, so a memory-mapped
+  grid is never copied whole.
+  """
+  # The size of a grid cell, in map units
+  cell = numpy.array([ (m.x_max - m.x_min) / float(m.width), (m.y_max - m.y_min) / float(m.height) ])
+  max_dx = max_dy = 0.0
+  for row0 in range(0, grid.shape[0] - 1, rows_at_a_time):
+    rows = numpy.asarray(grid[row0 : row0 + rows_at_a_time + 1], dtype=numpy.float64)
+    dx = numpy.diff(rows, axis=1) * cell / cell[0]
+    dy = numpy.diff(rows, axis=0) * cell / cell[1]
+    max_dx = max(max_dx, numpy.sqrt((dx ** 2).sum(axis=-1)).max())
+    max_dy = max(max_dy, numpy.sqrt((dy ** 2).sum(axis=-1)).max())
+  # Points outside the grid are left where they are
+  return max(1.0, math.hypot(max_dx, max_dy))
+
 class Interpolator(object):
   """
   Linear interpolation for cartogram grids.
-  You should use FastInterpolator instead, if at all possible.
+  Use map_array (or map) to interpolate a whole ring of points at once,
+  which is much faster than calling the interpolator once per point.
+  
+  If bbox = (x_min, y_min, x_max, y_max) is given, in map coordinates,
+  only the part of the grid that covers it is loaded (see
+  gridfile.load_grid_window).
   """
-  def __init__(self, grid_filename, the_map):
+  def __init__(self, grid_filename, the_map, cache=None, bbox=None):
     self.m = the_map
-    self.a = numpy.fromfile(grid_filename, sep=' ').reshape(3*self.m.height+1, 3*self.m.width+1, 2)
+    if bbox is None:
+      self.a = gridfile.load_grid(grid_filename, the_map, cache)
+    else:
+      window = gridfile.load_grid_window([grid_filename], the_map, bbox, cache=cache)
+      self.a = gridfile.GridWindow(window.a[0], window.row0, window.col0, window.full)
 
   def __call__(self, rx, ry, slide=1.0):
-    x = (rx - self.m.x_min) * self.m.width  / (self.m.x_max - self.m.x_min) + self.m.width
-    y = (ry - self.m.y_min) * self.m.height / (self.m.y_max - self.m.y_min) + self.m.height
-    if x < 0 or x > 3 * self.m.width or y < 0 or y > 3 * self.m.height:
-      return rx, ry
-    
-    ix, iy = int(x), int(y)
-    dx, dy = x - ix, y - iy
-    
-    tx, ty = (1-dx)*(1-dy)*self.a[iy][ix] \
-           + dx*(1-dy)*self.a[iy][ix+1]   \
-           + (1-dx)*dy*self.a[iy+1][ix]   \
-           + dx*dy*self.a[iy+1][ix+1]
-    
-    ix, iy = (
-      (tx - self.m.width)  * (self.m.x_max - self.m.x_min) / self.m.width  + self.m.x_min,
-      (ty - self.m.height) * (self.m.y_max - self.m.y_min) / self.m.height + self.m.y_min,
-    )
-    
-    return (
-      (1.0 - slide) * rx + slide * ix,
-      (1.0 - slide) * ry + slide * iy,
-    )
-  
-  def map(self, coords):
-    return [ self(x, y) for x, y in coords ]
+    (x, y), = self.map_array([(rx, ry)], slide)
+    return x, y
+
+  def map_array(self, coords, slide=1.0):
+    """Interpolate an (N,2) array of points, returning an (N,2) array.
+    """
+    return interpolate(self.a, self.m, coords, slide)
 
-def is_newer(a, b):
-  """Is the file a newer than (or, more precisely, not older than) b?
+  def jacobian_array(self, coords):
+    """The Jacobian at each point of an (N,2) array, as an (N,2,2) array.
+    """
+    return jacobian(self.a, self.m, coords)
+
+  def map(self, coords, slide=1.0):
+    return [ tuple(p) for p in self.map_array(coords, slide).tolist() ]
+
+class FastInterpolator(Interpolator):
+  """This used to be a faster alternative to Interpolator, using
+  scipy.interpolate. Interpolator is now just as fast, so this is
+  kept only for compatibility.
   """
-  return os.stat(a).st_mtime >= os.stat(b).st_mtime
+  pass
 
-class FastInterpolator(object):
-  """Faster linear interpolation, using scipy.interpolate.
+class MultiInterpolator(object):
+  """Linear interpolation for several cartogram grids of the same map.
+
+  The grids are indexed together as a gridfile.GridStack, so that a ring
+  can be interpolated for every cartogram in one pass, finding the cells
+  and weights of its points only once, while the grids themselves stay
+  memory-mapped. As with
+  Interpolator, bbox restricts this to the part of the grids that covers it.
   """
-  def __init__(self, grid_filename, m):
-    pickle_filename = grid_filename + ".pickled"
-    if os.path.isfile(pickle_filename) and is_newer(pickle_filename, grid_filename):
-      with open(pickle_filename, 'r') as f:
-        self.x = pickle.load(f)
-        self.y = pickle.load(f)
-    else:
-      self.load_cart(grid_filename, m)
-      with open(pickle_filename, 'w') as f:
-        pickle.dump(self.x, f, -1)
-        pickle.dump(self.y, f, -1)
-  
-  def load_cart(self, grid_filename, m):
-    import scipy.interpolate
-    grid = numpy.fromfile(grid_filename, sep=' ').reshape(3*m.height+1, 3*m.width+1, 2)
-    
-    x_pts = (numpy.arange(3*m.width+1) - m.width) * (m.x_max - m.x_min) / m.width  + m.x_min
-    y_pts = (numpy.arange(3*m.height+1) - m.height) * (m.y_max - m.y_min) / m.height  + m.y_min
-    
-    x_grid = (grid[:,:,0] - m.width) * (m.x_max - m.x_min) / m.width  + m.x_min
-    y_grid = (grid[:,:,1] - m.height) * (m.y_max - m.y_min) / m.height  + m.y_min
+  def __init__(self, grid_filenames, the_map, cache=None, bbox=None):
+    self.m = the_map
+    if bbox is not None:
+      self.a = gridfile.load_grid_window(grid_filenames, the_map, bbox, cache=cache)
+      return
     
-    self.x = scipy.interpolate.RectBivariateSpline(y_pts, x_pts, x_grid, kx=1, ky=1)
-    self.y = scipy.interpolate.RectBivariateSpline(y_pts, x_pts, y_grid, kx=1, ky=1)
+    self.a = gridfile.GridStack([
+      gridfile.load_grid(grid_filename, the_map, cache)
+      for grid_filename in grid_filenames
+    ])
 
-  def __call__(self, rx, ry):
-    return self.x(ry, rx), self.y(ry, rx)
-  
-  def map(self, coords):
-    # map is much faster than calling __call__ repeatedly.
-    c = numpy.array(coords)
-    ys, xs = c[:,1], c[:,0]
-    return zip(self.x.ev(ys, xs), self.y.ev(ys, xs))
+  def __len__(self):
+    return self.a.shape[0]
+
+  def map_array(self, coords, slide=1.0):
+    """Interpolate an (N,2) array of points for every grid,
+    returning a (K,N,2) array.
+    """
+    return interpolate(self.a, self.m, coords, slide)
+
+  def jacobian_array(self, coords):
+    """The Jacobian for every grid at each point of an (N,2) array,
+    as a (K,N,2,2) array.
+    """
+    return jacobian(self.a, self.m, coords)
 
+  def max_stretches(self):
+    """The max_stretch of each grid, as an array."""
+    grids = self.a.grids if isinstance(self.a, gridfile.GridStack) else self.a.a
+    return numpy.array([ max_stretch(grid, self.m) for grid in grids ])
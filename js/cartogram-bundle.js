@@ -0,0 +1,137 @@
+/*
+ * Loader for the bundles written by bin/as-js.py --format=bundle, which
+ * fetches the paths for each key only when they are first asked for.
+ *
+ *   CartogramBundle.load("data/bundle/", function(error, bundle) {
+ *     bundle.paths("population", function(error, paths) {
+ *       paths["France"];  // "M x0 y0 L x1 y1 ... Z"
+ *     });
+ *   });
+ *
+ * For a bundle made with --levels, bundle.pathsAtLevel(key, i, callback)
+ * gives the paths for level i of bundle.manifest.levels.simplification
+ * (0 is the finest), fetching the levels chunk as well as the key's.
+ *
+ * The .gz and .br files next to each chunk are for the web server to
+ * send with Content-Encoding: gzip or br, to browsers that accept them.
+ */
+(function(exports) {
+  "use strict";
+
+  function fetchJSON(url, callback) {
+    var request = new XMLHttpRequest();
+    request.open("GET", url);
+    request.onload = function() {
+      if (request.status < 200 || request.status >= 300) {
+        callback(new Error("Failed to load " + url + ": " + request.status));
+        return;
+      }
+      var result;
+      try {
+        result = JSON.parse(request.responseText);
+      } catch (e) {
+        callback(e);
+        return;
+      }
+      callback(null, result);
+    };
+    request.onerror = function() {
+      callback(new Error("Failed to load " + url));
+    };
+    request.send();
+  }
+
+  function CartogramBundle(baseUrl, manifest) {
+    if (manifest.version !== 1) {
+      throw new Error("Unsupported cartogram bundle version: " + manifest.version);
+    }
+    this.baseUrl = baseUrl;
+    this.manifest = manifest;
+    this.regions = manifest.regions;
+    this.keys = manifest.keys;
+    // Chunks that have been loaded, and callbacks waiting for those being
+    // loaded, by file name
+    this.chunks = {};
+    this.waiting = {};
+  }
+
+  CartogramBundle.load = function(baseUrl, callback) {
+    if (baseUrl && baseUrl.charAt(baseUrl.length - 1) !== "/") baseUrl += "/";
+    fetchJSON(baseUrl + "manifest.json", function(error, manifest) {
+      if (error) return callback(error);
+      var bundle;
+      try {
+        bundle = new CartogramBundle(baseUrl, manifest);
+      } catch (e) {
+        return callback(e);
+      }
+      callback(null, bundle);
+    });
+  };
+
+  // Call callback(error, paths) with the paths for key, as an object of
+  // region name => SVG path, fetching them if they are not already loaded.
+  CartogramBundle.prototype.paths = function(key, callback) {
+    var chunk = this.manifest.chunks[key];
+    if (chunk === undefined) return callback(new Error("No such key: " + key));
+    this.fetchChunk(chunk, callback);
+  };
+
+  // Call callback(error, contents) with the contents of the chunk described
+  // by chunk (from the manifest), fetching it if it is not already loaded.
+  CartogramBundle.prototype.fetchChunk = function(chunk, callback) {
+    var self = this, file = chunk.file;
+    if (this.chunks.hasOwnProperty(file)) return callback(null, this.chunks[file]);
+    if (this.waiting.hasOwnProperty(file)) return this.waiting[file].push(callback);
+
+    this.waiting[file] = [callback];
+    fetchJSON(this.baseUrl + file, function(error, contents) {
+      var callbacks = self.waiting[file];
+      delete self.waiting[file];
+      if (!error) self.chunks[file] = contents;
+      for (var i = 0; i < callbacks.length; i++) {
+        callbacks[i](error, contents);
+      }
+    });
+  };
+
+  // The SVG path made of the points of path whose level index in
+  // ringLevels (a list for each ring) is at least level.
+  function pathAtLevel(path, ringLevels, level) {
+    var rings = path.split(" Z"), parts = [];
+    for (var r = 0; r < ringLevels.length; r++) {
+      var numbers = rings[r].replace(/[ML]/g, " ").trim().split(/ +/), levels = ringLevels[r], kept = [];
+      for (var i = 0; i < levels.length; i++) {
+        if (levels[i] >= level) kept.push(numbers[2*i], numbers[2*i + 1]);
+      }
+      // As in the paths from as-js.py, leave out rings of a single point
+      if (kept.length >= 4) {
+        parts.push("M", kept[0], kept[1], "L", kept.slice(2).join(" "), "Z");
+      }
+    }
+    return parts.join(" ");
+  }
+
+  CartogramBundle.prototype.pathsAtLevel = function(key, level, callback) {
+    var self = this, levels = this.manifest.levels;
+    if (levels === undefined) return callback(new Error("This bundle was not made with --levels"));
+    if (!(level >= 0 && level < levels.simplification.length)) return callback(new Error("No such level: " + level));
+
+    this.fetchChunk(levels, function(error, levelsByRegion) {
+      if (error) return callback(error);
+      self.paths(key, function(error, paths) {
+        if (error) return callback(error);
+        var result = {};
+        for (var regionName in paths) {
+          if (paths.hasOwnProperty(regionName)) {
+            result[regionName] = pathAtLevel(paths[regionName], levelsByRegion[regionName], level);
+          }
+        }
+        callback(null, result);
+      });
+    });
+  };
+
+  CartogramBundle.pathAtLevel = pathAtLevel;
+  exports.CartogramBundle = CartogramBundle;
+})(typeof exports !== "undefined" ? exports : this);
@@ -0,0 +1,96 @@
+/*
+ * Decoder for the binary paths written by bin/as-js.py --format=binary.
+ * (See bin/pathcodec.py for a description of the format.)
+ *
+ *   var paths = new CartogramPaths(manifest, arrayBuffer);
+ *   paths.rings("population", "France");  // [Float64Array [x0, y0, x1, y1, ...], ...]
+ *   paths.svg("population", "France");    // "M x0 y0 L x1 y1 ... Z"
+ *   paths.all("population");              // { region name: SVG path }
+ *
+ * where manifest is the parsed JSON manifest and arrayBuffer holds the
+ * binary file, as fetched with responseType = "arraybuffer".
+ */
+(function(exports) {
+  "use strict";
+
+  function CartogramPaths(manifest, buffer) {
+    if (manifest.version !== 1) {
+      throw new Error("Unsupported cartogram paths version: " + manifest.version);
+    }
+    this.manifest = manifest;
+    this.bytes = new Uint8Array(buffer);
+    this.regionIndex = {};
+    for (var i = 0; i < manifest.regions.length; i++) {
+      this.regionIndex[manifest.regions[i]] = i;
+    }
+  }
+
+  // Decode the path that occupies bytes[start:end] into an array of rings,
+  // each a Float64Array of alternating x and y coordinates.
+  function decodePath(bytes, start, end, scale) {
+    var pos = start;
+    function varint() {
+      // Numbers in the path are well within 2^53, so use arithmetic
+      // rather than bit operations, which would truncate to 32 bits.
+      var result = 0, multiplier = 1, b;
+      do {
+        b = bytes[pos++];
+        result += (b & 0x7f) * multiplier;
+        multiplier *= 128;
+      } while (b & 0x80);
+      return result;
+    }
+    function signedVarint() {
+      var n = varint();
+      return (n % 2) ? -(n + 1) / 2 : n / 2;
+    }
+
+    var rings = [], nRings = varint();
+    for (var r = 0; r < nRings; r++) {
+      var n = varint(), ring = new Float64Array(2 * n), x = 0, y = 0;
+      for (var i = 0; i < n; i++) {
+        x += signedVarint();
+        y += signedVarint();
+        ring[2*i] = x * scale;
+        ring[2*i + 1] = y * scale;
+      }
+      rings.push(ring);
+    }
+    if (pos !== end) {
+      throw new Error("Corrupt cartogram path: expected " + (end - start) + " bytes, read " + (pos - start));
+    }
+    return rings;
+  }
+
+  CartogramPaths.prototype.rings = function(key, regionName) {
+    var paths = this.manifest.paths[key], i = this.regionIndex[regionName];
+    if (paths === undefined) throw new Error("No such key: " + key);
+    if (i === undefined) throw new Error("No such region: " + regionName);
+    return decodePath(this.bytes,
+      paths.offset + paths.offsets[i], paths.offset + paths.offsets[i + 1],
+      this.manifest.scale);
+  };
+
+  CartogramPaths.prototype.svg = function(key, regionName) {
+    var rings = this.rings(key, regionName), digits = this.manifest.decimal_digits, parts = [];
+    for (var r = 0; r < rings.length; r++) {
+      var ring = rings[r];
+      parts.push("M", ring[0].toFixed(digits), ring[1].toFixed(digits), "L");
+      for (var i = 2; i < ring.length; i += 2) {
+        parts.push(ring[i].toFixed(digits), ring[i + 1].toFixed(digits));
+      }
+      parts.push("Z");
+    }
+    return parts.join(" ");
+  };
+
+  CartogramPaths.prototype.all = function(key) {
+    var result = {}, regions = this.manifest.regions;
+    for (var i = 0; i < regions.length; i++) {
+      result[regions[i]] = this.svg(key, regions[i]);
+    }
+    return result;
+  };
+
+  exports.CartogramPaths = CartogramPaths;
+})(typeof exports !== "undefined" ? exports : this);
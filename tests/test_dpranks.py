@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+import numpy
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import dpranks
+
+def random_line(rng, n):
+  return numpy.cumsum(rng.normal(0, 10, (n, 2)), axis=0)
+
+class RanksTest(unittest.TestCase):
+  def test_same_as_simplify(self):
+    rng = numpy.random.RandomState(0)
+    for n in (2, 3, 10, 200):
+      line = random_line(rng, n)
+      # Points on a grid, so that there are ties between distances
+      for points in (line, numpy.round(line / 10)):
+        ranks = dpranks.ranks(points)
+        for tolerance in (0.5, 2.0, 10.0, 50.0):
+          simplified = numpy.array(LineString(points).simplify(tolerance, preserve_topology=False).coords)
+          self.assertEqual(points[ranks > tolerance].tolist(), simplified.tolist())
+
+  def test_many_lines_at_once(self):
+    rng = numpy.random.RandomState(1)
+    lines = [ random_line(rng, n) for n in (5, 0, 1, 2, 40, 17) ]
+    offsets = numpy.cumsum([ 0 ] + [ len(line) for line in lines ])
+    min_tolerances = [ 0, 0, 0, 0, 3.0, 100.0 ]
+    ranks = dpranks.ranks_of_lines(numpy.concatenate(lines), offsets, min_tolerances)
+    for line, min_tolerance, start, end in zip(lines, min_tolerances, offsets[:-1], offsets[1:]):
+      self.assertEqual(ranks[start:end].tolist(), dpranks.ranks(line, min_tolerance).tolist())
+
+  def test_min_tolerance(self):
+    line = random_line(numpy.random.RandomState(2), 100)
+    ranks, coarse = dpranks.ranks(line), dpranks.ranks(line, 20.0)
+    kept = ranks > 20.0
+    self.assertEqual(coarse[kept].tolist(), ranks[kept].tolist())
+    self.assertTrue((coarse[~kept] == 0).all())
+
+class FitBudgetTest(unittest.TestCase):
+  def test_fit_budget(self):
+    region_ranks = {
+      "a": numpy.array([ numpy.inf, 5.0, 1.0, 3.0, numpy.inf ]),
+      "b": numpy.array([ numpy.inf, 2.0, 4.0, 6.0, 0.5, numpy.inf ]),
+    }
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 100), (0.0, {}, 11))
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 7), (3.0, {}, 7))
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 4), (6.0, {}, 4))
+    # Only the end points are always kept
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 1), (6.0, {}, 4))
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 6, 3), (4.0, {}, 6))
+    # Too small a budget for the minimums, so each region keeps exactly 3
+    # points with a simplification of its own
+    self.assertEqual(dpranks.fit_budget(dict(region_ranks), 5, 3), (6.0, { "a": 3.0, "b": 4.0 }, 6))
+
+  def test_tied_ranks_at_minimum(self):
+    ranks = numpy.array([ numpy.inf, 2.0, 1.0, 2.0, 2.0, numpy.inf ])
+    simplification, simplification_dict, n_vertices = dpranks.fit_budget({ "a": ranks.copy() }, 1, 3)
+    # No simplification keeps just 3 of these points: the ones ranked 2.0 go together
+    self.assertEqual((simplification, simplification_dict, n_vertices), (2.0, { "a": 1.0 }, 5))
+    self.assertEqual((ranks > simplification_dict["a"]).sum(), n_vertices)
+
+if __name__ == "__main__":
+  unittest.main()
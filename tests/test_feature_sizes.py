@@ -0,0 +1,40 @@
+import imp
+import os
+import sys
+import unittest
+
+import numpy
+from shapely.geometry import Polygon
+
+bin_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+sys.path.insert(0, bin_directory)
+as_js = imp.load_source("as_js", os.path.join(bin_directory, "as-js.py"))
+
+class RingSizesTest(unittest.TestCase):
+  def test_ring_sizes(self):
+    rng = numpy.random.RandomState(0)
+    t = numpy.linspace(0, 2*numpy.pi, 40)[:-1]
+    blob = numpy.column_stack([ 30 * numpy.cos(t), 10 * numpy.sin(t) ]) * rng.uniform(0.8, 1.2, (len(t), 1))
+    polygons = [
+      [ numpy.array([ [ 0, 0 ], [ 4, 0 ], [ 4, 3 ], [ 0, 3 ], [ 0, 0 ] ], dtype=float),
+        numpy.array([ [ 1, 1 ], [ 1, 2 ], [ 2, 2 ], [ 1, 1 ] ], dtype=float) ],
+      # An empty ring, as simplification can leave, between two others
+      [ numpy.r_[ blob, blob[:1] ] + 100, numpy.zeros((0, 2)) ],
+      [ numpy.array([ [ -5, -5 ], [ -5, -5 ] ], dtype=float) ],
+    ]
+    region = as_js.SimplifiedMultipolygon.from_polygons("test", polygons)
+    extent, area = as_js.AsJSON._ring_sizes(region, region.points)
+
+    rings = [ ring for rings in polygons for ring in rings ]
+    self.assertEqual(len(extent), len(rings))
+    for ring, ring_extent, ring_area in zip(rings, extent, area):
+      if len(ring) == 0:
+        self.assertEqual((ring_extent, ring_area), (0, 0))
+        continue
+      x_min, y_min = ring.min(axis=0)
+      x_max, y_max = ring.max(axis=0)
+      self.assertAlmostEqual(ring_extent, max(x_max - x_min, y_max - y_min))
+      self.assertAlmostEqual(ring_area, Polygon(ring).area if len(ring) > 3 else 0)
+
+if __name__ == "__main__":
+  unittest.main()
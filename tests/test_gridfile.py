@@ -0,0 +1,121 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import gridcache
+import gridfile
+
+def make_grid(m, seed=0):
+  """A padded grid for m: the identity, moved a little at random."""
+  rng = numpy.random.RandomState(seed)
+  y, x = numpy.mgrid[0:3*m.height+1, 0:3*m.width+1]
+  return numpy.dstack([ x, y ]).astype(numpy.float64) + rng.uniform(-0.3, 0.3, (3*m.height+1, 3*m.width+1, 2))
+
+class GridFileTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = gridcache.Cache(os.path.join(self.directory, "cache"))
+    self.m = gridfile.GridHeader(7, 5, -70.0, 70.0, -25.0, 25.0)
+    self.grid = make_grid(self.m)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def test_binary_round_trip(self):
+    gridfile.write_binary_grid(self.path("g.bin"), self.grid, self.m)
+    header, grid = gridfile.open_binary_grid(self.path("g.bin"))
+    self.assertEqual(header.dtype, numpy.float64)
+    self.assertEqual((header.width, header.height), (7, 5))
+    self.assertTrue((grid == self.grid).all())
+    self.assertTrue((gridfile.load_grid(self.path("g.bin"), self.m) == self.grid).all())
+
+  def test_float32_round_trip(self):
+    header = gridfile.write_binary_grid(self.path("g.bin"), self.grid, self.m, float32=True)
+    grid = gridfile.load_grid(self.path("g.bin"), self.m)
+    self.assertEqual(grid.dtype, numpy.float32)
+    self.assertTrue(header.max_error > 0)
+    self.assertTrue(numpy.abs(grid - self.grid).max() <= header.max_error)
+
+  def test_text_grid_is_cached(self):
+    gridfile.write_text_grid(self.path("g.cart"), self.grid)
+    for i in range(2):
+      grid = gridfile.load_grid(self.path("g.cart"), self.m, self.cache)
+      self.assertTrue(isinstance(grid, numpy.memmap))
+      self.assertTrue((grid == self.grid).all())
+    self.assertEqual(len(self.cache.entries()), 1)
+
+  def test_cache_is_pruned_to_its_cap(self):
+    gridfile.write_text_grid(self.path("a.cart"), self.grid)
+    gridfile.write_text_grid(self.path("b.cart"), make_grid(self.m, 1))
+    gridfile.load_grid(self.path("a.cart"), self.m, self.cache)
+    entry_size = self.cache.size()
+    cache = gridcache.Cache(os.path.join(self.directory, "cache"), max_size=str(entry_size * 3 // 2))
+    gridfile.load_grid(self.path("a.cart"), self.m, cache)
+    self.assertEqual(len(cache.entries()), 1)
+    grid = gridfile.load_grid(self.path("b.cart"), self.m, cache)
+    self.assertEqual([ entry.path for entry in cache.entries() ], [ grid.filename ])
+
+  def test_cached_grid_pruned_before_it_is_opened(self):
+    gridfile.write_text_grid(self.path("g.cart"), self.grid)
+    get = self.cache.get
+    pruned = []
+    def get_then_prune(key, create, meta=None):
+      path = get(key, create, meta)
+      if not pruned:
+        # As if another process pruned the cache just then
+        pruned.extend(self.cache.prune(0))
+      return path
+    self.cache.get = get_then_prune
+    grid = gridfile.load_grid(self.path("g.cart"), self.m, self.cache)
+    self.assertEqual(len(pruned), 1)
+    self.assertTrue((grid == self.grid).all())
+
+  def test_wrong_map(self):
+    gridfile.write_binary_grid(self.path("g.bin"), self.grid, self.m)
+    other = gridfile.GridHeader(7, 5, -70.0, 70.0, -25.0, 30.0)
+    self.assertRaises(Exception, gridfile.load_grid, self.path("g.bin"), other)
+
+  def test_window(self):
+    gridfile.write_binary_grid(self.path("a.bin"), self.grid, self.m)
+    gridfile.write_text_grid(self.path("b.cart"), self.grid[::-1])
+    bbox = (-20.0, -5.0, 10.0, 8.0)
+    (row0, row1), (col0, col1) = gridfile.window_bounds(self.m, bbox, margin=1)
+    iy, ix = numpy.array([ row0, row1 - 1, row0 + 1 ]), numpy.array([ col0, col1 - 1, col1 - 2 ])
+    expected = numpy.array([ self.grid[iy, ix], self.grid[::-1][iy, ix] ])
+
+    # With a cache that can't be used, the text grid is parsed directly,
+    # and nothing outside the window can be looked up
+    unusable = gridcache.Cache(os.path.join(self.path("a.bin"), "cache"))
+    window = gridfile.load_grid_window([ self.path("a.bin"), self.path("b.cart") ], self.m, bbox, margin=1, cache=unusable)
+    self.assertEqual(window.shape, (2, row1 - row0, col1 - col0, 2))
+    self.assertTrue((window[..., iy, ix, :] == expected).all())
+    self.assertRaises(Exception, window.__getitem__, (Ellipsis, iy - 1, ix, slice(None)))
+
+    # Nor is a text grid put in the cache just for a window
+    window = gridfile.load_grid_window([ self.path("a.bin"), self.path("b.cart") ], self.m, bbox, margin=1, cache=self.cache)
+    self.assertTrue((window[..., iy, ix, :] == expected).all())
+    self.assertEqual(self.cache.entries(), [])
+
+    # Once the text grid is in the cache, the window is taken from there
+    gridfile.load_grid(self.path("b.cart"), self.m, self.cache)
+    window = gridfile.load_grid_window([ self.path("a.bin"), self.path("b.cart") ], self.m, bbox, margin=1, cache=self.cache)
+    outside = numpy.array([ 0, 3*self.m.height ]), numpy.array([ 0, 3*self.m.width ])
+    self.assertTrue((window[..., outside[0], outside[1], :] == numpy.array([ self.grid[outside], self.grid[::-1][outside] ])).all())
+
+  def test_stack(self):
+    grids = [ self.grid, make_grid(self.m, 1).astype(numpy.float32) ]
+    stack = gridfile.GridStack(grids)
+    self.assertEqual(stack.shape, (2, 3*self.m.height+1, 3*self.m.width+1, 2))
+    iy, ix = numpy.array([ 0, 4, 15 ]), numpy.array([ 21, 3, 0 ])
+    self.assertTrue((stack[..., iy, ix, :] == numpy.array(grids, dtype=numpy.float64)[..., iy, ix, :]).all())
+
+if __name__ == "__main__":
+  unittest.main()
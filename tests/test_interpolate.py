@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import gridfile
+import utils
+
+class InterpolateTest(unittest.TestCase):
+  def setUp(self):
+    self.m = gridfile.GridHeader(8, 4, -80.0, 80.0, -20.0, 20.0)
+    rng = numpy.random.RandomState(0)
+    y, x = numpy.mgrid[0:3*self.m.height+1, 0:3*self.m.width+1]
+    identity = numpy.dstack([ x, y ]).astype(numpy.float64)
+    self.grids = [ identity + rng.uniform(-0.4, 0.4, identity.shape) for i in range(2) ]
+    self.identity = identity
+
+    # Points well inside their cells, where the interpolation is smooth
+    cells = numpy.column_stack([ rng.randint(0, 3*self.m.width, 50), rng.randint(0, 3*self.m.height, 50) ])
+    offsets = rng.uniform(0.1, 0.9, (50, 2))
+    cell_size = numpy.array([ (self.m.x_max - self.m.x_min) / self.m.width, (self.m.y_max - self.m.y_min) / self.m.height ])
+    self.points = (cells + offsets - [ self.m.width, self.m.height ]) * cell_size + [ self.m.x_min, self.m.y_min ]
+
+  def test_identity(self):
+    self.assertTrue(numpy.allclose(utils.interpolate(self.identity, self.m, self.points), self.points))
+    outside = numpy.array([ [ 1000.0, 0.0 ], [ 0.0, -1000.0 ] ])
+    self.assertEqual(utils.interpolate(self.grids[0], self.m, outside).tolist(), outside.tolist())
+
+  def test_jacobian(self):
+    h = 1e-6
+    for grid in self.grids + [ numpy.array(self.grids) ]:
+      J = utils.jacobian(grid, self.m, self.points)
+      for j, step in enumerate(([ h, 0 ], [ 0, h ])):
+        difference = (utils.interpolate(grid, self.m, self.points + step) - utils.interpolate(grid, self.m, self.points - step)) / (2 * h)
+        self.assertTrue(numpy.allclose(J[..., j], difference, rtol=1e-5, atol=1e-6))
+
+  def test_stack(self):
+    stack = gridfile.GridStack(self.grids)
+    self.assertTrue(numpy.allclose(
+      utils.interpolate(stack, self.m, self.points),
+      [ utils.interpolate(grid, self.m, self.points) for grid in self.grids ]))
+
+  def test_max_stretch(self):
+    for grid in self.grids:
+      J = utils.jacobian(grid, self.m, self.points)
+      largest = max(numpy.linalg.svd(j, compute_uv=False)[0] for j in J)
+      self.assertTrue(largest <= utils.max_stretch(grid, self.m, rows_at_a_time=3))
+    self.assertTrue(numpy.allclose(utils.max_stretch(self.identity, self.m), numpy.sqrt(2)))
+
+if __name__ == "__main__":
+  unittest.main()
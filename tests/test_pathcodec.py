@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import pathcodec
+
+class PathCodecTest(unittest.TestCase):
+  def test_zigzag(self):
+    values = numpy.array([ 0, -1, 1, -2, 2, 2**62, -2**63 ], dtype=numpy.int64)
+    self.assertEqual(pathcodec.zigzag(values[:5]).tolist(), [ 0, 1, 2, 3, 4 ])
+    self.assertEqual(pathcodec.unzigzag(pathcodec.zigzag(values)).tolist(), values.tolist())
+
+  def test_varints(self):
+    values = numpy.array([ 0, 1, 127, 128, 300, 16383, 16384, 2**35, 2**64 - 1 ], dtype=numpy.uint64)
+    data = pathcodec.encode_varints(values)
+    self.assertEqual(pathcodec.encode_varints([ 300 ]), "\xac\x02")
+    self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 2 + 3 + 6 + 10)
+    self.assertEqual(pathcodec.decode_varints(data).tolist(), values.tolist())
+    self.assertEqual(pathcodec.decode_varints(pathcodec.encode_varints([])).tolist(), [])
+
+  def test_path_round_trip(self):
+    rng = numpy.random.RandomState(0)
+    rings = [
+      pathcodec.quantize(numpy.cumsum(rng.normal(0, 1000, (n, 2)), axis=0), 0.01)
+      for n in (1, 2, 50, 1000)
+    ]
+    decoded = pathcodec.decode_path(pathcodec.encode_path(rings))
+    self.assertEqual(len(decoded), len(rings))
+    for ring, decoded_ring in zip(rings, decoded):
+      self.assertEqual(decoded_ring.tolist(), ring.tolist())
+    self.assertEqual(pathcodec.decode_path(pathcodec.encode_path([])), [])
+
+  def test_path_as_svg(self):
+    rings = [ numpy.array([ [ 0, 0 ], [ 10, -5 ], [ 3, 7 ] ]) ]
+    self.assertEqual(pathcodec.path_as_svg(rings, 0.5, 1), "M 0.0 0.0 L 5.0 -2.5 1.5 3.5 Z")
+
+if __name__ == "__main__":
+  unittest.main()